@@ -9,8 +9,12 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'acris.settings')
+django.setup(set_prefix=False)
 
-application = get_asgi_application()
+# serves audio streams from the event loop, see acris.core.asgi
+from acris.core.asgi import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from acris.core.models import AcrisUser, Collection, Artist, Playlist, Album, Genre, Track
+from acris.core.models import AcrisUser, Collection, Artist, Playlist, Album, Genre, Track, IngestJob
 
 admin.site.register(Album)
 admin.site.register(Track)
@@ -8,3 +8,4 @@ admin.site.register(Artist)
 admin.site.register(Collection)
 admin.site.register(Genre)
 admin.site.register(Playlist)
+admin.site.register(IngestJob)
@@ -3,3 +3,15 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'acris.core'
+
+    def ready(self):
+        # connect the signal receivers that keep cover references, access maps, cached responses, smart playlists, the
+        # search index and aggregates in sync, remove orphaned entities and unlink the files of deleted rows
+        import acris.core.caching  # noqa: F401
+        import acris.core.covers  # noqa: F401
+        import acris.core.deletion  # noqa: F401
+        import acris.core.permissions  # noqa: F401
+        import acris.core.playlists  # noqa: F401
+        import acris.core.reaper  # noqa: F401
+        import acris.core.search  # noqa: F401
+        import acris.core.stats  # noqa: F401
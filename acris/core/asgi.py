@@ -0,0 +1,116 @@
+import asyncio
+import os
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+from acris.core.streaming import STREAM_CHUNK_SIZE
+
+# ASGI handler that sends audio without holding a thread for the length of the stream.
+#
+# Requests still go through the middleware and the (synchronous) DRF views, which only check permissions, look the
+# track up and return a response carrying a FilePlan (see acris.core.streaming). The body of those responses is then
+# read in chunks on the default executor and sent from the event loop. Each chunk waits for the server to accept the
+# previous one, so a slow listener only ever has one chunk in memory, and the stream stops when the client leaves.
+# Other streamed responses (the list exports) are produced by iterators that query the database as they go, each of
+# their parts is taken in the request's thread and sent from the event loop the same way.
+
+
+# the send callable of a request together with its scope and receive, so send_response can watch for disconnects
+class ResponseChannel:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+
+    async def __call__(self, message):
+        await self.send(message)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+def response_headers(response):
+    headers = []
+    for header, value in response.items():
+        headers.append((header.encode('ascii'), str(value).encode('latin1')))
+    for cookie in response.cookies.values():
+        headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+    return headers
+
+
+async def send_file_plan(plan, account, channel):
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(channel.receive))
+    fd = await loop.run_in_executor(None, os.open, plan.path, os.O_RDONLY)
+    try:
+        for prefix, start, end in plan.parts:
+            if prefix:
+                await channel.send({'type': 'http.response.body', 'body': prefix, 'more_body': True})
+            offset = start
+            while offset <= end:
+                if disconnected.done():
+                    return
+                data = await loop.run_in_executor(None, os.pread, fd, min(STREAM_CHUNK_SIZE, end - offset + 1),
+                                                  offset)
+                if not data:
+                    break
+                await channel.send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                account.sent(len(data))
+                offset += len(data)
+        await channel.send({'type': 'http.response.body', 'body': plan.closing, 'more_body': False})
+    finally:
+        disconnected.cancel()
+        os.close(fd)
+
+
+async def send_streaming_content(response, channel):
+    disconnected = asyncio.ensure_future(wait_for_disconnect(channel.receive))
+    parts = iter(response)
+    next_part = sync_to_async(next, thread_sensitive=True)
+    try:
+        while not disconnected.done():
+            part = await next_part(parts, None)
+            if part is None:
+                await channel.send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                return
+            if part:
+                await channel.send({'type': 'http.response.body', 'body': part, 'more_body': True})
+    finally:
+        disconnected.cancel()
+
+
+class StreamingASGIHandler(ASGIHandler):
+    async def __call__(self, scope, receive, send):
+        await super().__call__(scope, receive, ResponseChannel(scope, receive, send))
+
+    async def send_response(self, response, send):
+        plan = getattr(response, 'file_plan', None)
+        # middleware may have replaced the status (a 304 for instance), then the plan no longer describes the body
+        if plan is not None and (not plan.parts or plan.status != response.status_code):
+            plan = None
+        # django iterates streamed responses on the event loop, where they cannot query the database
+        if plan is None and not response.streaming:
+            await super().send_response(response, send)
+            return
+
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': response_headers(response)})
+        try:
+            if plan is None:
+                await send_streaming_content(response, send)
+                return
+            if send.scope['method'] == 'HEAD':
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                return
+            # bytes are counted as they are sent, not assumed sent in full as with sendfile
+            account = response.stream_account
+            account.expected = None
+            await send_file_plan(plan, account, send)
+        finally:
+            # a planned response's own file is never read, closing it also ends the request for django
+            await sync_to_async(response.close, thread_sensitive=True)()
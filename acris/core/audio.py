@@ -1,9 +1,20 @@
-import mutagen
-import acris.core.metadata as metadata
+import logging
+
+import acris.core.importer as importer
+import acris.core.tags as tags
 from acris.core.models import Track
 
+logger = logging.getLogger(__name__)
+
 
+# read the tags of a track's file again and write them with the same bulk path imports use
 def setup_track_from_file(track: Track):
-    meta = mutagen.File(track.audio_src.path)
-    metadata.extract_metadata(track, meta)
-    track.save()
+    try:
+        record = tags.read_record(track.audio_src.path, track.content_hash or None)
+    except Exception:
+        importer.read_failed(track.file_name)
+        logger.exception('could not read tags', extra={'track': track.id, 'file_name': track.file_name})
+        raise
+    if record is None:
+        raise ValueError('unsupported audio format: %s' % track.file_name)
+    importer.rewrite_tracks(track.collection, importer.LibraryNames(track.collection), [(track, record)])
@@ -0,0 +1,374 @@
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import django
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, connection, connections
+from django.utils.timezone import make_aware
+from rest_framework.test import APIClient
+
+import acris.core.audio as audio
+import acris.core.deletion as deletion
+import acris.core.importer as importer
+import acris.core.metrics as metrics
+import acris.core.synthetic as synthetic
+import acris.core.tags as tags
+from acris.core.models import AcrisUser, Collection, Album, Artist, Genre, IngestJob, Track
+
+# Benchmarks against a synthetic library in the configured database. Everything is created in collections of a
+# benchmark user that are deleted afterwards, timings are reported in milliseconds as json.
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'min_ms': round(samples[0] * 1000, 3),
+        'median_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def create_collection(user, name):
+    collection = Collection.objects.create(name=name, is_public=False, date_created=make_aware(datetime.now()))
+    collection.owners.add(user)
+    return collection
+
+
+# ~~~ Ingestion ~~~
+
+# setup_track_from_file on every file, as an upload's ingest job runs it
+def bench_ingest(collection, files):
+    timings = {}
+    failed = {}
+    for path, audio_format in files:
+        with open(path, 'rb') as f:
+            track = Track(date_uploaded=make_aware(datetime.now()), collection=collection,
+                          file_name=os.path.basename(path), audio_src=File(f, name=os.path.basename(path)))
+            track.save()
+        start = time.perf_counter()
+        try:
+            audio.setup_track_from_file(track)
+        except Exception:
+            failed[audio_format] = failed.get(audio_format, 0) + 1
+            continue
+        timings.setdefault(audio_format, []).append(time.perf_counter() - start)
+
+    result = {audio_format: summarize(samples) for audio_format, samples in sorted(timings.items())}
+    for audio_format, count in failed.items():
+        result.setdefault(audio_format, {})['failed'] = count
+    return result
+
+
+# tag extraction alone, every file read repeat times in this process
+def bench_tags(files, repeat):
+    paths = {}
+    for path, audio_format in files:
+        paths.setdefault(audio_format, []).append(path)
+
+    result = {}
+    for audio_format, format_paths in sorted(paths.items()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path in format_paths:
+                tags.read_tags(path)
+        duration = time.perf_counter() - start
+        count = len(format_paths) * repeat
+        result[audio_format] = {
+            'files': count,
+            'seconds': round(duration, 3),
+            'files_per_second': round(count / duration, 1) if duration else None,
+        }
+    return result
+
+
+# the bulk import path: tags parsed in worker processes, tracks written in batches
+def bench_import(collection, files):
+    names = []
+    for path, audio_format in files:
+        with open(path, 'rb') as f:
+            names.append(default_storage.save(importer.audio_storage_name(collection, os.path.basename(path)), f))
+    job = IngestJob.objects.create(date_created=make_aware(datetime.now()), collection=collection,
+                                   kind=IngestJob.IMPORT, total=len(names), files=names)
+    start = time.perf_counter()
+    importer.run_import(job)
+    duration = time.perf_counter() - start
+    return {
+        'files': len(names),
+        'failed': job.failed,
+        'seconds': round(duration, 3),
+        'files_per_second': round(len(names) / duration, 1) if duration else None,
+    }
+
+
+# import records for tracks, stored under names pointing at nothing but using the formats of the generated files
+def track_records(collection, tracks, files, start=0):
+    for number, track in enumerate(tracks, start):
+        audio_format = files[number % len(files)][1]
+        name = 'collection-%d/tracks/synthetic/%07d.%s' % (collection.id, number, audio_format)
+        yield name, synthetic.import_record(track, audio_format)
+
+
+# tracks written straight to the database
+def fill_database(collection, tracks, files):
+    names = importer.LibraryNames(collection)
+    batch = []
+    for record in track_records(collection, tracks, files):
+        batch.append(record)
+        if len(batch) == importer.BATCH_SIZE:
+            importer.write_tracks(collection, names, batch)
+            batch = []
+    if batch:
+        importer.write_tracks(collection, names, batch)
+
+
+# ~~~ Requests ~~~
+
+def request_cases(collection, track, search_term):
+    album = Album.objects.filter(collection=collection).order_by('id').first()
+    artist = Artist.objects.filter(collection=collection).order_by('id').first()
+    genre = Genre.objects.filter(collection=collection).order_by('id').first()
+    collection_url = '/api/collection/%d/' % collection.id
+    stream_url = '/api/track/%d/stream/' % track.id
+    return [
+        ('tracks', collection_url + 'tracks/', {}),
+        ('tracks_by_year', collection_url + 'tracks/?ordering=-year', {}),
+        ('tracks_search', collection_url + 'tracks/?search=%s' % search_term, {}),
+        ('tracks_fields', collection_url + 'tracks/?fields=id,name,length&expand=', {}),
+        ('tracks_export_ndjson', collection_url + 'tracks/?format=ndjson&fields=id,name,album&expand=', {}),
+        ('albums', collection_url + 'albums/', {}),
+        ('artists', collection_url + 'artists/?ordering=name', {}),
+        ('genres', collection_url + 'genres/', {}),
+        ('search', collection_url + 'search/?q=%s' % search_term, {}),
+        ('track', '/api/track/%d/' % track.id, {}),
+        ('album', '/api/album/%d/' % album.id, {}),
+        ('album_tracks', '/api/album/%d/tracks/' % album.id, {}),
+        ('artist_tracks', '/api/artist/%d/tracks/' % artist.id, {}),
+        ('genre_tracks', '/api/genre/%d/tracks/' % genre.id, {}),
+        ('stream', stream_url, {}),
+        ('stream_range', stream_url, {'HTTP_RANGE': 'bytes=0-65535'}),
+        ('stream_multirange', stream_url, {'HTTP_RANGE': 'bytes=0-99,1000-1999,4000-'}),
+    ]
+
+
+def timed_get(client, url, headers):
+    timer = metrics.QueryTimer()
+    start = time.perf_counter()
+    with metrics.timed_queries(timer):
+        response = client.get(url, **headers)
+        size = sum(len(chunk) for chunk in response.streaming_content) if response.streaming \
+            else len(response.content)
+        response.close()
+    return time.perf_counter() - start, response, size, timer.count
+
+
+def bench_requests(user, cases, repeat):
+    client = APIClient()
+    client.force_authenticate(user=user)
+
+    results = {}
+    for name, url, headers in cases:
+        samples = []
+        for _ in range(repeat + 1):
+            duration, response, size, queries = timed_get(client, url, headers)
+            samples.append(duration)
+        # the first run warms caches and is left out
+        result = summarize(samples[1:])
+        result.update({'status': response.status_code, 'bytes': size, 'queries': queries})
+
+        etag = response.get('ETag')
+        if etag and not response.streaming:
+            duration, response, size, queries = timed_get(client, url, dict(headers, HTTP_IF_NONE_MATCH=etag))
+            result['not_modified'] = {'status': response.status_code, 'ms': round(duration * 1000, 3),
+                                      'queries': queries}
+        results[name] = result
+    return results
+
+
+# ~~~ Concurrency ~~~
+# threads requesting a list over and over, first alone and then while another process imports batches of tracks,
+# as an ingest running in a second worker would. A writer thread would mostly measure the GIL instead
+
+def read_loop(user, url, stop, samples, errors):
+    client = APIClient()
+    client.force_authenticate(user=user)
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                response = client.get(url)
+            except DatabaseError as e:
+                errors.append(str(e))
+                continue
+            if response.status_code != 200:
+                errors.append(response.status_code)
+                continue
+            samples.append(time.perf_counter() - start)
+    finally:
+        connections.close_all()
+
+
+def write_loop(collection_id, library, files, stop, results):
+    collection = Collection.objects.get(id=collection_id)
+    names = importer.LibraryNames(collection)
+    written = []
+    errors = []
+    number = 0
+    while not stop.is_set():
+        tracks = [library[i % len(library)] for i in range(number, number + importer.BATCH_SIZE)]
+        start = time.perf_counter()
+        try:
+            importer.write_tracks(collection, names, list(track_records(collection, tracks, files, number)))
+        except DatabaseError as e:
+            errors.append(str(e))
+            continue
+        written.append(time.perf_counter() - start)
+        number += len(tracks)
+    results.put((written, errors))
+
+
+def concurrent_reads(user, url, readers, seconds, write=None):
+    context = multiprocessing.get_context('fork')
+    stop = context.Event()
+    results = context.Queue()
+    writer = None
+    if write is not None:
+        # the forked process must not share the connections of this one
+        connections.close_all()
+        writer = context.Process(target=write_loop, args=write + (stop, results))
+        writer.start()
+
+    samples = []
+    errors = []
+    threads = [threading.Thread(target=read_loop, args=(user, url, stop, samples, errors)) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    result = summarize(samples) if samples else {'runs': 0}
+    result.update({'requests_per_second': round(len(samples) / seconds, 1), 'errors': len(errors)})
+    if errors:
+        result['first_error'] = str(errors[0])
+
+    if writer is not None:
+        written, write_errors = results.get()
+        writer.join()
+        write = summarize(written) if written else {'runs': 0}
+        write.update({'tracks': len(written) * importer.BATCH_SIZE, 'errors': len(write_errors)})
+        if write_errors:
+            write['first_error'] = write_errors[0]
+        result['write_batches'] = write
+    return result
+
+
+def bench_concurrency(user, collection, write_collection, library, files, readers, seconds):
+    url = '/api/collection/%d/tracks/?limit=50' % collection.id
+    return {
+        'readers': readers,
+        'seconds': seconds,
+        'idle': concurrent_reads(user, url, readers, seconds),
+        'writing': concurrent_reads(user, url, readers, seconds, (write_collection.id, library, files)),
+    }
+
+
+# ~~~ Run ~~~
+
+def run(tracks=5000, files=40, repeat=10, seed=1, formats=synthetic.FORMATS, readers=4, seconds=5, keep=False,
+        log=None):
+    log = log or (lambda message: None)
+    directory = tempfile.mkdtemp(prefix='acris-benchmark-')
+    user = AcrisUser.objects.create(username='benchmark-%d' % int(time.time() * 1000))
+    collection = create_collection(user, 'benchmark')
+    import_collection = create_collection(user, 'benchmark import')
+    write_collection = create_collection(user, 'benchmark writes')
+    try:
+        library = synthetic.library(seed, tracks + files)
+        log('writing %d files' % files)
+        written = synthetic.write_files(directory, library[:files], formats)
+
+        log('reading tags')
+        tag_reads = bench_tags(written, repeat)
+
+        log('ingesting')
+        ingest = bench_ingest(collection, written)
+        bulk_import = bench_import(import_collection, written)
+
+        log('writing %d tracks to the database' % tracks)
+        start = time.perf_counter()
+        fill_database(collection, library[files:], written)
+        fill_seconds = time.perf_counter() - start
+
+        log('timing requests')
+        track = Track.objects.filter(collection=collection).exclude(audio_format='').order_by('id').first()
+        search_term = library[0]['name'].split()[0].lower()
+        requests = bench_requests(user, request_cases(collection, track, search_term), repeat)
+
+        concurrency = None
+        if readers:
+            log('reading with %d threads while writing' % readers)
+            concurrency = bench_concurrency(user, collection, write_collection, library[files:] or library, written,
+                                            readers, seconds)
+
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'date': make_aware(datetime.now()).isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'read_database': 'read' in settings.DATABASES,
+                'debug': settings.DEBUG,
+                'tracks': tracks,
+                'files': files,
+                'formats': list(formats),
+                'repeat': repeat,
+                'seed': seed,
+            },
+            'tags': tag_reads,
+            'ingest': ingest,
+            'import': bulk_import,
+            'fill': {'tracks': tracks, 'seconds': round(fill_seconds, 3)},
+            'requests': requests,
+            'concurrency': concurrency,
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        if not keep:
+            log('cleaning up')
+            for benchmark_collection in (collection, import_collection, write_collection):
+                deletion.delete_collection(benchmark_collection)
+            user.delete()
+
+
+# median changes of the requests of two runs, [(name, before ms, after ms, change)]
+def compare(before, after):
+    changes = []
+    for name, result in after['requests'].items():
+        previous = before.get('requests', {}).get(name)
+        if previous is None:
+            continue
+        change = result['median_ms'] / previous['median_ms'] - 1 if previous['median_ms'] else 0
+        changes.append((name, previous['median_ms'], result['median_ms'], change))
+    return changes
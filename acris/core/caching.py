@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import signals
+from django.dispatch import receiver
+from django.http import HttpResponse
+from rest_framework import status
+from rest_framework.response import Response
+
+import acris.core.metrics as metrics
+from acris.core.conditional import ConditionalGetMixin
+from acris.core.models import Collection
+from acris.core.signals import collection_changed
+
+# Rendered responses of routes under a collection are kept in the ACRIS_RESPONSE_CACHE cache, keyed by the
+# collection's version and the request's path, query and format. Every change to a collection bumps its version
+# (see models.py), so an entry is never served after the data behind it changed: the next request looks up a key
+# that does not exist yet. collection_changed drops the entries of older versions this process stored, the ones of
+# other processes age out of the cache.
+
+# keys stored per collection and remembered for dropping, past this many the rest only age out
+TRACKED_KEYS = 1000
+
+_stored = defaultdict(set)
+_stored_lock = threading.Lock()
+
+
+def get_cache():
+    if settings.ACRIS_RESPONSE_CACHE is None:
+        return None
+    return caches[settings.ACRIS_RESPONSE_CACHE]
+
+
+def response_key(request, collection_id, version):
+    query = sorted((key, request.GET.getlist(key)) for key in request.GET)
+    digest = hashlib.sha1(repr((request.get_host(), request.path, query, request.accepted_renderer.format))
+                          .encode()).hexdigest()
+    return 'acris:response:%d:%d:%s' % (collection_id, version, digest)
+
+
+def remember(collection_id, key):
+    with _stored_lock:
+        keys = _stored[collection_id]
+        if len(keys) < TRACKED_KEYS:
+            keys.add(key)
+
+
+def drop(collection_id):
+    with _stored_lock:
+        keys = _stored.pop(collection_id, None)
+    cache = get_cache()
+    if keys and cache is not None:
+        cache.delete_many(list(keys))
+
+
+class CachedResponse(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+# Serves GET responses of a ConditionalGetMixin route from the cache. The lookup happens after the permission checks
+# and the conditional GET, a hit skips the view's queries, serializers and renderer altogether.
+class CachedResponseMixin(ConditionalGetMixin):
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        self.response_key = None
+        cache = get_cache()
+        if self.validators is None or cache is None:
+            return
+        collection_id, version, date_modified = self.get_collection_row()
+        key = response_key(request, collection_id, version)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.RESPONSE_CACHE.inc(result='hit')
+            content, headers = cached
+            response = HttpResponse(content)
+            for header, value in headers:
+                response[header] = value
+            raise CachedResponse(response)
+        metrics.RESPONSE_CACHE.inc(result='miss')
+        self.response_key = key
+
+    def handle_exception(self, exc):
+        if isinstance(exc, CachedResponse):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        key = getattr(self, 'response_key', None)
+        # exports are streamed and never cached
+        if key is not None and isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            response.render()
+            if len(response.content) <= settings.ACRIS_RESPONSE_CACHE_MAX_SIZE:
+                get_cache().set(key, (response.content, list(response.items())))
+                remember(self.get_collection_row()[0], key)
+        return response
+
+
+# ~~~ Invalidation ~~~
+
+@receiver(collection_changed)
+def drop_responses_on_change(sender, collection_id, **kwargs):
+    drop(collection_id)
+
+
+@receiver(signals.post_delete, sender=Collection)
+def drop_responses_on_delete(sender, instance, **kwargs):
+    drop(instance.pk)
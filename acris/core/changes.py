@@ -0,0 +1,104 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Exists, Max, OuterRef
+from django.utils.timezone import make_aware
+
+from acris.core.models import Collection, Change
+from acris.core.rows import TrackRowSerializer, AlbumRowSerializer, ArtistRowSerializer, GenreRowSerializer, \
+    PlaylistRowSerializer
+
+# Clients keep the seq of their last sync and ask for the changes after it. Changes of an object supersede its
+# older ones, so only the latest change per object is sent (and kept after compaction). Created and updated objects
+# come with their current row, relations as ids, deleted objects only with their id.
+
+ROW_SERIALIZERS = {
+    'track': TrackRowSerializer,
+    'album': AlbumRowSerializer,
+    'artist': ArtistRowSerializer,
+    'genre': GenreRowSerializer,
+    'playlist': PlaylistRowSerializer,
+}
+
+
+# the changes after since, at most limit of them unless a single seq has more, seqs are never split across pages
+def load_changes(collection_id, since, limit):
+    changes = list(Change.objects.filter(collection_id=collection_id, seq__gt=since).order_by('seq', 'id')
+                   .values_list('seq', 'kind', 'object_id', 'action')[:limit + 1])
+    more = len(changes) > limit
+    if more:
+        next_seq = changes[limit][0]
+        changes = [change for change in changes[:limit] if change[0] != next_seq]
+        if not changes:
+            changes = list(Change.objects.filter(collection_id=collection_id, seq=next_seq).order_by('id')
+                           .values_list('seq', 'kind', 'object_id', 'action'))
+    return changes, more
+
+
+def latest_per_object(changes):
+    latest = {}
+    for change in changes:
+        latest.pop((change[1], change[2]), None)
+        latest[(change[1], change[2])] = change
+    return list(latest.values())
+
+
+# kind -> id -> row of the objects still alive
+def load_rows(request, collection_id, changes):
+    ids = defaultdict(set)
+    for seq, kind, object_id, action in changes:
+        if action != Change.DELETE:
+            ids[kind].add(object_id)
+
+    rows = {}
+    for kind, object_ids in ids.items():
+        serializer = ROW_SERIALIZERS[kind](request, expand=())
+        values = list(serializer.model.objects.filter(id__in=object_ids, collection_id=collection_id)
+                      .values(*serializer.columns()))
+        rows[kind] = {row['id']: item for row, item in zip(values, serializer.render(values))}
+    return rows
+
+
+# the response of api/collection/<id>/changes for a client at since, version is the collection's current version
+def sync(request, collection_id, version, horizon, since, limit):
+    if since < horizon or since > version:
+        return {'seq': version, 'reset': True, 'more': False, 'changes': []}
+
+    changes, more = load_changes(collection_id, since, limit)
+    last_seq = changes[-1][0] if changes else since
+    changes = latest_per_object(changes)
+    rows = load_rows(request, collection_id, changes)
+
+    output = []
+    for seq, kind, object_id, action in changes:
+        change = {'seq': seq, 'kind': kind, 'id': object_id, 'action': action}
+        if action != Change.DELETE:
+            change['data'] = rows[kind].get(object_id)
+            if change['data'] is None:
+                # deleted after this change, its delete comes in a later seq
+                continue
+        output.append(change)
+
+    return {
+        'seq': last_seq if more else max(last_seq, version),
+        'reset': False,
+        'more': more,
+        'changes': output,
+    }
+
+
+# drop changes superseded by a later change of the same object, and deletes older than retention
+def compact(collection, retention):
+    newer = Change.objects.filter(collection=collection, kind=OuterRef('kind'), object_id=OuterRef('object_id'),
+                                  id__gt=OuterRef('id'))
+    expired = Change.objects.filter(collection=collection, action=Change.DELETE,
+                                    date__lt=make_aware(datetime.now()) - timedelta(days=retention))
+
+    with transaction.atomic():
+        superseded = Change.objects.filter(collection=collection).filter(Exists(newer)).delete()[0]
+        horizon = expired.aggregate(horizon=Max('seq'))['horizon']
+        removed = expired.delete()[0]
+        if horizon is not None:
+            Collection.objects.filter(id=collection.id, changes_horizon__lt=horizon).update(changes_horizon=horizon)
+    return superseded, removed
@@ -0,0 +1,72 @@
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from acris.core.permissions import CollectionScopedMixin
+
+
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+
+def etag_matches(etag, if_none_match):
+    for tag in parse_etags(if_none_match):
+        if tag == '*' or tag == etag or tag == 'W/' + etag:
+            return True
+    return False
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        return etag_matches(etag, if_none_match)
+
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since)
+        return since is not None and int(last_modified.timestamp()) <= since
+    return False
+
+
+# Conditional GET for routes whose response only depends on the contents of one collection.
+#
+# Collection.version is bumped on every change inside the collection (see models.py), so it is a strong validator
+# for everything under it. The version comes with the collection lookup of the permission checks, a matching
+# If-None-Match or If-Modified-Since is answered with 304 before the view runs any of its own queries or serializers.
+class ConditionalGetMixin(CollectionScopedMixin):
+    # (etag, last modified) of the current response, None to answer unconditionally
+    def get_validators(self):
+        version = self.get_collection_row()
+        if version is None:
+            return None
+        collection_id, number, date_modified = version
+        return '"%d.%d.%s"' % (collection_id, number, self.request.accepted_renderer.format), date_modified
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        self.validators = None
+        if request.method in ('GET', 'HEAD'):
+            self.validators = self.get_validators()
+            if self.validators is not None and not_modified(request, *self.validators):
+                raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        validators = getattr(self, 'validators', None)
+        if validators is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            etag, last_modified = validators
+            # compressed bodies are not byte for byte the same representation
+            response['ETag'] = 'W/' + etag if response.has_header('Content-Encoding') else etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified.timestamp())
+            # clients may keep responses but have to revalidate them on every use
+            response['Cache-Control'] = 'private, no-cache'
+        return response
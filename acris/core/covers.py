@@ -0,0 +1,163 @@
+import hashlib
+import os
+from collections import Counter, defaultdict
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F, signals
+from django.dispatch import receiver
+
+import acris.core.tags as tags
+from acris.core.models import Album, CoverArt, Track, queue_file_deletions
+from acris.core.signals import bulk_deleting, tracks_rewriting
+
+# Embedded cover art is stored once per distinct source image, keyed by the sha256 of the embedded bytes.
+# Track and album thumbnail_src fields point at the shared file and CoverArt.ref_count counts those references,
+# the file is removed when the last reference goes away.
+
+COVER_DIR = 'covers/'
+
+
+def cover_digest(image_data):
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def cover_name(digest):
+    return '{0}{1}/{2}.jpg'.format(COVER_DIR, digest[:2], digest)
+
+
+def name_digest(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def is_cover(name):
+    return bool(name) and name.startswith(COVER_DIR)
+
+
+def write_cover(digest, encoded):
+    name = cover_name(digest)
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(encoded))
+    return name
+
+
+# add references to covers that are already stored, returns the digests that were found. A cover counts as found
+# only when the update matched its row, one released and deleted since the select is stored again by the caller
+def add_references(counts):
+    found = set()
+    for digest in CoverArt.objects.filter(digest__in=list(counts)).values_list('digest', flat=True):
+        if CoverArt.objects.filter(digest=digest).update(ref_count=F('ref_count') + counts[digest]):
+            found.add(digest)
+    return found
+
+
+def create_cover(digest, encoded, count):
+    while True:
+        write_cover(digest, encoded)
+        try:
+            with transaction.atomic():
+                CoverArt.objects.create(digest=digest, ref_count=count)
+            return
+        except IntegrityError:
+            # stored concurrently by another ingest, unless that one was released again in between
+            if CoverArt.objects.filter(digest=digest).update(ref_count=F('ref_count') + count):
+                return
+
+
+# store one embedded image and take a reference to it, the image is only decoded if it is new
+def store(image_data):
+    digest = cover_digest(image_data)
+    if not add_references({digest: 1}):
+        create_cover(digest, tags.encode_thumbnail(image_data), 1)
+    return cover_name(digest)
+
+
+# store the covers of a batch of tracks, counts maps digest -> references, pictures digest -> embedded bytes
+# encode is called with the list of new images and returns their encoded data in the same order
+def store_many(counts, pictures, encode=None):
+    stored = add_references(counts)
+    new = [digest for digest in counts if digest not in stored]
+    if new:
+        encode = encode or (lambda images: [tags.encode_thumbnail(image) for image in images])
+        for digest, encoded in zip(new, encode([pictures[digest] for digest in new])):
+            if encoded is not None:
+                create_cover(digest, encoded, counts[digest])
+                stored.add(digest)
+    return {digest: cover_name(digest) for digest in stored}
+
+
+def acquire(name, count=1):
+    if is_cover(name):
+        CoverArt.objects.filter(digest=name_digest(name)).update(ref_count=F('ref_count') + count)
+
+
+def release(name):
+    release_many([name])
+
+
+# drop one reference per name, covers left without references and thumbnails stored before the cover store (which
+# belong to a single row) are queued for removal
+def release_many(names):
+    counts = Counter(name for name in names if name)
+    queue_file_deletions([name for name in counts if not is_cover(name)])
+
+    digests = Counter()
+    for name, count in counts.items():
+        if is_cover(name):
+            digests[name_digest(name)] += count
+    if not digests:
+        return
+
+    # one update per distinct count rather than per cover
+    by_count = defaultdict(list)
+    for digest, count in digests.items():
+        by_count[count].append(digest)
+    with transaction.atomic():
+        for count, batch in by_count.items():
+            CoverArt.objects.filter(digest__in=batch).update(ref_count=F('ref_count') - count)
+        unused = list(CoverArt.objects.filter(digest__in=list(digests), ref_count__lte=0)
+                      .values_list('digest', flat=True))
+        if unused:
+            CoverArt.objects.filter(digest__in=unused).delete()
+            queue_file_deletions([cover_name(digest) for digest in unused])
+
+
+# give albums without art the cover of their tracks, album_covers maps album id -> cover name
+def share_with_albums(album_covers):
+    shared = Counter()
+    for album_id, name in album_covers.items():
+        if Album.objects.filter(id=album_id, thumbnail_src='').update(thumbnail_src=name):
+            shared[name] += 1
+    for name, count in shared.items():
+        acquire(name, count)
+
+
+# ~~~ Reference counting ~~~
+
+@receiver(signals.post_delete, sender=Track)
+@receiver(signals.post_delete, sender=Album)
+def release_cover_on_delete(sender, instance, **kwargs):
+    release(instance.thumbnail_src.name)
+
+
+@receiver(bulk_deleting, sender=Track)
+@receiver(bulk_deleting, sender=Album)
+def release_covers_on_bulk_delete(sender, ids, **kwargs):
+    release_many(sender.objects.filter(id__in=ids).values_list('thumbnail_src', flat=True))
+
+
+# the new covers of rewritten tracks were already referenced by the importer
+@receiver(tracks_rewriting)
+def release_covers_on_rewrite(sender, track_ids, **kwargs):
+    release_many(Track.objects.filter(id__in=track_ids).values_list('thumbnail_src', flat=True))
+
+
+@receiver(signals.pre_save, sender=Track)
+@receiver(signals.pre_save, sender=Album)
+def release_cover_on_change(sender, instance, raw=False, **kwargs):
+    if not instance.pk or raw:
+        return
+    old_name = sender.objects.filter(pk=instance.pk).values_list('thumbnail_src', flat=True).first()
+    if old_name and old_name != instance.thumbnail_src.name:
+        release(old_name)
@@ -0,0 +1,171 @@
+from django.db import router, transaction
+from django.db.models import signals
+from django.dispatch import receiver
+
+from acris.core.models import Album, Artist, Change, Genre, IngestJob, LibraryFile, Playlist, PlaylistEntry, \
+    Track, deleting, is_deleting, queue_file_deletions, record_changes
+from acris.core.signals import bulk_deleting
+
+# Tracks, albums and collections are deleted here in batches of set based queries, instead of through delete() which
+# loads every row and runs the delete receivers once per track. Every batch is one transaction:
+#
+#   - bulk_deleting is sent first, acris.core.stats, covers and search update aggregates, cover references and the
+#     index for the whole batch
+#   - relations and rows are removed with one query per table and the deletes are logged as changes
+#   - the audio files are queued for acris.core.reaper, which removes them once the transaction has committed
+#
+# Albums, artists and genres the deleted tracks leave behind are removed afterwards the same way. A delete that stops
+# half way leaves whole batches removed and the rest untouched, running it again finishes it.
+
+BATCH_SIZE = 500
+
+# what an entity still needs to not be an orphan: a track, and for artists an album
+ORPHAN_FILTERS = {
+    Album: {'track': None},
+    Artist: {'track': None, 'album': None},
+    Genre: {'track': None},
+}
+
+# link tables rows of an entity are removed from, (through model, column)
+ENTITY_LINKS = {
+    Album: [(Album.artists.through, 'album_id')],
+    Artist: [(Album.artists.through, 'artist_id'), (Track.artists.through, 'artist_id')],
+    Genre: [(Track.genres.through, 'genre_id')],
+    Playlist: [(Track.playlists.through, 'playlist_id')],
+}
+
+
+def chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield ids[i:i + BATCH_SIZE]
+
+
+# one DELETE, without the collector and the per row signals, callers do what the receivers would have done
+def raw_delete(queryset):
+    return queryset._raw_delete(router.db_for_write(queryset.model))
+
+
+# remove one batch of tracks of a collection, returns the album, artist and genre ids they were linked to
+def delete_track_batch(collection, ids):
+    tracks = Track.objects.filter(id__in=ids)
+    album_ids = set(tracks.exclude(album=None).values_list('album_id', flat=True))
+    artist_ids = set(Track.artists.through.objects.filter(track_id__in=ids).values_list('artist_id', flat=True))
+    genre_ids = set(Track.genres.through.objects.filter(track_id__in=ids).values_list('genre_id', flat=True))
+    audio_names = list(tracks.values_list('audio_src', flat=True))
+    playlist_ids = set(Track.playlists.through.objects.filter(track_id__in=ids).values_list('playlist_id', flat=True))
+
+    bulk_deleting.send(sender=Track, collection=collection, ids=ids)
+    for through in (Track.artists.through, Track.genres.through, Track.playlists.through):
+        raw_delete(through.objects.filter(track_id__in=ids))
+    IngestJob.objects.filter(track_id__in=ids).update(track=None)
+    raw_delete(LibraryFile.objects.filter(track_id__in=ids))
+    raw_delete(tracks)
+
+    record_changes(collection.id, [('track', track_id, Change.DELETE) for track_id in ids] +
+                   [('playlist', playlist_id, Change.UPDATE) for playlist_id in sorted(playlist_ids)])
+    queue_file_deletions(audio_names)
+    return album_ids, artist_ids, genre_ids
+
+
+def delete_entity_batch(model, collection, ids):
+    bulk_deleting.send(sender=model, collection=collection, ids=ids)
+    entities = model.objects.filter(id__in=ids)
+    # album art is shared cover art, released by acris.core.covers
+    if model is not Album:
+        queue_file_deletions(entities.values_list('thumbnail_src', flat=True))
+    for through, column in ENTITY_LINKS[model]:
+        raw_delete(through.objects.filter(**{column + '__in': ids}))
+    raw_delete(entities)
+    record_changes(collection.id, [(model._meta.model_name, entity_id, Change.DELETE) for entity_id in ids])
+
+
+# remove the albums, artists and genres among the candidates that nothing refers to anymore, returns how many
+def collect_orphans(collection, album_ids=(), artist_ids=(), genre_ids=()):
+    removed = 0
+    # albums first, their artist links keep artists alive
+    for model, candidates in ((Album, album_ids), (Artist, artist_ids), (Genre, genre_ids)):
+        for batch in chunks(candidates):
+            with transaction.atomic():
+                ids = list(model.objects.filter(id__in=batch, **ORPHAN_FILTERS[model]).values_list('id', flat=True))
+                if ids:
+                    delete_entity_batch(model, collection, ids)
+                    removed += len(ids)
+    return removed
+
+
+# delete tracks of a collection and whatever they leave orphaned, returns the number of tracks deleted
+def delete_tracks(collection, track_ids):
+    album_ids, artist_ids, genre_ids = set(), set(), set()
+    count = 0
+    for batch in chunks(track_ids):
+        with transaction.atomic():
+            ids = list(Track.objects.filter(collection=collection, id__in=batch).values_list('id', flat=True))
+            if not ids:
+                continue
+            albums, artists, genres = delete_track_batch(collection, ids)
+            album_ids |= albums
+            artist_ids |= artists
+            genre_ids |= genres
+            count += len(ids)
+
+    collect_orphans(collection, album_ids, artist_ids, genre_ids)
+    return count
+
+
+def delete_album(album):
+    collection = album.collection
+    artist_ids = set(album.artists.values_list('id', flat=True))
+    delete_tracks(collection, album.track_set.values_list('id', flat=True))
+    # an album without tracks is not an orphan candidate of delete_tracks
+    with transaction.atomic():
+        if Album.objects.filter(id=album.id).exists():
+            delete_entity_batch(Album, collection, [album.id])
+    collect_orphans(collection, artist_ids=artist_ids)
+
+
+def delete_playlist(playlist):
+    with transaction.atomic():
+        # the tracks of the playlist lose it from their playlists
+        track_ids = set(PlaylistEntry.objects.filter(playlist=playlist).values_list('track_id', flat=True))
+        delete_entity_batch(Playlist, playlist.collection, [playlist.id])
+        record_changes(playlist.collection_id, [('track', track_id, Change.UPDATE) for track_id in sorted(track_ids)])
+
+
+def delete_collection(collection):
+    # as with Collection.delete(), nothing is logged for a collection that is going away
+    deleting.ids = getattr(deleting, 'ids', set()) | {collection.pk}
+    try:
+        for batch in chunks(Track.objects.filter(collection=collection).values_list('id', flat=True)):
+            with transaction.atomic():
+                delete_track_batch(collection, batch)
+        for model in (Playlist, Album, Artist, Genre):
+            for batch in chunks(model.objects.filter(collection=collection).values_list('id', flat=True)):
+                with transaction.atomic():
+                    delete_entity_batch(model, collection, batch)
+        # what is left (change log, jobs, uploads) cascades in a few queries
+        collection.delete()
+    finally:
+        deleting.ids = getattr(deleting, 'ids', set()) - {collection.pk}
+
+
+# ~~~ Single deletes ~~~
+# delete() on a track, in the admin for instance, removes the artists and genres it leaves without tracks. Albums are
+# left alone here, an album being deleted cascades to its tracks before its own row goes
+
+@receiver(signals.pre_delete, sender=Track)
+def remember_relations_on_delete(sender, instance, **kwargs):
+    instance.orphan_candidates = (
+        set(Track.artists.through.objects.filter(track_id=instance.pk).values_list('artist_id', flat=True)),
+        set(Track.genres.through.objects.filter(track_id=instance.pk).values_list('genre_id', flat=True)),
+    )
+
+
+@receiver(signals.post_delete, sender=Track)
+def collect_orphans_on_delete(sender, instance, **kwargs):
+    candidates = getattr(instance, 'orphan_candidates', None)
+    if candidates is None or is_deleting(instance.collection_id):
+        return
+    artist_ids, genre_ids = candidates
+    if artist_ids or genre_ids:
+        collect_orphans(instance.collection, artist_ids=artist_ids, genre_ids=genre_ids)
@@ -0,0 +1,59 @@
+import hashlib
+from datetime import datetime
+
+from django.utils.timezone import make_aware
+
+import acris.core.covers as covers
+from acris.core.models import Track
+
+# What an upload does when its audio is already in the collection:
+#   skip     nothing is stored, the existing track is returned
+#   link     a new track sharing the existing file and copying its metadata, nothing is parsed or stored
+#   replace  the existing track takes the uploaded file name and is read again from its file
+SKIP = 'skip'
+LINK = 'link'
+REPLACE = 'replace'
+MODES = (SKIP, LINK, REPLACE)
+
+
+# the sha256 of an uploaded file, computed by the upload handlers when they are installed
+def upload_hash(file):
+    content_hash = getattr(file, 'content_hash', None)
+    if content_hash is None:
+        hasher = hashlib.sha256()
+        for chunk in file.chunks():
+            hasher.update(chunk)
+        file.seek(0)
+        content_hash = hasher.hexdigest()
+    return content_hash
+
+
+def find_duplicate(collection, content_hash):
+    if not content_hash:
+        return None
+    return Track.objects.filter(collection=collection, content_hash=content_hash).order_by('id').first()
+
+
+def link_track(existing, file_name):
+    artist_ids = list(existing.artists.values_list('id', flat=True))
+    genre_ids = list(existing.genres.values_list('id', flat=True))
+
+    track = Track.objects.get(pk=existing.pk)
+    track.pk = None
+    track.id = None
+    track.date_uploaded = make_aware(datetime.now())
+    track.file_name = file_name
+    track.save()
+    if track.thumbnail_src:
+        covers.acquire(track.thumbnail_src.name)
+
+    track.artists.set(artist_ids)
+    track.genres.set(genre_ids)
+    return track
+
+
+# the uploaded bytes are the ones already stored, so only the name changes before the track is read again
+def replace_track(existing, file_name):
+    existing.file_name = file_name
+    existing.save(update_fields=['file_name'])
+    return existing
@@ -0,0 +1,350 @@
+import hashlib
+import multiprocessing
+import os
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils.timezone import make_aware
+
+import acris.core.covers as covers
+import acris.core.deletion as deletion
+import acris.core.duplicates as duplicates
+import acris.core.metrics as metrics
+import acris.core.tags as tags
+from acris.core.models import Artist, Album, Genre, Track, Change, record_changes
+from acris.core.signals import tracks_imported, tracks_rewriting
+
+AUDIO_EXTENSIONS = ('.flac', '.mp3', '.ogg', '.oga', '.opus', '.m4a', '.mp4')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# number of tracks written per transaction
+BATCH_SIZE = 500
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# The pool is first used from ingest worker threads while other threads hold SQLite connections, forking such a
+# process can deadlock the child. Its processes are started from a fork server instead (spawn where there is none),
+# a fresh interpreter that only imports tags, which needs neither Django nor the database.
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            if context.get_start_method() == 'forkserver':
+                context.set_forkserver_preload(['acris.core.tags'])
+            _pool = ProcessPoolExecutor(max_workers=settings.ACRIS_IMPORT_PROCESSES, mp_context=context)
+    return _pool
+
+
+def is_audio_file(name):
+    return name.lower().endswith(AUDIO_EXTENSIONS)
+
+
+def is_archive(name):
+    return name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def audio_storage_name(collection, file_name, content_hash=''):
+    field = Track._meta.get_field('audio_src')
+    return field.generate_filename(Track(collection=collection, content_hash=content_hash), file_name)
+
+
+# save an uploaded audio file or every audio member of an uploaded archive, skipping audio the collection already
+# has. seen holds the hashes stored by this import so far, returns [storage name, content hash] pairs and the number
+# skipped
+def store_upload(collection, file, seen):
+    if is_archive(file.name):
+        return store_archive(collection, file, seen)
+    if is_audio_file(file.name):
+        content_hash = duplicates.upload_hash(file)
+        if content_hash in seen or duplicates.find_duplicate(collection, content_hash):
+            return [], 1
+        seen.add(content_hash)
+        return [[default_storage.save(audio_storage_name(collection, file.name, content_hash), file), content_hash]], 0
+    return [], 0
+
+
+# archive members are copied to a temporary file while hashing, so duplicates never reach the storage
+def store_member(collection, base_name, member, seen):
+    with tempfile.TemporaryFile() as temp:
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: member.read(1024 * 1024), b''):
+            hasher.update(chunk)
+            temp.write(chunk)
+        content_hash = hasher.hexdigest()
+        if content_hash in seen or duplicates.find_duplicate(collection, content_hash):
+            return None
+        seen.add(content_hash)
+        temp.seek(0)
+        return [default_storage.save(audio_storage_name(collection, base_name, content_hash), File(temp)), content_hash]
+
+
+def archive_members(file):
+    if file.name.lower().endswith('.zip'):
+        with zipfile.ZipFile(file) as archive:
+            for info in archive.infolist():
+                base_name = os.path.basename(info.filename)
+                if info.is_dir() or not is_audio_file(base_name):
+                    continue
+                with archive.open(info) as member:
+                    yield base_name, member
+    else:
+        with tarfile.open(fileobj=file, mode='r:*') as archive:
+            for info in archive:
+                base_name = os.path.basename(info.name)
+                if not info.isfile() or not is_audio_file(base_name):
+                    continue
+                yield base_name, archive.extractfile(info)
+
+
+def store_archive(collection, file, seen):
+    names = []
+    skipped = 0
+    for base_name, member in archive_members(file):
+        stored = store_member(collection, base_name, member, seen)
+        if stored is None:
+            skipped += 1
+        else:
+            names.append(stored)
+    return names, skipped
+
+
+# name -> id of the artists, albums or genres of a collection, looked up as names come up and created when missing
+class NameMap:
+    def __init__(self, model, collection):
+        self.model = model
+        self.collection = collection
+        self.ids = {}
+
+    def resolve(self, names):
+        unknown = list(dict.fromkeys(name for name in names if name not in self.ids))
+        for i in range(0, len(unknown), BATCH_SIZE):
+            self.ids.update(self.model.objects.filter(collection=self.collection, name__in=unknown[i:i + BATCH_SIZE])
+                            .values_list('name', 'id'))
+
+        missing = {name for name in names if name not in self.ids}
+        if missing:
+            self.model.objects.bulk_create([self.model(collection=self.collection, name=name) for name in missing])
+            created = dict(self.model.objects.filter(collection=self.collection, name__in=missing)
+                           .values_list('name', 'id'))
+            self.ids.update(created)
+            record_changes(self.collection.id, [(self.model._meta.model_name, entity_id, Change.CREATE)
+                                                for entity_id in created.values()])
+        return [self.ids[name] for name in names]
+
+
+class LibraryNames:
+    def __init__(self, collection):
+        self.artists = NameMap(Artist, collection)
+        self.albums = NameMap(Album, collection)
+        self.genres = NameMap(Genre, collection)
+
+    # look up every name of a batch of records at once
+    def preload(self, records):
+        self.artists.resolve([name for record in records for name in record['artists']])
+        self.albums.resolve([record['album'] for record in records if record['album']])
+        self.genres.resolve([name for record in records for name in record['genres']])
+
+
+# fan tag parsing for a list of paths out over the worker processes, files whose hash is known are not hashed again
+def parse_files(paths, content_hashes=None):
+    return get_pool().map(tags.parse_file, paths, content_hashes or [None] * len(paths), chunksize=16)
+
+
+def read_failed(file_name):
+    metrics.METADATA_ERRORS.inc(format=os.path.splitext(file_name)[1].lstrip('.').lower() or 'unknown')
+
+
+# set the fields read from tags, on a new track or one being read again
+def fill_track(track, names, record, thumbnail_name):
+    track.name = record['name'] or track.file_name
+    track.audio_format = record['format']
+    track.length = timedelta(seconds=record['length']) if record['length'] is not None else None
+    track.album_artist = record['album_artist'] or 'Unknown'
+    track.album_id = names.albums.resolve([record['album']])[0] if record['album'] else None
+    track.album_track_number = record['album_track_number']
+    track.lyrics = record['lyrics'] or ''
+    track.year = record['year']
+    track.thumbnail_src = thumbnail_name or ''
+    if record.get('content_hash'):
+        track.content_hash = record['content_hash']
+    return track
+
+
+def build_track(collection, names, audio_name, record, thumbnail_name, date_uploaded):
+    track = Track(date_uploaded=date_uploaded, collection=collection, file_name=os.path.basename(audio_name),
+                  audio_src=audio_name)
+    return fill_track(track, names, record, thumbnail_name)
+
+
+# artist and genre through rows for tracks, links is [(track id, record)]
+def link_rows(names, links):
+    artist_links = []
+    genre_links = []
+    for track_id, record in links:
+        for artist_id in names.artists.resolve(record['artists']):
+            artist_links.append(Track.artists.through(track_id=track_id, artist_id=artist_id))
+        for genre_id in names.genres.resolve(record['genres']):
+            genre_links.append(Track.genres.through(track_id=track_id, genre_id=genre_id))
+    Track.artists.through.objects.bulk_create(artist_links)
+    Track.genres.through.objects.bulk_create(genre_links)
+
+
+def encode_covers(images):
+    return list(get_pool().map(tags.try_encode_thumbnail, images))
+
+
+# each distinct cover of a batch is encoded and stored once, however many tracks embed it. Returns digest -> name
+def store_covers(records):
+    cover_counts = Counter()
+    pictures = {}
+    for record in records:
+        if record['picture_digest'] is not None:
+            cover_counts[record['picture_digest']] += 1
+            pictures.setdefault(record['picture_digest'], record['picture'])
+    return covers.store_many(cover_counts, pictures, encode_covers) if cover_counts else {}
+
+
+# write one batch of parsed files: tracks with bulk_create, then the artist and genre through tables
+def write_tracks(collection, names, batch):
+    date_uploaded = make_aware(datetime.now())
+    cover_names = store_covers([record for _, record in batch])
+    names.preload([record for _, record in batch])
+
+    tracks = []
+    for audio_name, record in batch:
+        thumbnail_name = cover_names.get(record['picture_digest'])
+        tracks.append(build_track(collection, names, audio_name, record, thumbnail_name, date_uploaded))
+
+    with transaction.atomic():
+        Track.objects.bulk_create(tracks)
+
+        # sqlite does not hand back primary keys from bulk inserts, storage names are unique so look them up
+        ids = dict(Track.objects.filter(collection=collection, audio_src__in=[name for name, _ in batch])
+                   .values_list('audio_src', 'id'))
+        link_rows(names, [(ids[audio_name], record) for audio_name, record in batch])
+
+    covers.share_with_albums({track.album_id: track.thumbnail_src.name for track in reversed(tracks)
+                              if track.album_id is not None and track.thumbnail_src})
+    tracks_imported.send(sender=Track, collection=collection, track_ids=list(ids.values()))
+    record_changes(collection.id, [('track', track_id, Change.CREATE) for track_id in ids.values()])
+    return ids
+
+
+TAG_FIELDS = ['name', 'audio_format', 'length', 'album_artist', 'album', 'album_track_number', 'lyrics', 'year',
+              'thumbnail_src', 'content_hash']
+
+
+# write the records read again for existing tracks of a collection, batch is [(track, record)]. Tracks are updated in
+# bulk and their links replaced. tracks_rewriting takes the old values out of the aggregates and releases the old
+# covers, tracks_imported adds the new ones, and albums, artists and genres left without tracks are removed
+def rewrite_tracks(collection, names, batch):
+    cover_names = store_covers([record for _, record in batch])
+    names.preload([record for _, record in batch])
+    ids = [track.id for track, _ in batch]
+
+    with transaction.atomic():
+        old_albums = set(Track.objects.filter(id__in=ids).exclude(album=None).values_list('album_id', flat=True))
+        old_artists = set(Track.artists.through.objects.filter(track_id__in=ids).values_list('artist_id', flat=True))
+        old_genres = set(Track.genres.through.objects.filter(track_id__in=ids).values_list('genre_id', flat=True))
+        tracks_rewriting.send(sender=Track, collection=collection, track_ids=ids)
+
+        tracks = [fill_track(track, names, record, cover_names.get(record['picture_digest']))
+                  for track, record in batch]
+        Track.objects.bulk_update(tracks, TAG_FIELDS)
+        Track.artists.through.objects.filter(track_id__in=ids).delete()
+        Track.genres.through.objects.filter(track_id__in=ids).delete()
+        link_rows(names, [(track.id, record) for track, record in batch])
+
+        covers.share_with_albums({track.album_id: track.thumbnail_src.name for track in reversed(tracks)
+                                  if track.album_id is not None and track.thumbnail_src})
+        tracks_imported.send(sender=Track, collection=collection, track_ids=ids)
+        record_changes(collection.id, [('track', track_id, Change.UPDATE) for track_id in ids])
+
+    deletion.collect_orphans(collection, old_albums, old_artists, old_genres)
+
+
+# parse and write every stored file, reporting progress through the job
+def run_import(job):
+    collection = job.collection
+    names = LibraryNames(collection)
+    # files are [storage name, content hash] pairs, or bare names for files stored without hashing them
+    stored = [entry if isinstance(entry, list) else [entry, None] for entry in job.files]
+    paths = [default_storage.path(name) for name, content_hash in stored]
+    storage_names = dict(zip(paths, (name for name, content_hash in stored)))
+
+    errors = []
+    batch = []
+
+    def flush():
+        if batch:
+            write_tracks(collection, names, batch)
+            job.processed += len(batch)
+            job.save(update_fields=['processed', 'failed'])
+            batch.clear()
+
+    for path, record, error in parse_files(paths, [content_hash for name, content_hash in stored]):
+        if error is not None:
+            job.failed += 1
+            job.processed += 1
+            errors.append('%s: %s' % (os.path.basename(path), error))
+            read_failed(path)
+            default_storage.delete(storage_names[path])
+            continue
+
+        batch.append((storage_names[path], record))
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    flush()
+
+    job.error = '\n'.join(errors)
+
+
+# read the tags of every track of the collection again, files that can no longer be read keep their track as it is
+def run_retag(job):
+    collection = job.collection
+    names = LibraryNames(collection)
+    # linked duplicates share their file, it is read once for all of them
+    tracks = {}
+    for track in Track.objects.filter(collection=collection).exclude(audio_src=''):
+        tracks.setdefault(default_storage.path(track.audio_src.name), []).append(track)
+    job.total = sum(len(shared) for shared in tracks.values())
+    job.save(update_fields=['total'])
+
+    errors = []
+    batch = []
+
+    def flush():
+        if batch:
+            rewrite_tracks(collection, names, batch)
+            job.processed += len(batch)
+            job.save(update_fields=['processed', 'failed'])
+            batch.clear()
+
+    paths = list(tracks)
+    for path, record, error in parse_files(paths, [tracks[path][0].content_hash or None for path in paths]):
+        if error is not None:
+            job.failed += len(tracks[path])
+            job.processed += len(tracks[path])
+            errors.append('%s: %s' % (tracks[path][0].file_name, error))
+            read_failed(path)
+            continue
+
+        batch.extend((track, record) for track in tracks[path])
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    flush()
+
+    job.error = '\n'.join(errors)
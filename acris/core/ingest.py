@@ -0,0 +1,120 @@
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.timezone import make_aware
+
+import acris.core.audio as audio
+import acris.core.importer as importer
+import acris.core.metrics as metrics
+from acris.core.models import IngestJob
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.ACRIS_INGEST_WORKERS,
+                                           thread_name_prefix='acris-ingest')
+
+            # pick up jobs left behind by a previous process, claiming in run_job stops double processing
+            recover_jobs()
+            for job_id in IngestJob.objects.filter(status=IngestJob.PENDING).values_list('id', flat=True):
+                _executor.submit(run_job, job_id)
+    return _executor
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+# whether the process that claimed a job may still be running it, processes of other hosts are assumed to be
+def worker_alive(worker):
+    host, _, pid = worker.rpartition(':')
+    if not host:
+        return False
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        return True
+    return True
+
+
+# Jobs left running by a process that is gone would stay running forever. Uploads and retags only rewrite tracks and
+# are queued again, an import may have written part of its files and is failed instead.
+def recover_jobs():
+    stale = [job_id for job_id, worker in IngestJob.objects.filter(status=IngestJob.RUNNING)
+             .values_list('id', 'worker') if not worker_alive(worker)]
+    if not stale:
+        return
+    IngestJob.objects.filter(id__in=stale, status=IngestJob.RUNNING, kind=IngestJob.IMPORT).update(
+        status=IngestJob.FAILED, error='Interrupted by a restart.', date_finished=make_aware(datetime.now()))
+    IngestJob.objects.filter(id__in=stale, status=IngestJob.RUNNING).update(status=IngestJob.PENDING, worker='')
+    logger.warning('recovered interrupted ingest jobs', extra={'jobs': stale})
+
+
+# queue a job once the transaction that created it has committed
+def submit(job: IngestJob):
+    transaction.on_commit(lambda: get_executor().submit(run_job, job.id))
+
+
+def record_job(job, duration):
+    # a failed upload job is its one file failing
+    failed = job.failed if job.kind in (IngestJob.IMPORT, IngestJob.RETAG) else int(job.status == IngestJob.FAILED)
+    metrics.INGEST_JOBS.inc(kind=job.kind, status=job.status)
+    metrics.INGEST_FILES.inc(job.total - failed, result='ok')
+    metrics.INGEST_FILES.inc(failed, result='failed')
+    metrics.INGEST_DURATION.observe(duration, kind=job.kind)
+    logger.info('ingest job finished', extra={'job': job.id, 'kind': job.kind, 'status': job.status,
+                                               'files': job.total, 'failed': failed, 'duplicates': job.duplicates,
+                                               'seconds': round(duration, 3)})
+
+
+def run_job(job_id):
+    close_old_connections()
+    try:
+        # only one worker may move a job out of pending
+        claimed = IngestJob.objects.filter(id=job_id, status=IngestJob.PENDING).update(status=IngestJob.RUNNING,
+                                                                                       worker=worker_name())
+        if not claimed:
+            return
+
+        job = IngestJob.objects.select_related('collection', 'track', 'track__collection').get(id=job_id)
+        start = time.perf_counter()
+        try:
+            if job.kind == IngestJob.IMPORT:
+                importer.run_import(job)
+                job.status = IngestJob.FAILED if job.failed == job.total else IngestJob.DONE
+            elif job.kind == IngestJob.RETAG:
+                importer.run_retag(job)
+                job.status = IngestJob.FAILED if job.total and job.failed == job.total else IngestJob.DONE
+            else:
+                audio.setup_track_from_file(job.track)
+                job.status = IngestJob.DONE
+        except Exception as e:
+            logger.exception('ingest job failed', extra={'job': job.id, 'kind': job.kind})
+            job.status = IngestJob.FAILED
+            job.error = str(e) or e.__class__.__name__
+
+        job.processed = job.total
+        job.date_finished = make_aware(datetime.now())
+        job.save(update_fields=['status', 'processed', 'failed', 'error', 'date_finished'])
+        record_job(job, time.perf_counter() - start)
+    finally:
+        # connections stay open for the next job unless CONN_MAX_AGE has passed or this one left them broken
+        close_old_connections()
@@ -0,0 +1,22 @@
+import json
+import logging
+
+# attributes every LogRecord has, anything else on a record was passed with extra= and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+# one json object per line: time, level, logger, message, the extra fields and the traceback if there is one
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.benchmark as benchmark
+import acris.core.synthetic as synthetic
+
+
+class Command(BaseCommand):
+    help = 'Time ingestion, list, detail and stream routes against a synthetic library and print the results as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=5000, help='tracks written straight to the database')
+        parser.add_argument('--files', type=int, default=40, help='tagged audio files generated and ingested')
+        parser.add_argument('--formats', default=','.join(synthetic.FORMATS),
+                            help='comma separated file formats out of %s' % ', '.join(synthetic.FORMATS))
+        parser.add_argument('--repeat', type=int, default=10, help='timed runs of every request')
+        parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic library')
+        parser.add_argument('--readers', type=int, default=4,
+                            help='threads reading while another one writes tracks, 0 to skip')
+        parser.add_argument('--seconds', type=float, default=5,
+                            help='length of the concurrent reads, alone and while writing')
+        parser.add_argument('--output', help='write the results to this file instead of stdout')
+        parser.add_argument('--compare', help='results of an earlier run to report request changes against')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='relative median slowdown reported as a regression')
+        parser.add_argument('--keep', action='store_true', help='keep the benchmark collections')
+
+    def handle(self, *args, **options):
+        formats = tuple(name.strip() for name in options['formats'].split(',') if name.strip())
+        unknown = [name for name in formats if name not in synthetic.FORMATS]
+        if unknown or not formats:
+            raise CommandError('unknown formats: %s' % ', '.join(unknown))
+        if options['files'] < 1 or options['repeat'] < 1 or options['tracks'] < 0 or options['readers'] < 0:
+            raise CommandError('--files and --repeat must be at least 1, --tracks and --readers at least 0')
+        if options['seconds'] <= 0:
+            raise CommandError('--seconds must be more than 0')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        results = benchmark.run(tracks=options['tracks'], files=options['files'], repeat=options['repeat'],
+                                seed=options['seed'], formats=formats, readers=options['readers'],
+                                seconds=options['seconds'], keep=options['keep'],
+                                log=lambda message: self.stderr.write(message))
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = 0
+            for name, before, after, change in benchmark.compare(baseline, results):
+                slower = change > options['threshold']
+                regressions += slower
+                self.stderr.write('%-24s %10.3f ms -> %10.3f ms  %+6.1f%%%s' % (name, before, after, change * 100,
+                                                                             '  REGRESSION' if slower else ''))
+            if regressions:
+                raise CommandError('%d requests are slower than --threshold' % regressions)
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.changes as changes
+from acris.core.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Drop superseded change log entries and deletes older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, nargs='?', help='only compact this collection')
+        parser.add_argument('--days', type=int, default=settings.ACRIS_CHANGE_RETENTION_DAYS,
+                            help='days deletes are kept for clients to sync them')
+
+    def handle(self, *args, **options):
+        collections = Collection.objects.all()
+        if options['collection'] is not None:
+            collections = collections.filter(id=options['collection'])
+            if not collections.exists():
+                raise CommandError('collection %s does not exist' % options['collection'])
+
+        for collection in collections:
+            superseded, expired = changes.compact(collection, options['days'])
+            self.stdout.write('%s: removed %d superseded and %d expired changes' % (collection.name, superseded,
+                                                                                    expired))
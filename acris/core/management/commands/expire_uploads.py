@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+import acris.core.resumable as resumable
+
+
+class Command(BaseCommand):
+    help = 'Remove resumable uploads that expired before they were completed'
+
+    def handle(self, *args, **options):
+        self.stdout.write('removed %d expired uploads' % resumable.expire())
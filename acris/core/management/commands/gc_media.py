@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+import acris.core.reaper as reaper
+
+
+class Command(BaseCommand):
+    help = 'Remove queued and unreferenced media files and report tracks whose audio file is missing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=60,
+                            help='minutes a file has to be unchanged before it is removed as unreferenced')
+        parser.add_argument('--dry-run', action='store_true', help='only count what would be removed')
+        parser.add_argument('--delete-missing', action='store_true',
+                            help='delete tracks whose audio file is missing')
+
+    def handle(self, *args, **options):
+        result = reaper.gc_media(min_age=options['min_age'] * 60, dry_run=options['dry_run'],
+                                 delete_missing=options['delete_missing'])
+        self.stdout.write(str(result))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.search as search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for every collection'
+
+    def handle(self, *args, **options):
+        if not search.enabled():
+            raise CommandError('the search index requires an sqlite database')
+        search.rebuild_index()
+        self.stdout.write('search index rebuilt')
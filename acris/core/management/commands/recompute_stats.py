@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.stats as stats
+from acris.core.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Rebuild track counts, lengths and format breakdowns of collections, albums, artists and genres'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, nargs='?', help='only rebuild this collection')
+
+    def handle(self, *args, **options):
+        collection = None
+        if options['collection'] is not None:
+            try:
+                collection = Collection.objects.get(id=options['collection'])
+            except Collection.DoesNotExist:
+                raise CommandError('collection %s does not exist' % options['collection'])
+
+        stats.recompute(collection)
+        self.stdout.write('statistics rebuilt')
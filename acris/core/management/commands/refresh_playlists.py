@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.playlists as playlists
+from acris.core.models import Collection, Playlist
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the entries of smart playlists from their rules, run periodically for rules on dates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, nargs='?', help='only rebuild the playlists of this collection')
+
+    def handle(self, *args, **options):
+        smart = Playlist.objects.exclude(rules='').order_by('id')
+        if options['collection'] is not None:
+            if not Collection.objects.filter(id=options['collection']).exists():
+                raise CommandError('collection %s does not exist' % options['collection'])
+            smart = smart.filter(collection_id=options['collection'])
+
+        for playlist in smart:
+            added, removed = playlists.sync_members(playlist)
+            self.stdout.write('playlist %d (%s): %d added, %d removed' % (playlist.id, playlist.name, added, removed))
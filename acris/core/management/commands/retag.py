@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import make_aware
+
+import acris.core.ingest as ingest
+from acris.core.models import Collection, IngestJob
+
+
+class Command(BaseCommand):
+    help = 'Read the tags of every track again and update titles, albums, artists, genres and covers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, nargs='?', help='only read this collection again')
+
+    def handle(self, *args, **options):
+        collections = Collection.objects.all()
+        if options['collection'] is not None:
+            collections = collections.filter(id=options['collection'])
+            if not collections.exists():
+                raise CommandError('collection %s does not exist' % options['collection'])
+
+        for collection in collections:
+            job = IngestJob.objects.create(date_created=make_aware(datetime.now()), collection=collection,
+                                           kind=IngestJob.RETAG, total=0)
+            ingest.run_job(job.id)
+            job.refresh_from_db()
+            if job.error:
+                self.stderr.write(job.error)
+            self.stdout.write('collection {0}: {1} tracks read, {2} failed'.format(
+                collection.id, job.total - job.failed, job.failed))
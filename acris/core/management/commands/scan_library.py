@@ -0,0 +1,38 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+import acris.core.scanner as scanner
+from acris.core.models import Collection
+
+
+class Command(BaseCommand):
+    help = 'Import the audio files below a directory into a collection, only reading new or changed files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, help='id of the collection to import into')
+        parser.add_argument('path', help='library directory on the local disk')
+        parser.add_argument('--watch', action='store_true', help='keep polling the directory for changes')
+        parser.add_argument('--interval', type=float, default=60, help='seconds between scans in watch mode')
+
+    def handle(self, *args, **options):
+        try:
+            collection = Collection.objects.get(id=options['collection'])
+        except Collection.DoesNotExist:
+            raise CommandError('collection %s does not exist' % options['collection'])
+
+        if not os.path.isdir(options['path']):
+            raise CommandError('%s is not a directory' % options['path'])
+
+        if options['watch']:
+            try:
+                scanner.watch_library(collection, options['path'], options['interval'], self.report)
+            except KeyboardInterrupt:
+                pass
+        else:
+            self.report(scanner.scan_library(collection, options['path']))
+
+    def report(self, result):
+        for error in result.errors:
+            self.stderr.write(error)
+        self.stdout.write(str(result))
@@ -0,0 +1,211 @@
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.db import connections
+
+# Counters, gauges and histograms kept in process and rendered in the Prometheus text format by api/metrics.
+# Every process has its own values, when running several workers scrape each of them (or run a single ASGI process).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REGISTRY = []
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for name, value in zip(names, values))
+    return '{%s}' % ','.join(pairs)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines += self.render_sample(key, value)
+        return lines
+
+    def render_sample(self, key, value):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, key), format_value(value))]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        if not self.labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    # values hold [count per bucket..., sum]
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            sample = self.values.get(key)
+            if sample is None:
+                sample = self.values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    sample[i] += 1
+                    break
+            sample[-1] += value
+
+    def render_sample(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            bucket_labels = format_labels(self.labels + ('le',), key + (format_value(bound),))
+            lines.append('%s_bucket%s %d' % (self.name, bucket_labels, cumulative))
+        labels = format_labels(self.labels, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(value[-1])))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_DURATION = Histogram('acris_request_duration_seconds', 'Time to produce a response, by route.',
+                             ['route', 'method', 'status'])
+DB_QUERIES = Counter('acris_db_queries_total', 'Database queries run, by route.', ['route'])
+DB_QUERY_TIME = Counter('acris_db_query_seconds_total', 'Time spent in database queries, by route.', ['route'])
+
+STREAMS = Counter('acris_streams_total', 'Audio streams started, by response status.', ['status'])
+STREAMS_ACTIVE = Gauge('acris_streams_active', 'Audio streams being sent.')
+STREAM_BYTES = Counter('acris_stream_bytes_total', 'Audio bytes sent to listeners.')
+
+INGEST_JOBS = Counter('acris_ingest_jobs_total', 'Finished ingest jobs, by kind and status.', ['kind', 'status'])
+INGEST_FILES = Counter('acris_ingest_files_total', 'Files read by ingest jobs, by result.', ['result'])
+INGEST_DURATION = Histogram('acris_ingest_job_duration_seconds', 'Time to run an ingest job.', ['kind'],
+                            buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+RESPONSE_CACHE = Counter('acris_response_cache_total', 'Cached response lookups, by result.', ['result'])
+
+METADATA_ERRORS = Counter('acris_metadata_errors_total', 'Tags or covers that could not be read, by format.',
+                          ['format'])
+
+
+# ~~~ Requests ~~~
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+
+
+# time the queries of every configured database, reads and writes may go through different connections
+@contextmanager
+def timed_queries(timer):
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(timer))
+        yield timer
+
+
+# the url pattern of a request, so every track shares the label of api/track/<int:track_id>/
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with timed_queries(timer):
+            response = self.get_response(request)
+        route = route_of(request)
+        REQUEST_DURATION.observe(time.perf_counter() - start, route=route, method=request.method,
+                                 status=response.status_code)
+        DB_QUERIES.inc(timer.count, route=route)
+        DB_QUERY_TIME.inc(timer.duration, route=route)
+        return response
+
+
+# ~~~ Streams ~~~
+# counts an audio stream as active until its response is closed. Bodies sent by sendfile never pass through python,
+# expected is counted for them instead when nothing was counted with sent
+class StreamAccount:
+    def __init__(self, status, expected=None):
+        self.expected = expected
+        self.sent_bytes = 0
+        self.finished = False
+        STREAMS.inc(status=status)
+        STREAMS_ACTIVE.inc()
+
+    def sent(self, size):
+        self.sent_bytes += size
+        STREAM_BYTES.inc(size)
+
+    def counted(self, chunks):
+        for chunk in chunks:
+            self.sent(len(chunk))
+            yield chunk
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        STREAMS_ACTIVE.dec()
+        if self.expected and not self.sent_bytes:
+            STREAM_BYTES.inc(self.expected)
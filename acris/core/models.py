@@ -1,22 +1,26 @@
 import os
-from datetime import timedelta
+import threading
+from datetime import datetime, timedelta
 
-from django.db import models
+from django.core.files.storage import default_storage
+from django.db import models, transaction
 from django.dispatch import receiver
+from django.utils.timezone import make_aware
 
 from django.contrib.auth.models import AbstractUser
 
+from acris.core.signals import collection_changed, file_deletions_queued
 
+
+# files are removed by acris.core.reaper once the transaction has committed, see queue_file_deletions
 def delete_file_on_change_helper(old_file, new_file):
-    if not old_file == new_file:
-        if os.path.isfile(old_file.path):
-            os.remove(old_file.path)
+    if old_file and not old_file == new_file:
+        queue_file_deletions([old_file.name])
 
 
 def delete_file_on_delete_helper(file_field):
     if file_field:
-        if os.path.isfile(file_field.path):
-            os.remove(file_field.path)
+        queue_file_deletions([file_field.name])
 
 
 # ~~~ User ~~~
@@ -34,6 +38,18 @@ class Collection(models.Model):
     viewers = models.ManyToManyField(AcrisUser, related_name='%(class)s_viewers', default=[])
     is_public = models.BooleanField()
 
+    # bumped on every change to the collection or anything in it, used as the ETag of its api responses
+    version = models.BigIntegerField(default=0)
+    date_modified = models.DateTimeField(null=True)
+    # newest change log seq dropped by compaction, clients that synced before it have to start over
+    changes_horizon = models.BigIntegerField(default=0)
+
+    # aggregates maintained by acris.core.stats
+    track_count = models.IntegerField(default=0)
+    length = models.DurationField(default=timedelta(seconds=0))
+    formats = models.JSONField(default=dict)
+    date_updated = models.DateTimeField(null=True)
+
 
 # ~~~ Artist ~~~
 def artist_thumbnail_path(instance, filename):
@@ -46,6 +62,17 @@ class Artist(models.Model):
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     thumbnail_src = models.ImageField(upload_to=artist_thumbnail_path)
 
+    # aggregates maintained by acris.core.stats
+    track_count = models.IntegerField(default=0)
+    length = models.DurationField(default=timedelta(seconds=0))
+    formats = models.JSONField(default=dict)
+    date_updated = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'name', 'id']),
+        ]
+
 
 @receiver(models.signals.post_delete, sender=Artist)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
@@ -58,7 +85,7 @@ def auto_delete_file_on_change(sender, instance, **kwargs):
         return False
 
     try:
-        old_obj = Track.objects.get(pk=instance.pk)
+        old_obj = Artist.objects.get(pk=instance.pk)
         delete_file_on_change_helper(old_obj.thumbnail_src, instance.thumbnail_src)
     except Artist.DoesNotExist:
         return False
@@ -72,27 +99,23 @@ def album_thumbnail_path(instance, filename):
 # an individual album, belonging to one collection
 class Album(models.Model):
     name = models.CharField(max_length=128)
-    length = models.DurationField(default=timedelta(seconds=0))
     artists = models.ManyToManyField(Artist, default=[])
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     thumbnail_src = models.ImageField(upload_to=album_thumbnail_path)
 
+    # aggregates maintained by acris.core.stats
+    track_count = models.IntegerField(default=0)
+    length = models.DurationField(default=timedelta(seconds=0))
+    formats = models.JSONField(default=dict)
+    date_updated = models.DateTimeField(null=True)
 
-@receiver(models.signals.post_delete, sender=Album)
-def auto_delete_file_on_delete(sender, instance, **kwargs):
-    delete_file_on_delete_helper(instance.thumbnail_src)
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'name', 'id']),
+        ]
 
 
-@receiver(models.signals.pre_save, sender=Album)
-def auto_delete_file_on_change(sender, instance, **kwargs):
-    if not instance.pk:
-        return False
-
-    try:
-        old_obj = Track.objects.get(pk=instance.pk)
-        delete_file_on_change_helper(old_obj.thumbnail_src, instance.thumbnail_src)
-    except Album.DoesNotExist:
-        return False
+# album and track thumbnails are shared cover art, their files are reference counted in acris.core.covers
 
 
 # ~~~ Genre ~~~
@@ -106,6 +129,17 @@ class Genre(models.Model):
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     thumbnail_src = models.ImageField(upload_to=genre_thumbnail_path)
 
+    # aggregates maintained by acris.core.stats
+    track_count = models.IntegerField(default=0)
+    length = models.DurationField(default=timedelta(seconds=0))
+    formats = models.JSONField(default=dict)
+    date_updated = models.DateTimeField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'name', 'id']),
+        ]
+
 
 @receiver(models.signals.post_delete, sender=Genre)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
@@ -118,7 +152,7 @@ def auto_delete_file_on_change(sender, instance, **kwargs):
         return False
 
     try:
-        old_obj = Track.objects.get(pk=instance.pk)
+        old_obj = Genre.objects.get(pk=instance.pk)
         delete_file_on_change_helper(old_obj.thumbnail_src, instance.thumbnail_src)
     except Genre.DoesNotExist:
         return False
@@ -135,10 +169,24 @@ class Playlist(models.Model):
     name = models.CharField(max_length=128)
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     thumbnail_src = models.ImageField(upload_to=playlist_thumbnail_path)
+    # smart playlists are filled with the tracks matching these rules (see acris.core.rules), empty for the others
+    rules = models.TextField(default='', blank=True)
+
+
+# ~~~ Cover Art ~~~
+# an encoded cover image stored at covers/<digest[:2]>/<digest>.jpg, shared by every track and album
+# embedding the same source image
+class CoverArt(models.Model):
+    digest = models.CharField(max_length=64, unique=True)
+    ref_count = models.IntegerField(default=0)
 
 
 # ~~~ Track ~~~
+# files with a known content hash are stored in a folder named after it, keeping the uploaded file name
 def track_path(instance, filename):
+    if instance.content_hash:
+        return 'collection-{0}/tracks/{1}/{2}/{3}'.format(instance.collection.id, instance.content_hash[:2],
+                                                          instance.content_hash, filename)
     return 'collection-{0}/tracks/{1}'.format(instance.collection.id, filename)
 
 
@@ -160,10 +208,21 @@ class Track(models.Model):
     genres = models.ManyToManyField(Genre)
     lyrics = models.TextField(default='')
     year = models.CharField(max_length=128, null=True)
-    playlists = models.ManyToManyField(Playlist)
+    playlists = models.ManyToManyField(Playlist, through='PlaylistEntry')
     collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
     thumbnail_src = models.ImageField("thumbnail location", upload_to=track_thumbnail_path)
     audio_src = models.FileField("file location", upload_to=track_path)
+    # sha256 of the audio file, empty when unknown
+    content_hash = models.CharField(max_length=64, default='')
+
+    # keyset pagination walks these in (sort key, id) order
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'name', 'id']),
+            models.Index(fields=['collection', 'year', 'id']),
+            models.Index(fields=['album', 'name', 'id']),
+            models.Index(fields=['collection', 'content_hash']),
+        ]
 
     # def save(self, *args, **kwargs):
     #     self.artists_display = ''
@@ -185,21 +244,25 @@ class Track(models.Model):
     #     super(Track, self).save(*args, **kwargs)
 
 
-@receiver(models.signals.pre_delete, sender=Track)
-def pre_delete_track(sender, instance, **kwargs):
-    for artist in instance.artists:
-        if artist.track_set.count() == 1:
-            artist.delete()
+# one track at one place in a playlist, a track can be in a playlist more than once. Entries are ordered by sparse
+# positions, see acris.core.playlists
+class PlaylistEntry(models.Model):
+    playlist = models.ForeignKey(Playlist, on_delete=models.CASCADE)
+    track = models.ForeignKey(Track, on_delete=models.CASCADE)
+    position = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['playlist', 'position'], name='unique_playlist_position'),
+        ]
 
-    for genre in instance.genres:
-        if genre.track_set.count() == 1:
-            genre.delete()
+
+# artists and genres left without tracks are removed by acris.core.deletion
 
 
 @receiver(models.signals.post_delete, sender=Track)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
     delete_file_on_delete_helper(instance.audio_src)
-    delete_file_on_delete_helper(instance.thumbnail_src)
 
 
 @receiver(models.signals.pre_save, sender=Track)
@@ -210,6 +273,227 @@ def auto_delete_file_on_change(sender, instance, **kwargs):
     try:
         old_obj = Track.objects.get(pk=instance.pk)
         delete_file_on_change_helper(old_obj.audio_src, instance.audio_src)
-        delete_file_on_change_helper(old_obj.thumbnail_src, instance.thumbnail_src)
     except Track.DoesNotExist:
         return False
+
+
+# ~~~ Ingest ~~~
+# a queued metadata extraction for uploaded files, processed by acris.core.ingest
+class IngestJob(models.Model):
+    UPLOAD = 'upload'
+    IMPORT = 'import'
+    RETAG = 'retag'
+    KIND_CHOICES = [
+        (UPLOAD, 'Upload'),
+        (IMPORT, 'Import'),
+        (RETAG, 'Retag'),
+    ]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    date_created = models.DateTimeField()
+    date_finished = models.DateTimeField(null=True)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, default=UPLOAD)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    total = models.IntegerField(default=1)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    # stored files of an import, [storage name, content hash] pairs
+    files = models.JSONField(default=list)
+    # uploaded files skipped because the collection already had their audio
+    duplicates = models.IntegerField(default=0)
+    error = models.TextField(default='')
+    # host:pid of the process running the job, to tell jobs interrupted by a restart from ones still running
+    worker = models.CharField(max_length=128, default='')
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    track = models.ForeignKey(Track, on_delete=models.SET_NULL, null=True)
+
+
+# ~~~ Upload Session ~~~
+# a resumable upload in progress, its chunks are written to partial_name until offset reaches length
+# (see acris.core.resumable). Sessions not written to before date_expires are removed by expire_uploads
+class UploadSession(models.Model):
+    file_name = models.CharField(max_length=255)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    on_duplicate = models.CharField(max_length=16, default='skip')
+    date_created = models.DateTimeField()
+    date_expires = models.DateTimeField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    user = models.ForeignKey(AcrisUser, on_delete=models.CASCADE)
+
+    @property
+    def partial_name(self):
+        return 'collection-{0}/uploads/{1}.part'.format(self.collection_id, self.id)
+
+
+@receiver(models.signals.post_delete, sender=UploadSession)
+def delete_partial_upload(sender, instance, **kwargs):
+    path = default_storage.path(instance.partial_name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+# ~~~ Library File ~~~
+# a file found by the library scanner, used to only re-read files whose size or mtime changed
+# track is empty for files that could not be read, so they are skipped until they change
+class LibraryFile(models.Model):
+    path = models.CharField(max_length=1024)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, null=True)
+
+    class Meta:
+        unique_together = [['collection', 'path']]
+
+
+# ~~~ File Deletion ~~~
+# a stored file whose row was deleted or pointed elsewhere, removed by acris.core.reaper unless another row still
+# references the name (linked duplicates share audio files)
+class FileDeletion(models.Model):
+    name = models.CharField(max_length=1024)
+    date_created = models.DateTimeField()
+
+
+# queue names for removal with the transaction that released them, the reaper is woken once it has committed
+def queue_file_deletions(names):
+    names = sorted({name for name in names if name})
+    if not names:
+        return
+    now = make_aware(datetime.now())
+    FileDeletion.objects.bulk_create([FileDeletion(name=name, date_created=now) for name in names])
+    transaction.on_commit(lambda: file_deletions_queued.send(sender=FileDeletion))
+
+
+# ~~~ Change Log ~~~
+# one row per created, updated or deleted track, album, artist, genre or playlist, for clients syncing deltas.
+# seq is the collection version the change was recorded at, rows superseded by a later change of the same object
+# are removed by compaction (see acris.core.changes)
+class Change(models.Model):
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = [
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    ]
+
+    seq = models.BigIntegerField()
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    date = models.DateTimeField()
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'seq']),
+            models.Index(fields=['collection', 'kind', 'object_id', 'seq']),
+        ]
+
+
+# ~~~ Collection versions ~~~
+# bulk writes bypass these signals and call bump_collection_version or record_changes themselves
+
+def bump_collection_version(collection_id):
+    Collection.objects.filter(id=collection_id).update(version=models.F('version') + 1,
+                                                       date_modified=make_aware(datetime.now()))
+    collection_changed.send(sender=Collection, collection_id=collection_id)
+
+
+# collections being deleted in this thread, their cascaded deletes are not logged
+deleting = threading.local()
+
+
+def is_deleting(collection_id):
+    return collection_id in getattr(deleting, 'ids', ())
+
+
+# bump the version of a collection and log changes at the new version, changes are (kind, object id, action)
+def record_changes(collection_id, changes):
+    if is_deleting(collection_id):
+        return
+    with transaction.atomic():
+        bump_collection_version(collection_id)
+        seq = Collection.objects.filter(id=collection_id).values_list('version', flat=True).first()
+        if seq is None or not changes:
+            return
+        now = make_aware(datetime.now())
+        Change.objects.bulk_create([Change(collection_id=collection_id, seq=seq, kind=kind, object_id=object_id,
+                                           action=action, date=now) for kind, object_id, action in changes])
+
+
+@receiver(models.signals.post_save, sender=Collection)
+@receiver(models.signals.m2m_changed, sender=Collection.owners.through)
+@receiver(models.signals.m2m_changed, sender=Collection.viewers.through)
+def bump_version_on_collection_change(sender, instance, raw=False, action=None, reverse=False, pk_set=None,
+                                      **kwargs):
+    if raw or action in ('pre_add', 'pre_remove', 'pre_clear'):
+        return
+    if not reverse:
+        bump_collection_version(instance.pk)
+    elif pk_set:
+        # a user added to or removed from collections
+        for collection_id in pk_set:
+            bump_collection_version(collection_id)
+
+
+@receiver(models.signals.pre_delete, sender=Collection)
+def start_collection_delete(sender, instance, **kwargs):
+    deleting.ids = getattr(deleting, 'ids', set()) | {instance.pk}
+
+
+@receiver(models.signals.post_delete, sender=Collection)
+def finish_collection_delete(sender, instance, **kwargs):
+    deleting.ids = getattr(deleting, 'ids', set()) - {instance.pk}
+
+
+@receiver(models.signals.post_save, sender=Artist)
+@receiver(models.signals.post_save, sender=Album)
+@receiver(models.signals.post_save, sender=Genre)
+@receiver(models.signals.post_save, sender=Playlist)
+@receiver(models.signals.post_save, sender=Track)
+def record_change_on_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        record_changes(instance.collection_id,
+                       [(sender._meta.model_name, instance.pk, Change.CREATE if created else Change.UPDATE)])
+
+
+@receiver(models.signals.post_delete, sender=Artist)
+@receiver(models.signals.post_delete, sender=Album)
+@receiver(models.signals.post_delete, sender=Genre)
+@receiver(models.signals.post_delete, sender=Playlist)
+@receiver(models.signals.post_delete, sender=Track)
+def record_change_on_delete(sender, instance, **kwargs):
+    record_changes(instance.collection_id, [(sender._meta.model_name, instance.pk, Change.DELETE)])
+
+
+@receiver(models.signals.m2m_changed, sender=Track.artists.through)
+@receiver(models.signals.m2m_changed, sender=Track.genres.through)
+@receiver(models.signals.m2m_changed, sender=Track.playlists.through)
+@receiver(models.signals.m2m_changed, sender=Album.artists.through)
+def record_change_on_relation_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    # the track or album holding the relation changed, both sides belong to the same collection
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            record_changes(instance.collection_id, [(instance._meta.model_name, instance.pk, Change.UPDATE)])
+        return
+
+    if action == 'pre_clear':
+        instance.changes_cleared = list(sender.objects.filter(**{instance._meta.model_name + '_id': instance.pk})
+                                        .values_list(model._meta.model_name + '_id', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        ids = getattr(instance, 'changes_cleared', []) if action == 'post_clear' else pk_set
+        record_changes(instance.collection_id, [(model._meta.model_name, object_id, Change.UPDATE)
+                                                for object_id in sorted(ids or [])])
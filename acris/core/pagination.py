@@ -0,0 +1,164 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def row_value(row, name):
+    if isinstance(row, dict):
+        return row[name]
+    return getattr(row, name)
+
+
+def json_value(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+# A limit/offset paginator with two additions for large lists:
+#
+# ?cursor= switches to keyset pagination over (ordering fields..., id), so every page costs one indexed range
+# scan no matter how deep it is, and no count is run. the cursor of the next page is returned in `next`.
+#
+# ?count=false keeps limit/offset pagination but skips the count query, `count` is then returned as null.
+class KeysetPagination(LimitOffsetPagination):
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    cursor_default_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.keyset = self.cursor_query_param in request.query_params
+        self.skip_count = request.query_params.get(self.count_query_param, '').lower() in ('false', '0')
+
+        if self.keyset:
+            self.limit = self.get_limit(request) or self.cursor_default_limit
+            return self.paginate_keyset(queryset, request)
+
+        if not self.skip_count:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.count = None
+        self.offset = self.get_offset(request)
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_paginated_response(self, data):
+        if self.keyset:
+            return Response(OrderedDict([
+                ('next', self.next_cursor_link),
+                ('previous', None),
+                ('results', data),
+            ]))
+        return super().get_paginated_response(data)
+
+    def get_next_link(self):
+        if self.skip_count and not self.keyset:
+            if not self.has_next:
+                return None
+            url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+            return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+        return super().get_next_link()
+
+    # ~~~ keyset ~~~
+
+    def ordering_keys(self, queryset):
+        keys = []
+        for ordering in queryset.query.order_by or queryset.model._meta.ordering:
+            if not isinstance(ordering, str):
+                continue
+            descending = ordering.startswith('-')
+            name = ordering.lstrip('-')
+            if name in ('id', 'pk'):
+                continue
+            try:
+                nullable = queryset.model._meta.get_field(name).null
+            except FieldDoesNotExist:
+                nullable = False
+            keys.append((name, descending, nullable))
+        return keys
+
+    def decode_cursor(self, cursor, length):
+        if not cursor:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        if not isinstance(values, list) or len(values) != length + 1:
+            raise NotFound('Invalid cursor')
+        return values
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    # rows strictly after the cursor, nulls sort first ascending and last descending
+    def after(self, keys, values, descending_id):
+        if not keys:
+            return Q(id__lt=values[0]) if descending_id else Q(id__gt=values[0])
+
+        (name, descending, nullable), value = keys[0], values[0]
+        rest = self.after(keys[1:], values[1:], descending_id)
+
+        if value is None:
+            equal = Q(**{name + '__isnull': True})
+            beyond = None if descending else Q(**{name + '__isnull': False})
+        else:
+            equal = Q(**{name: value})
+            beyond = Q(**{name + ('__lt' if descending else '__gt'): value})
+            if descending and nullable:
+                beyond |= Q(**{name + '__isnull': True})
+
+        if beyond is None:
+            return equal & rest
+        return beyond | (equal & rest)
+
+    # a bound on the first ordering key alone, ANDed onto after() so the index range starts at the cursor instead of
+    # the database walking every row before it
+    def leading_bound(self, keys, values):
+        if not keys or values[0] is None:
+            return Q()
+        (name, descending, nullable), value = keys[0], values[0]
+        if not descending:
+            return Q(**{name + '__gte': value})
+        bound = Q(**{name + '__lte': value})
+        return bound | Q(**{name + '__isnull': True}) if nullable else bound
+
+    def paginate_keyset(self, queryset, request):
+        keys = self.ordering_keys(queryset)
+        descending_id = keys[-1][1] if keys else False
+
+        order_by = []
+        for name, descending, nullable in keys:
+            order_by.append(F(name).desc(nulls_last=True) if descending else F(name).asc(nulls_first=True))
+        order_by.append('-id' if descending_id else 'id')
+        queryset = queryset.order_by(*order_by)
+
+        values = self.decode_cursor(request.query_params.get(self.cursor_query_param), len(keys))
+        if values is not None:
+            queryset = queryset.filter(self.leading_bound(keys, values) & self.after(keys, values, descending_id))
+
+        rows = list(queryset[:self.limit + 1])
+        page = rows[:self.limit]
+
+        self.next_cursor_link = None
+        if len(rows) > self.limit:
+            last = page[-1]
+            cursor = self.encode_cursor([json_value(row_value(last, name)) for name, descending, nullable in keys] +
+                                        [row_value(last, 'id')])
+            url = replace_query_param(request.build_absolute_uri(), self.limit_query_param, self.limit)
+            url = remove_query_param(url, self.offset_query_param)
+            self.next_cursor_link = replace_query_param(url, self.cursor_query_param, cursor)
+        return page
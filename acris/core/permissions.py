@@ -1,18 +1,127 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+from django.dispatch import receiver
 from rest_framework import permissions
 
+from acris.core.models import Collection
 
-def has_collection_permission(request, collection):
+# Collection access is resolved from a per-user map of collection id -> access level, built with two queries,
+# kept in the cache between requests and dropped whenever the user's owner or viewer links change.
+# Public collections are one cached set shared by everyone.
+
+OWNER = 'owner'
+VIEWER = 'viewer'
+
+PUBLIC_KEY = 'acris:acl:public'
+
+
+def user_key(user_id):
+    return 'acris:acl:user:%d' % user_id
+
+
+def load_user_access(user_id):
+    access = {}
+    for collection_id in Collection.viewers.through.objects.filter(acrisuser_id=user_id) \
+            .values_list('collection_id', flat=True):
+        access[collection_id] = VIEWER
+    for collection_id in Collection.owners.through.objects.filter(acrisuser_id=user_id) \
+            .values_list('collection_id', flat=True):
+        access[collection_id] = OWNER
+    return access
+
+
+# collection id -> OWNER or VIEWER for the user of the request, looked up once per request
+def user_access(request):
+    access = getattr(request, 'collection_access', None)
+    if access is None:
+        access = {}
+        if request.user and request.user.is_authenticated:
+            access = cache.get_or_set(user_key(request.user.id), lambda: load_user_access(request.user.id),
+                                      settings.ACRIS_ACL_CACHE_TIMEOUT)
+        request.collection_access = access
+    return access
+
+
+def public_collections(request):
+    public = getattr(request, 'public_collections', None)
+    if public is None:
+        public = cache.get_or_set(PUBLIC_KEY,
+                                  lambda: set(Collection.objects.filter(is_public=True).values_list('id', flat=True)),
+                                  settings.ACRIS_ACL_CACHE_TIMEOUT)
+        request.public_collections = public
+    return public
+
+
+def has_collection_permission(request, collection_id):
+    level = user_access(request).get(collection_id)
     if request.method in permissions.SAFE_METHODS:
-        if collection.is_public or request.user in collection.viewers:
+        if level is not None or collection_id in public_collections(request):
             return True
-    return request.user in collection.owners
+    return level == OWNER
+
+
+# views under a collection say which url kwarg identifies them and which model it is the id of
+class CollectionScopedMixin:
+    collection_model = Collection
+    collection_kwarg = 'collection_id'
+
+    # (collection id, version, date modified) of the collection the url points into, None if it does not exist
+    def get_collection_row(self):
+        if not hasattr(self, 'collection_row'):
+            lookup = self.collection_model.objects.filter(id=self.kwargs[self.collection_kwarg])
+            if self.collection_model is Collection:
+                self.collection_row = lookup.values_list('id', 'version', 'date_modified').first()
+            else:
+                self.collection_row = lookup.values_list('collection_id', 'collection__version',
+                                                         'collection__date_modified').first()
+        return self.collection_row
 
 
 class HasCollectionPermissionOrReadOnly(permissions.BasePermission):
+    # missing objects are let through for the view to answer 404
+    def has_permission(self, request, view):
+        row = view.get_collection_row()
+        return row is None or has_collection_permission(request, row[0])
+
     def has_object_permission(self, request, view, obj):
-        return has_collection_permission(request, obj)
+        return has_collection_permission(request, obj.id)
 
 
-class HasSubCollectionPermissionOrReadOnly(permissions.BasePermission):
+class HasSubCollectionPermissionOrReadOnly(HasCollectionPermissionOrReadOnly):
     def has_object_permission(self, request, view, obj):
-        return has_collection_permission(request, obj.collection)
+        return has_collection_permission(request, obj.collection_id)
+
+
+# ~~~ Invalidation ~~~
+
+@receiver(signals.m2m_changed, sender=Collection.owners.through)
+@receiver(signals.m2m_changed, sender=Collection.viewers.through)
+def invalidate_access_on_member_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # a user's collections changed
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            cache.delete(user_key(instance.pk))
+        return
+
+    if action == 'pre_clear':
+        instance.acl_cleared = list(sender.objects.filter(collection_id=instance.pk)
+                                    .values_list('acrisuser_id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        cache.delete_many([user_key(user_id) for user_id in pk_set])
+    elif action == 'post_clear':
+        cache.delete_many([user_key(user_id) for user_id in getattr(instance, 'acl_cleared', [])])
+
+
+@receiver(signals.post_save, sender=Collection)
+def invalidate_public_on_save(sender, instance, **kwargs):
+    cache.delete(PUBLIC_KEY)
+
+
+@receiver(signals.pre_delete, sender=Collection)
+def invalidate_access_on_delete(sender, instance, **kwargs):
+    user_ids = set(Collection.owners.through.objects.filter(collection_id=instance.pk)
+                   .values_list('acrisuser_id', flat=True))
+    user_ids.update(Collection.viewers.through.objects.filter(collection_id=instance.pk)
+                    .values_list('acrisuser_id', flat=True))
+    cache.delete_many([user_key(user_id) for user_id in user_ids] + [PUBLIC_KEY])
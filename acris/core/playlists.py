@@ -0,0 +1,226 @@
+from django.db import transaction
+from django.db.models import F, Max, signals
+from django.dispatch import receiver
+from rest_framework.exceptions import ValidationError
+
+import acris.core.deletion as deletion
+import acris.core.rules as rules
+from acris.core.models import Album, Artist, Change, Genre, Playlist, PlaylistEntry, Track, record_changes
+from acris.core.signals import tracks_imported
+
+# Playlist entries are ordered by sparse integer positions. Appended entries are placed GAP apart, and entries added
+# or moved in front of another one take positions spread over the gap below it, so a move updates only the moved rows
+# however long the playlist is. When a gap is used up the playlist is renumbered once, which leaves room for the
+# entries being placed and GAP between all the others again. Positions are unique within a playlist, rows getting new
+# ones are first moved to negative positions so no update collides with a position about to be freed.
+#
+# Every operation runs in one transaction, and changes the playlist's version like any other change in the
+# collection.
+#
+# Smart playlists have rules instead, their entries are the tracks matching them. Tracks are checked against the rules
+# as they are imported, read again or edited, new matches are appended and tracks that stopped matching are removed.
+# Deleted tracks take their entries with them. Rules on dates (added in last 30 days) change as time passes, run
+# manage.py refresh_playlists periodically to rebuild them.
+
+GAP = 1 << 16
+
+# entries added, moved or removed by one request
+MAX_ENTRIES = 5000
+
+
+def check_manual(playlist, name):
+    if playlist.rules:
+        raise ValidationError({name: ['Smart playlists are filled by their rules.']})
+
+
+def check_size(name, ids):
+    if not ids:
+        raise ValidationError({name: ['Expected a list of ids.']})
+    if len(ids) > MAX_ENTRIES:
+        raise ValidationError({name: ['At most %d at a time.' % MAX_ENTRIES]})
+
+
+def entry_position(playlist, entry_id, name='before'):
+    position = PlaylistEntry.objects.filter(playlist=playlist, id=entry_id).values_list('position', flat=True).first()
+    if position is None:
+        raise ValidationError({name: ['Unknown entry: %s' % entry_id]})
+    return position
+
+
+# give every entry a new position GAP apart, with room for count more entries below the entry before
+def renumber(playlist, before=None, count=0):
+    entries = list(PlaylistEntry.objects.filter(playlist=playlist).order_by('position', 'id').only('id', 'position'))
+    PlaylistEntry.objects.filter(playlist=playlist).update(position=-F('position'))
+    offset = 0
+    for i, entry in enumerate(entries, 1):
+        if entry.id == before:
+            offset = count * GAP
+        entry.position = i * GAP + offset
+    PlaylistEntry.objects.bulk_update(entries, ['position'], batch_size=deletion.BATCH_SIZE)
+
+
+# positions for count entries in front of the entry before, or after the last one when before is None. Entries being
+# moved do not count as neighbours
+def free_positions(playlist, before, count, moving=()):
+    if before is None:
+        last = PlaylistEntry.objects.filter(playlist=playlist).aggregate(last=Max('position'))['last'] or 0
+        return [last + GAP * (i + 1) for i in range(count)]
+
+    upper = entry_position(playlist, before)
+    lower = PlaylistEntry.objects.filter(playlist=playlist, position__lt=upper).exclude(id__in=moving) \
+        .aggregate(lower=Max('position'))['lower'] or 0
+    step = (upper - lower) // (count + 1)
+    if step < 1:
+        renumber(playlist, before, count)
+        return free_positions(playlist, before, count, moving)
+    return [lower + step * (i + 1) for i in range(count)]
+
+
+# add tracks of the playlist's collection in the given order, in front of the entry before or at the end
+def add_tracks(playlist: Playlist, track_ids, before=None):
+    check_manual(playlist, 'tracks')
+    check_size('tracks', track_ids)
+    with transaction.atomic():
+        known = set()
+        for batch in deletion.chunks(set(track_ids)):
+            known.update(Track.objects.filter(collection_id=playlist.collection_id, id__in=batch)
+                         .values_list('id', flat=True))
+        unknown = [str(track_id) for track_id in track_ids if track_id not in known]
+        if unknown:
+            raise ValidationError({'tracks': ['Unknown track: %s' % ', '.join(unknown)]})
+
+        positions = free_positions(playlist, before, len(track_ids))
+        PlaylistEntry.objects.bulk_create([PlaylistEntry(playlist=playlist, track_id=track_id, position=position)
+                                           for track_id, position in zip(track_ids, positions)],
+                                          batch_size=deletion.BATCH_SIZE)
+        record_changes(playlist.collection_id, [('playlist', playlist.id, Change.UPDATE)] +
+                       [('track', track_id, Change.UPDATE) for track_id in sorted(known)])
+        return list(PlaylistEntry.objects.filter(playlist=playlist, position__gte=positions[0],
+                                                 position__lte=positions[-1]).order_by('position'))
+
+
+# move entries, in the given order, in front of the entry before or to the end
+def move_entries(playlist: Playlist, entry_ids, before=None):
+    check_size('entries', entry_ids)
+    if len(set(entry_ids)) != len(entry_ids):
+        raise ValidationError({'entries': ['An entry can only be moved once at a time.']})
+    if before in entry_ids:
+        raise ValidationError({'before': ['An entry cannot be moved in front of itself.']})
+    with transaction.atomic():
+        entries = PlaylistEntry.objects.filter(playlist=playlist).in_bulk(entry_ids)
+        unknown = [str(entry_id) for entry_id in entry_ids if entry_id not in entries]
+        if unknown:
+            raise ValidationError({'entries': ['Unknown entry: %s' % ', '.join(unknown)]})
+
+        positions = free_positions(playlist, before, len(entry_ids), moving=entry_ids)
+        moved = []
+        for entry_id, position in zip(entry_ids, positions):
+            entries[entry_id].position = position
+            moved.append(entries[entry_id])
+        for batch in deletion.chunks(entry_ids):
+            PlaylistEntry.objects.filter(id__in=batch).update(position=-F('position'))
+        PlaylistEntry.objects.bulk_update(moved, ['position'], batch_size=deletion.BATCH_SIZE)
+        record_changes(playlist.collection_id, [('playlist', playlist.id, Change.UPDATE)])
+        return moved
+
+
+# remove entries, returns how many were removed
+def remove_entries(playlist: Playlist, entry_ids):
+    check_manual(playlist, 'entries')
+    check_size('entries', entry_ids)
+    with transaction.atomic():
+        entries = PlaylistEntry.objects.filter(playlist=playlist, id__in=entry_ids)
+        track_ids = set(entries.values_list('track_id', flat=True))
+        removed = deletion.raw_delete(entries)
+        if removed:
+            record_changes(playlist.collection_id, [('playlist', playlist.id, Change.UPDATE)] +
+                           [('track', track_id, Change.UPDATE) for track_id in sorted(track_ids)])
+        return removed
+
+
+# ~~~ Smart playlists ~~~
+
+def smart_playlists(collection_id):
+    return list(Playlist.objects.filter(collection_id=collection_id).exclude(rules=''))
+
+
+# bring the entries of a smart playlist in line with its rules, for the given tracks or every track of the collection.
+# Returns the number of entries added and removed
+def sync_members(playlist: Playlist, track_ids=None):
+    tracks = Track.objects.filter(collection_id=playlist.collection_id)
+    entries = PlaylistEntry.objects.filter(playlist=playlist)
+    if track_ids is not None:
+        tracks = tracks.filter(id__in=track_ids)
+        entries = entries.filter(track_id__in=track_ids)
+
+    with transaction.atomic():
+        query = rules.compile_rules(playlist.rules)()
+        matching = set(rules.annotate(tracks).filter(query).values_list('id', flat=True))
+        members = set(entries.values_list('track_id', flat=True))
+        added = sorted(matching - members)
+        removed = members - matching
+
+        if added:
+            PlaylistEntry.objects.bulk_create([PlaylistEntry(playlist=playlist, track_id=track_id, position=position)
+                                               for track_id, position in
+                                               zip(added, free_positions(playlist, None, len(added)))],
+                                              batch_size=deletion.BATCH_SIZE)
+        if removed:
+            deletion.raw_delete(entries.filter(track_id__in=removed))
+        if added or removed:
+            record_changes(playlist.collection_id, [('playlist', playlist.id, Change.UPDATE)] +
+                           [('track', track_id, Change.UPDATE) for track_id in sorted(matching ^ members)])
+    return len(added), len(removed)
+
+
+def sync_tracks(collection_id, track_ids):
+    track_ids = list(track_ids)
+    if not track_ids:
+        return
+    for playlist in smart_playlists(collection_id):
+        for batch in deletion.chunks(track_ids):
+            sync_members(playlist, batch)
+
+
+@receiver(tracks_imported)
+def sync_imported_tracks(sender, collection, track_ids, **kwargs):
+    sync_tracks(collection.id, track_ids)
+
+
+@receiver(signals.post_save, sender=Track)
+def sync_track_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync_tracks(instance.collection_id, [instance.pk])
+
+
+@receiver(signals.m2m_changed, sender=Track.artists.through)
+@receiver(signals.m2m_changed, sender=Track.genres.through)
+def sync_track_on_relation_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        sync_tracks(instance.collection_id, [instance.pk])
+    elif pk_set:
+        sync_tracks(instance.collection_id, pk_set)
+
+
+# a renamed album, artist or genre can change which of its tracks match
+@receiver(signals.post_save, sender=Album)
+@receiver(signals.post_save, sender=Artist)
+@receiver(signals.post_save, sender=Genre)
+def sync_tracks_on_entity_save(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        sync_tracks(instance.collection_id, instance.track_set.values_list('id', flat=True))
+
+
+@receiver(signals.pre_save, sender=Playlist)
+def remember_rules(sender, instance, raw=False, **kwargs):
+    instance.rules_previous = None
+    if instance.pk and not raw:
+        instance.rules_previous = Playlist.objects.filter(pk=instance.pk).values_list('rules', flat=True).first()
+
+
+@receiver(signals.post_save, sender=Playlist)
+def sync_playlist_on_rules_change(sender, instance, raw=False, **kwargs):
+    if not raw and instance.rules and instance.rules != getattr(instance, 'rules_previous', None):
+        sync_members(instance)
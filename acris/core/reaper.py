@@ -0,0 +1,226 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+import acris.core.covers as covers
+import acris.core.deletion as deletion
+from acris.core.models import Album, Artist, Collection, CoverArt, FileDeletion, Genre, IngestJob, Playlist, Track, \
+    UploadSession
+from acris.core.signals import file_deletions_queued
+
+logger = logging.getLogger(__name__)
+
+# Files are not removed by the request or job that deleted their rows. Their names are queued as FileDeletion rows in
+# the same transaction (see models.queue_file_deletions) and unlinked here, on a background thread, once it has
+# committed. A rolled back delete keeps its files, and a queue left by a process that stopped is picked up by the next
+# one or by manage.py gc_media. A name is skipped when a row still refers to it: linked duplicates share audio files,
+# and a released cover may have been stored again since.
+
+BATCH_SIZE = 500
+
+# every field holding a storage name
+FILE_FIELDS = [
+    (Track, 'audio_src'),
+    (Track, 'thumbnail_src'),
+    (Album, 'thumbnail_src'),
+    (Artist, 'thumbnail_src'),
+    (Genre, 'thumbnail_src'),
+    (Playlist, 'thumbnail_src'),
+]
+
+_executor = None
+_executor_lock = threading.Lock()
+_scheduled = False
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='acris-reaper')
+            # files queued by a previous process
+            _executor.submit(run)
+    return _executor
+
+
+# one reap covers everything queued until it starts, so wakes arriving while one is waiting are dropped
+def wake():
+    global _scheduled
+    with _executor_lock:
+        if _scheduled:
+            return
+        _scheduled = True
+    get_executor().submit(run)
+
+
+def run():
+    global _scheduled
+    with _executor_lock:
+        _scheduled = False
+    close_old_connections()
+    try:
+        reap()
+    except Exception:
+        logger.exception('could not remove queued files')
+    finally:
+        close_old_connections()
+
+
+@receiver(file_deletions_queued)
+def wake_on_queue(sender, **kwargs):
+    wake()
+
+
+# the names out of names that a row refers to
+def in_use(names):
+    names = list(names)
+    used = set()
+    for batch in deletion.chunks(names):
+        for model, field in FILE_FIELDS:
+            used.update(model.objects.filter(**{field + '__in': batch}).values_list(field, flat=True))
+        digests = {covers.name_digest(name): name for name in batch if covers.is_cover(name)}
+        for digest in CoverArt.objects.filter(digest__in=list(digests)).values_list('digest', flat=True):
+            used.add(digests[digest])
+    return used
+
+
+# unlink a stored file, a symlink made by the library scanner is removed but not what it points at
+def remove(name):
+    path = default_storage.path(name)
+    try:
+        size = os.lstat(path).st_size
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+# remove every queued file nothing refers to, returns how many were removed
+def reap():
+    removed = 0
+    while True:
+        rows = list(FileDeletion.objects.order_by('id').values_list('id', 'name')[:BATCH_SIZE])
+        if not rows:
+            return removed
+        used = in_use({name for _, name in rows})
+        for name in {name for _, name in rows} - used:
+            try:
+                remove(name)
+                removed += 1
+            except OSError:
+                logger.warning('could not remove file', exc_info=True, extra={'file_name': name})
+        FileDeletion.objects.filter(id__in=[row_id for row_id, _ in rows]).delete()
+
+
+# ~~~ Reconciling ~~~
+
+class GCResult:
+    def __init__(self):
+        self.queued = 0
+        self.unreferenced = 0
+        self.unreferenced_bytes = 0
+        self.empty_folders = 0
+        self.missing = 0
+        self.missing_deleted = 0
+
+    def __str__(self):
+        return 'removed {0} queued files, {1} unreferenced files ({2} bytes) and {3} empty folders, ' \
+               '{4} tracks without audio file ({5} deleted)'.format(
+                self.queued, self.unreferenced, self.unreferenced_bytes, self.empty_folders, self.missing,
+                self.missing_deleted)
+
+
+# the folders acris stores into, anything else below MEDIA_ROOT is left alone
+def media_folders(root):
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, entry) for entry in sorted(os.listdir(root))
+            if entry.startswith('collection-') or entry == covers.COVER_DIR.rstrip('/')]
+
+
+# yields (storage name, lstat) of the files and symlinks below the media folders
+def stored_files(root):
+    stack = media_folders(root)
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield os.path.relpath(entry.path, root).replace(os.sep, '/'), entry.stat(follow_symlinks=False)
+
+
+# files written before their rows exist: resumable uploads in progress and the files of imports not yet run
+def pending_names():
+    names = {session.partial_name for session in UploadSession.objects.only('id', 'collection_id')}
+    for files in IngestJob.objects.filter(status__in=[IngestJob.PENDING, IngestJob.RUNNING]) \
+            .values_list('files', flat=True):
+        names.update(files)
+    return names
+
+
+def remove_empty_folders(root, min_mtime):
+    removed = 0
+    for folder, dirs, files in os.walk(root, topdown=False):
+        if folder == root or files or dirs or os.lstat(folder).st_mtime > min_mtime:
+            continue
+        try:
+            os.rmdir(folder)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def remove_unreferenced(batch, pending, dry_run, result):
+    unused = {name for name, size in batch} - in_use(name for name, size in batch) - pending
+    for name, size in batch:
+        if name in unused:
+            result.unreferenced += 1
+            result.unreferenced_bytes += size
+            if not dry_run:
+                remove(name)
+
+
+# bring the media folder in line with the database: empty the queue, remove files no row refers to that are older
+# than min_age seconds (younger ones may belong to a request still running), and count tracks whose audio is gone
+def gc_media(min_age=3600, dry_run=False, delete_missing=False):
+    result = GCResult()
+    root = settings.MEDIA_ROOT
+    if not dry_run:
+        result.queued = reap()
+
+    min_mtime = time.time() - min_age
+    pending = pending_names()
+    batch = []
+    for name, stat in stored_files(root):
+        if stat.st_mtime > min_mtime:
+            continue
+        batch.append((name, stat.st_size))
+        if len(batch) == BATCH_SIZE:
+            remove_unreferenced(batch, pending, dry_run, result)
+            batch = []
+    if batch:
+        remove_unreferenced(batch, pending, dry_run, result)
+    if not dry_run:
+        for folder in media_folders(root):
+            result.empty_folders += remove_empty_folders(folder, min_mtime)
+
+    # os.path.exists follows the symlinks of scanned tracks, a link to a master that is gone counts as missing
+    missing = {}
+    for track_id, collection_id, name in Track.objects.exclude(audio_src='') \
+            .values_list('id', 'collection_id', 'audio_src').iterator():
+        if not os.path.exists(default_storage.path(name)):
+            missing.setdefault(collection_id, []).append(track_id)
+    result.missing = sum(len(ids) for ids in missing.values())
+    if delete_missing and not dry_run:
+        for collection in Collection.objects.filter(id__in=list(missing)):
+            result.missing_deleted += deletion.delete_tracks(collection, missing[collection.id])
+    return result
@@ -0,0 +1,133 @@
+import json
+import zlib
+
+import msgpack
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework import renderers
+from rest_framework.settings import api_settings
+from rest_framework.utils import encoders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Renderers for list exports that write one record at a time. Rendered normally (errors, small payloads) they
+# encode a list as one record per item and anything else as a single record, see stream_response for streaming.
+class StreamingRenderer(renderers.BaseRenderer):
+    charset = None
+
+    def encode(self, item):
+        raise NotImplementedError
+
+    def encode_items(self, items):
+        return b''.join(self.encode(item) for item in items)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, list):
+            return self.encode_items(data)
+        return self.encode(data)
+
+
+# newline delimited json, one object per line
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def encode(self, item):
+        return json.dumps(item, cls=encoders.JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+
+
+# a sequence of concatenated messagepack maps, readable with msgpack.Unpacker
+class MessagePackRenderer(StreamingRenderer):
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+
+    def encode(self, item):
+        return msgpack.packb(item, use_bin_type=True)
+
+
+LIST_RENDERERS = list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer, MessagePackRenderer]
+
+
+# ~~~ Compression ~~~
+
+class GzipStream:
+    encoding = 'gzip'
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    # sync flush so every chunk reaches the client as soon as it is rendered
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliStream:
+    encoding = 'br'
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+# brotli when the client and server both have it, then gzip, None to send the stream as is
+def choose_compression(request):
+    encodings = accepted_encodings(request)
+    if brotli is not None and 'br' in encodings:
+        return BrotliStream()
+    if 'gzip' in encodings:
+        return GzipStream()
+    return None
+
+
+def compressed(chunks, compression):
+    for chunk in chunks:
+        data = compression.compress(chunk)
+        if data:
+            yield data
+    yield compression.finish()
+
+
+# a response sending each chunk of items as soon as it is encoded, chunks is an iterable of lists of items
+def stream_response(request, renderer, chunks):
+    content = (renderer.encode_items(items) for items in chunks)
+
+    compression = choose_compression(request)
+    if compression is not None:
+        content = compressed(content, compression)
+
+    response = StreamingHttpResponse(content, content_type=renderer.media_type)
+    if compression is not None:
+        response['Content-Encoding'] = compression.encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
@@ -0,0 +1,215 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import UnreadablePostError
+from django.utils.http import http_date
+from django.utils.timezone import make_aware
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+import acris.core.importer as importer
+from acris.core.models import UploadSession
+from acris.core.permissions import CollectionScopedMixin
+
+logger = logging.getLogger(__name__)
+
+# Resumable uploads following the tus 1.0 protocol (core, creation, termination and expiration):
+#
+#   POST   api/collection/<id>/uploads  Upload-Length, Upload-Metadata: filename <base64>  -> 201, Location
+#   HEAD   api/upload/<upload_id>       -> Upload-Offset, how much of the file the server has
+#   PATCH  api/upload/<upload_id>       Upload-Offset, application/offset+octet-stream body -> 204, new Upload-Offset
+#   DELETE api/upload/<upload_id>       -> 204, the partial file is removed
+#
+# Chunks are appended to the partial file in place and hashed as they arrive. The PATCH that completes the upload
+# moves the file to its track storage name and answers like api/collection/<id>/upload.
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,termination,expiration'
+OFFSET_CONTENT_TYPE = 'application/offset+octet-stream'
+CHUNK_SIZE = 1024 * 1024
+
+
+class Conflict(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Upload-Offset does not match the offset of the upload.'
+
+
+class TooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Upload-Length is larger than the maximum upload size.'
+
+
+# Upload-Metadata is a comma separated list of "key base64(value)" pairs, values may be missing
+def parse_metadata(header):
+    metadata = {}
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(value.strip(), validate=True).decode() if value.strip() else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise ValueError('invalid Upload-Metadata value for %s' % key)
+    return metadata
+
+
+def expiry():
+    return make_aware(datetime.now()) + timedelta(hours=settings.ACRIS_UPLOAD_EXPIRY_HOURS)
+
+
+def create(collection, user, file_name, length, on_duplicate):
+    if length > settings.ACRIS_UPLOAD_MAX_SIZE:
+        raise TooLarge()
+    now = make_aware(datetime.now())
+    session = UploadSession.objects.create(collection=collection, user=user, file_name=os.path.basename(file_name),
+                                           length=length, on_duplicate=on_duplicate, date_created=now,
+                                           date_expires=expiry())
+    path = default_storage.path(session.partial_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return session
+
+
+# ~~~ Hashing ~~~
+# sha256 state of the sessions this process is writing, id -> (offset, hasher, expires). Hash objects cannot be
+# stored, a session resumed in another process, after a restart or after its state was evicted hashes what it already
+# has once to catch up. The state of sessions left past their expiry is dropped on the next write, whichever process
+# expires the sessions themselves
+_hashers = {}
+_busy = set()
+_lock = threading.Lock()
+
+
+def claim(session_id):
+    with _lock:
+        if session_id in _busy:
+            raise Conflict('Another request is writing to this upload.')
+        _busy.add(session_id)
+
+
+def release(session_id):
+    with _lock:
+        _busy.discard(session_id)
+
+
+def hasher_at(session, path):
+    offset, hasher, _ = _hashers.get(session.id, (None, None, None))
+    if offset == session.offset:
+        return hasher
+
+    hasher = hashlib.sha256()
+    remaining = session.offset
+    with open(path, 'rb') as f:
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
+
+
+# append the body of a PATCH at offset, returns the new offset. A connection that drops keeps what was received
+def write(session, offset, stream):
+    if offset != session.offset:
+        raise Conflict()
+
+    claim(session.id)
+    try:
+        path = default_storage.path(session.partial_name)
+        hasher = hasher_at(session, path)
+        remaining = session.length - offset
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            try:
+                while remaining and stream is not None:
+                    chunk = stream.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    offset += len(chunk)
+                    remaining -= len(chunk)
+            except (OSError, UnreadablePostError):
+                logger.info('upload chunk cut short', exc_info=True,
+                            extra={'upload': session.id, 'offset': offset})
+            # anything past the offset is left over from a write that never got recorded
+            f.truncate(offset)
+
+        session.offset = offset
+        session.date_expires = expiry()
+        session.save(update_fields=['offset', 'date_expires'])
+        with _lock:
+            _hashers[session.id] = (offset, hasher, session.date_expires)
+    finally:
+        release(session.id)
+    evict_hashers(make_aware(datetime.now()))
+    return offset
+
+
+def evict_hashers(now):
+    with _lock:
+        for session_id in [session_id for session_id, (_, _, expires) in _hashers.items() if expires < now]:
+            del _hashers[session_id]
+
+
+def content_hash(session):
+    offset, hasher, _ = _hashers.get(session.id, (None, None, None))
+    if offset != session.offset:
+        hasher = hasher_at(session, default_storage.path(session.partial_name))
+    return hasher.hexdigest()
+
+
+# move a complete upload to its track storage name, same filesystem so nothing is copied
+def store(session, file_hash):
+    name = default_storage.get_available_name(importer.audio_storage_name(session.collection, session.file_name,
+                                                                          file_hash))
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(default_storage.path(session.partial_name), path)
+    return name
+
+
+def discard(session):
+    with _lock:
+        _hashers.pop(session.id, None)
+    session.delete()
+
+
+def expire():
+    now = make_aware(datetime.now())
+    count = 0
+    for session in UploadSession.objects.filter(date_expires__lt=now):
+        discard(session)
+        count += 1
+    evict_hashers(now)
+    return count
+
+
+# ~~~ Views ~~~
+
+def upload_headers(response, session):
+    response['Upload-Offset'] = str(session.offset)
+    response['Upload-Length'] = str(session.length)
+    response['Upload-Expires'] = http_date(session.date_expires.timestamp())
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+# tus headers on every response of the upload routes
+class TusMixin(CollectionScopedMixin):
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        response['Tus-Resumable'] = TUS_VERSION
+        if request.method == 'OPTIONS':
+            response['Tus-Version'] = TUS_VERSION
+            response['Tus-Extension'] = TUS_EXTENSIONS
+            response['Tus-Max-Size'] = str(settings.ACRIS_UPLOAD_MAX_SIZE)
+        return response
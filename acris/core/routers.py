@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+READ_DATABASE = 'read'
+
+
+# reads go to the read only connection when settings.DATABASES has one, writes always to default
+class ReadWriteRouter:
+    def db_for_read(self, model, **hints):
+        # inside a transaction, reads have to see what it wrote so far
+        if READ_DATABASE not in settings.DATABASES or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    # both are the same database
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,271 @@
+from collections import defaultdict
+
+from django.utils.duration import duration_string
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from acris.core.models import Artist, Album, Genre, Playlist, Track
+from acris.core.renderers import LIST_RENDERERS, StreamingRenderer, stream_response
+
+# List routes render their rows straight from values() tuples instead of going through ModelSerializer.
+#
+# ?fields=id,name,album  limits a row to the listed fields, only their columns are selected
+# ?expand=album,artists  nests the related objects of those fields, the other relations are rendered as ids
+#
+# Without ?fields= every field except the optional ones (track lyrics) is rendered, and without ?expand= the
+# relations the ModelSerializers nest are expanded, so the default rows keep the shape of the detail routes.
+
+datetime_field = serializers.DateTimeField()
+
+
+def render_datetime(value, request):
+    return datetime_field.to_representation(value)
+
+
+def render_duration(value, request):
+    return None if value is None else duration_string(value)
+
+
+def file_renderer(model, field_name):
+    storage = model._meta.get_field(field_name).storage
+
+    def render(value, request):
+        if not value:
+            return None
+        url = storage.url(value)
+        return request.build_absolute_uri(url) if request is not None else url
+    return render
+
+
+class Column:
+    def __init__(self, column, render=None):
+        self.column = column
+        self.render = render
+
+
+class ForeignKey:
+    def __init__(self, column, rows):
+        self.column = column
+        self.rows = rows
+
+
+class ManyToMany:
+    def __init__(self, through, source, target, rows):
+        self.through = through
+        self.source = source
+        self.target = target
+        self.rows = rows
+
+    # source id -> target ids, in link order
+    def load(self, ids):
+        links = defaultdict(list)
+        for source_id, target_id in self.through.objects.filter(**{self.source + '__in': ids}) \
+                .order_by('id').values_list(self.source, self.target):
+            links[source_id].append(target_id)
+        return links
+
+
+class RowSerializer:
+    model = None
+    # field name -> Column, ForeignKey or ManyToMany, in output order
+    fields = {}
+    # fields only rendered when asked for with ?fields=
+    optional = ()
+    default_expand = ()
+
+    def __init__(self, request=None, fields=None, expand=None):
+        self.request = request
+        self.selected = list(fields) if fields is not None else \
+            [name for name in self.fields if name not in self.optional]
+        self.expand = set(expand if expand is not None else self.default_expand)
+
+        unknown = [name for name in self.selected if name not in self.fields]
+        if unknown:
+            raise ValidationError({'fields': ['Unknown field: %s' % ', '.join(unknown)]})
+        unknown = [name for name in self.expand if getattr(self.fields.get(name), 'rows', None) is None]
+        if unknown:
+            raise ValidationError({'expand': ['Cannot expand: %s' % ', '.join(unknown)]})
+
+    @classmethod
+    def from_request(cls, request):
+        return cls(request, fields=split_param(request, 'fields'), expand=split_param(request, 'expand'))
+
+    def columns(self):
+        columns = ['id']
+        for name in self.selected:
+            spec = self.fields[name]
+            if isinstance(spec, (Column, ForeignKey)) and spec.column not in columns:
+                columns.append(spec.column)
+        return columns
+
+    # narrow a queryset to the columns of the selected fields, extra keeps the columns it is ordered by
+    def prepare(self, queryset):
+        extra = [ordering.lstrip('-') for ordering in queryset.query.order_by if isinstance(ordering, str)]
+        columns = self.columns() + [column for column in extra if column not in self.columns()]
+        return queryset.select_related(None).prefetch_related(None).values(*columns)
+
+    def render(self, rows):
+        rows = list(rows)
+        ids = [row['id'] for row in rows]
+
+        related = {}
+        for name in self.selected:
+            spec = self.fields[name]
+            if isinstance(spec, ManyToMany):
+                links = spec.load(ids)
+                objects = self.nested(spec, name, {target for targets in links.values() for target in targets})
+                related[name] = (links, objects)
+            elif isinstance(spec, ForeignKey):
+                related[name] = self.nested(spec, name, {row[spec.column] for row in rows} - {None})
+
+        output = []
+        for row in rows:
+            item = {}
+            for name in self.selected:
+                spec = self.fields[name]
+                if isinstance(spec, Column):
+                    value = row[spec.column]
+                    item[name] = spec.render(value, self.request) if spec.render else value
+                elif isinstance(spec, ForeignKey):
+                    value = row[spec.column]
+                    objects = related[name]
+                    item[name] = value if objects is None or value is None else objects.get(value)
+                else:
+                    links, objects = related[name]
+                    targets = links.get(row['id'], [])
+                    item[name] = targets if objects is None else [objects[t] for t in targets if t in objects]
+            output.append(item)
+        return output
+
+    # id -> rendered related object for expanded fields, None when the field renders ids
+    def nested(self, spec, name, ids):
+        if name not in self.expand:
+            return None
+        if not ids:
+            return {}
+        rows = spec.rows(self.request)
+        values = list(rows.model.objects.filter(id__in=ids).values(*rows.columns()))
+        return {row['id']: item for row, item in zip(values, rows.render(values))}
+
+
+def split_param(request, name):
+    if name not in request.query_params:
+        return None
+    return [value.strip() for value in request.query_params[name].split(',') if value.strip()]
+
+
+class ArtistRowSerializer(RowSerializer):
+    model = Artist
+    fields = {
+        'id': Column('id'),
+        'name': Column('name'),
+        'collection': Column('collection_id'),
+        'thumbnail_src': Column('thumbnail_src', file_renderer(Artist, 'thumbnail_src')),
+        'track_count': Column('track_count'),
+        'length': Column('length', render_duration),
+        'formats': Column('formats'),
+        'date_updated': Column('date_updated', render_datetime),
+    }
+
+
+class AlbumRowSerializer(RowSerializer):
+    model = Album
+    fields = {
+        'id': Column('id'),
+        'name': Column('name'),
+        'length': Column('length', render_duration),
+        'artists': ManyToMany(Album.artists.through, 'album_id', 'artist_id', ArtistRowSerializer),
+        'collection': Column('collection_id'),
+        'thumbnail_src': Column('thumbnail_src', file_renderer(Album, 'thumbnail_src')),
+        'track_count': Column('track_count'),
+        'formats': Column('formats'),
+        'date_updated': Column('date_updated', render_datetime),
+    }
+
+
+class GenreRowSerializer(RowSerializer):
+    model = Genre
+    fields = {
+        'id': Column('id'),
+        'name': Column('name'),
+        'collection': Column('collection_id'),
+        'thumbnail_src': Column('thumbnail_src', file_renderer(Genre, 'thumbnail_src')),
+        'track_count': Column('track_count'),
+        'length': Column('length', render_duration),
+        'formats': Column('formats'),
+        'date_updated': Column('date_updated', render_datetime),
+    }
+
+
+class PlaylistRowSerializer(RowSerializer):
+    model = Playlist
+    fields = {
+        'id': Column('id'),
+        'name': Column('name'),
+        'collection': Column('collection_id'),
+        'rules': Column('rules'),
+    }
+
+
+class TrackRowSerializer(RowSerializer):
+    model = Track
+    fields = {
+        'id': Column('id'),
+        'date_uploaded': Column('date_uploaded', render_datetime),
+        'name': Column('name'),
+        'file_name': Column('file_name'),
+        'length': Column('length', render_duration),
+        'audio_format': Column('audio_format'),
+        'artists': ManyToMany(Track.artists.through, 'track_id', 'artist_id', ArtistRowSerializer),
+        'album_artist': Column('album_artist'),
+        'album': ForeignKey('album_id', AlbumRowSerializer),
+        'album_track_number': Column('album_track_number'),
+        'genres': ManyToMany(Track.genres.through, 'track_id', 'genre_id', GenreRowSerializer),
+        'lyrics': Column('lyrics'),
+        'year': Column('year'),
+        'collection': Column('collection_id'),
+        'playlists': ManyToMany(Track.playlists.through, 'track_id', 'playlist_id', None),
+        'thumbnail_src': Column('thumbnail_src', file_renderer(Track, 'thumbnail_src')),
+        'content_hash': Column('content_hash'),
+    }
+    optional = ('lyrics',)
+    default_expand = ('artists', 'album', 'genres')
+
+
+# the tracks of a playlist, with the entry id and position of each
+class PlaylistTrackRowSerializer(TrackRowSerializer):
+    fields = {
+        'entry': Column('entry'),
+        'position': Column('position'),
+        **TrackRowSerializer.fields,
+    }
+
+
+# for list routes: filter and paginate a values() queryset, then render the page with row_serializer_class.
+# ndjson and msgpack exports skip pagination and stream the whole list, rendered export_chunk_size rows at a time
+class RowListMixin:
+    row_serializer_class = None
+    renderer_classes = LIST_RENDERERS
+    export_chunk_size = 1000
+
+    def list(self, request, *args, **kwargs):
+        rows = self.row_serializer_class.from_request(request)
+        queryset = rows.prepare(self.filter_queryset(self.get_queryset()))
+        if isinstance(request.accepted_renderer, StreamingRenderer):
+            return stream_response(request, request.accepted_renderer, self.export_chunks(rows, queryset))
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(rows.render(page))
+        return Response(rows.render(queryset))
+
+    def export_chunks(self, rows, queryset):
+        chunk = []
+        for row in queryset.iterator(chunk_size=self.export_chunk_size):
+            chunk.append(row)
+            if len(chunk) == self.export_chunk_size:
+                yield rows.render(chunk)
+                chunk = []
+        if chunk:
+            yield rows.render(chunk)
@@ -0,0 +1,225 @@
+import re
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+
+from django.db.models import IntegerField, Q
+from django.db.models.functions import Cast, Substr
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.timezone import make_aware
+
+from acris.core.models import Track
+
+# The rules of a smart playlist select tracks of its collection, e.g.
+#
+#   genre = Jazz and year < 1970
+#   added in last 30 days and not artist = "Various Artists"
+#   (genre = Rock or genre = Metal) and length > 300
+#
+# A condition is a field, an operator (= != < <= > >= contains) and a value, quoted when it has spaces. Text is
+# compared case insensitively, year by the number its first four characters make (tracks without one never match a
+# year condition, not even a negated one), length is in seconds and added takes a date (2024-01-31) or
+# `in last N days|weeks`. Conditions combine with and, or, not and parentheses. compile_rules turns rules into a
+# function building the Q of the matching tracks, relative dates are resolved when it is called. The Q filters
+# tracks passed through annotate().
+
+TEXT = 'text'
+YEAR = 'year'
+DURATION = 'duration'
+DATE = 'date'
+
+ANNOTATIONS = {
+    'year_number': Cast(Substr('year', 1, 4), IntegerField()),
+}
+
+# field -> (lookup on Track, kind), or for artists and genres (through model, lookup on the through model, kind)
+FIELDS = {
+    'name': ('name', TEXT),
+    'album': ('album__name', TEXT),
+    'album_artist': ('album_artist', TEXT),
+    'artist': (Track.artists.through, 'artist__name', TEXT),
+    'genre': (Track.genres.through, 'genre__name', TEXT),
+    'year': ('year_number', YEAR),
+    'format': ('audio_format', TEXT),
+    'lyrics': ('lyrics', TEXT),
+    'length': ('length', DURATION),
+    'added': ('date_uploaded', DATE),
+}
+
+OPERATORS = {
+    '=': 'iexact',
+    '!=': 'iexact',
+    'contains': 'icontains',
+    '<': 'lt',
+    '<=': 'lte',
+    '>': 'gt',
+    '>=': 'gte',
+}
+
+UNITS = {'day': 1, 'days': 1, 'week': 7, 'weeks': 7}
+
+TOKEN = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|(<=|>=|!=|=|<|>|\(|\))|([^\s()<>=!"\']+))')
+
+
+class RuleError(ValueError):
+    pass
+
+
+# (kind, text) pairs, kind is 'value' for quoted strings and 'word' otherwise
+def tokenize(rules):
+    tokens = []
+    position = 0
+    rules = rules.strip()
+    while position < len(rules):
+        match = TOKEN.match(rules, position)
+        if match is None or match.end() == position:
+            raise RuleError('Unexpected character at %d.' % position)
+        double, single, symbol, word = match.groups()
+        if double is not None or single is not None:
+            tokens.append(('value', re.sub(r'\\(.)', r'\1', double if double is not None else single)))
+        else:
+            tokens.append(('word', symbol or word))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    def __init__(self, rules):
+        self.tokens = tokenize(rules)
+        self.index = 0
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            kind, text = self.tokens[self.index]
+            return text.lower() if kind == 'word' else None
+        return None
+
+    def take(self, expected=None):
+        if self.index >= len(self.tokens):
+            raise RuleError('Unexpected end of rules.')
+        kind, text = self.tokens[self.index]
+        if expected is not None and (kind != 'word' or text.lower() != expected):
+            raise RuleError('Expected %s instead of %s.' % (expected, text))
+        self.index += 1
+        return text
+
+    def parse(self):
+        if not self.tokens:
+            raise RuleError('Rules are empty.')
+        node = self.expression()
+        if self.index < len(self.tokens):
+            raise RuleError('Unexpected %s.' % self.tokens[self.index][1])
+        return node
+
+    def expression(self):
+        nodes = [self.term()]
+        while self.peek() == 'or':
+            self.take()
+            nodes.append(self.term())
+        return ('or', nodes) if len(nodes) > 1 else nodes[0]
+
+    def term(self):
+        nodes = [self.factor()]
+        while self.peek() == 'and':
+            self.take()
+            nodes.append(self.factor())
+        return ('and', nodes) if len(nodes) > 1 else nodes[0]
+
+    def factor(self):
+        if self.peek() == 'not':
+            self.take()
+            return 'not', self.factor()
+        if self.peek() == '(':
+            self.take()
+            node = self.expression()
+            self.take(')')
+            return node
+        return self.condition()
+
+    def condition(self):
+        field = self.take().lower()
+        if field not in FIELDS:
+            raise RuleError('Unknown field %s, expected one of: %s.' % (field, ', '.join(FIELDS)))
+        kind = FIELDS[field][-1]
+
+        if self.peek() == 'in' and kind == DATE:
+            self.take()
+            self.take('last')
+            count = self.take()
+            unit = self.take().lower()
+            if not count.isdigit() or unit not in UNITS:
+                raise RuleError('Expected in last <number> days or weeks.')
+            return 'recent', field, timedelta(days=int(count) * UNITS[unit])
+
+        operator = self.take().lower()
+        if operator not in OPERATORS:
+            raise RuleError('Unknown operator %s, expected one of: %s.' % (operator, ' '.join(OPERATORS)))
+        return 'compare', field, operator, self.value(field, kind, operator)
+
+    def value(self, field, kind, operator):
+        text = self.take()
+        if kind == TEXT:
+            return text
+        if operator == 'contains':
+            raise RuleError('%s cannot be compared with contains.' % field)
+        if kind == YEAR:
+            if not text.isdigit():
+                raise RuleError('%s is compared with a number.' % field)
+            return int(text)
+        if kind == DURATION:
+            try:
+                return timedelta(seconds=float(text))
+            except ValueError:
+                raise RuleError('%s is compared with a number of seconds.' % field)
+        date = parse_date(text)
+        if date is None:
+            raise RuleError('%s is compared with a date like 2024-01-31.' % field)
+        return make_aware(datetime.combine(date, time()))
+
+
+def condition_q(field, lookup_type, value, negate=False):
+    spec = FIELDS[field]
+    if len(spec) == 3:
+        through, lookup, kind = spec
+        q = Q(id__in=through.objects.filter(**{'%s__%s' % (lookup, lookup_type): value}).values('track_id'))
+        return ~q if negate else q
+    lookup, kind = spec
+    if kind != TEXT and lookup_type == 'iexact':
+        lookup_type = 'exact'
+    q = Q(**{'%s__%s' % (lookup, lookup_type): value})
+    if negate:
+        q = ~q
+    if kind == YEAR:
+        q &= Q(year__regex=r'^[0-9]{4}')
+    return q
+
+
+# not is pushed down to the conditions, so a negated year condition still only matches tracks with a year
+def build(node, now, negate=False):
+    if node[0] in ('or', 'and'):
+        q = Q()
+        for child in node[1]:
+            if (node[0] == 'or') != negate:
+                q |= build(child, now, negate)
+            else:
+                q &= build(child, now, negate)
+        return q
+    if node[0] == 'not':
+        return build(node[1], now, not negate)
+    if node[0] == 'recent':
+        return condition_q(node[1], 'gte', now - node[2], negate)
+
+    field, operator, value = node[1:]
+    return condition_q(field, OPERATORS[operator], value, negate=(operator == '!=') != negate)
+
+
+# parse rules once, returns a function of the current time building the Q of the tracks they match. Raises RuleError
+@lru_cache(maxsize=256)
+def compile_rules(rules):
+    node = Parser(rules).parse()
+    return lambda now=None: build(node, now or timezone.now())
+
+
+# the columns rules compare that are computed from a track's fields
+def annotate(tracks):
+    return tracks.annotate(**ANNOTATIONS)
@@ -0,0 +1,178 @@
+import logging
+import os
+import time
+
+from django.core.files.storage import default_storage
+
+import acris.core.deletion as deletion
+import acris.core.importer as importer
+from acris.core.models import LibraryFile, Track
+
+logger = logging.getLogger(__name__)
+
+
+class ScanResult:
+    def __init__(self):
+        self.added = 0
+        self.updated = 0
+        self.removed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.errors = []
+
+    def __str__(self):
+        return 'added {0}, updated {1}, removed {2}, unchanged {3}, failed {4}'.format(
+            self.added, self.updated, self.removed, self.unchanged, self.failed)
+
+
+# yields (path, size, mtime_ns) for every audio file below root
+def walk_library(root):
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and importer.is_audio_file(entry.name):
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime_ns
+        except OSError:
+            logger.warning('could not read library folder', exc_info=True)
+
+
+# scanned tracks point at the master through a symlink in the collection folder, the master is never copied
+def link_file(collection, path):
+    name = default_storage.get_available_name(importer.audio_storage_name(collection, os.path.basename(path)))
+    link = default_storage.path(name)
+    os.makedirs(os.path.dirname(link), exist_ok=True)
+    os.symlink(path, link)
+    return name
+
+
+def add_files(collection, files, result):
+    if not files:
+        return
+
+    names = importer.LibraryNames(collection)
+    stats = {path: (size, mtime_ns) for path, size, mtime_ns in files}
+    batch = []
+    failed = []
+
+    def flush():
+        if not batch:
+            return
+        links = {}
+        for path, record in batch:
+            links[path] = link_file(collection, path)
+        ids = importer.write_tracks(collection, names, [(links[path], record) for path, record in batch])
+        LibraryFile.objects.bulk_create([
+            LibraryFile(collection=collection, path=path, size=stats[path][0], mtime_ns=stats[path][1],
+                        track_id=ids[links[path]])
+            for path, record in batch
+        ])
+        result.added += len(batch)
+        batch.clear()
+
+    for path, record, error in importer.parse_files(list(stats)):
+        if error is not None:
+            result.failed += 1
+            result.errors.append('%s: %s' % (path, error))
+            importer.read_failed(path)
+            failed.append(LibraryFile(collection=collection, path=path, size=stats[path][0],
+                                      mtime_ns=stats[path][1]))
+            continue
+
+        batch.append((path, record))
+        if len(batch) >= importer.BATCH_SIZE:
+            flush()
+    flush()
+
+    LibraryFile.objects.bulk_create(failed)
+
+
+# read changed files again, their tracks are rewritten in batches like new files are written
+def update_files(collection, changed, result):
+    names = importer.LibraryNames(collection)
+    library_files = {library_file.path: library_file for library_file, size, mtime_ns in changed}
+    batch = []
+
+    def flush():
+        if batch:
+            importer.rewrite_tracks(collection, names, batch)
+            result.updated += len(batch)
+            batch.clear()
+
+    for path, record, error in importer.parse_files(list(library_files)):
+        if error is not None:
+            result.failed += 1
+            result.errors.append('%s: %s' % (path, error))
+            importer.read_failed(path)
+            continue
+
+        batch.append((library_files[path].track, record))
+        if len(batch) >= importer.BATCH_SIZE:
+            flush()
+    flush()
+
+    for library_file, size, mtime_ns in changed:
+        library_file.size = size
+        library_file.mtime_ns = mtime_ns
+    LibraryFile.objects.bulk_update([library_file for library_file, size, mtime_ns in changed], ['size', 'mtime_ns'],
+                                    batch_size=importer.BATCH_SIZE)
+
+
+# bring the collection in line with the files below root, only touching new, changed and removed files
+def scan_library(collection, root):
+    root = os.path.realpath(root)
+    result = ScanResult()
+
+    index = {}
+    for file_id, path, size, mtime_ns in LibraryFile.objects.filter(collection=collection) \
+            .filter(path__startswith=os.path.join(root, '')).values_list('id', 'path', 'size', 'mtime_ns'):
+        index[path] = (file_id, size, mtime_ns)
+
+    new_files = []
+    changed = []
+    for path, size, mtime_ns in walk_library(root):
+        entry = index.pop(path, None)
+        if entry is None:
+            new_files.append((path, size, mtime_ns))
+        elif entry[1] != size or entry[2] != mtime_ns:
+            changed.append((entry[0], path, size, mtime_ns))
+        else:
+            result.unchanged += 1
+
+    # anything still in the index is gone from disk
+    if index:
+        removed_ids = [file_id for file_id, size, mtime_ns in index.values()]
+        # the links of the removed tracks are unlinked by acris.core.reaper, the masters are already gone
+        deletion.delete_tracks(collection, Track.objects.filter(libraryfile__id__in=removed_ids)
+                               .values_list('id', flat=True))
+        LibraryFile.objects.filter(id__in=removed_ids).delete()
+        result.removed += len(removed_ids)
+
+    if changed:
+        library_files = LibraryFile.objects.select_related('track', 'track__collection') \
+            .in_bulk([file_id for file_id, path, size, mtime_ns in changed])
+        retry = []
+        updated = []
+        for file_id, path, size, mtime_ns in changed:
+            library_file = library_files[file_id]
+            if library_file.track is None:
+                retry.append(file_id)
+                new_files.append((path, size, mtime_ns))
+            else:
+                updated.append((library_file, size, mtime_ns))
+        LibraryFile.objects.filter(id__in=retry).delete()
+        update_files(collection, updated, result)
+
+    add_files(collection, new_files, result)
+    return result
+
+
+# poll root forever, calling report with the result of every scan
+def watch_library(collection, root, interval, report):
+    while True:
+        report(scan_library(collection, root))
+        time.sleep(interval)
@@ -0,0 +1,276 @@
+import re
+
+from django.db import connection, connections, router, transaction
+from django.db.models import signals
+from django.db.models.expressions import RawSQL
+from django.dispatch import receiver
+from rest_framework import filters
+
+from acris.core.models import Artist, Album, Genre, Track
+from acris.core.signals import bulk_deleting, tracks_imported
+
+TRACK_INDEX = 'core_track_fts'
+ENTITY_INDEX = 'core_entity_fts'
+
+# tokens are matched case and accent insensitively, with prefix indexes for search-as-you-type
+TOKENIZE = "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'"
+
+# the columns of the track index that user terms are matched against, collection only scopes a search
+TRACK_COLUMNS = 'name file_name album artists genres album_artist lyrics'
+
+# bm25 weights per column of the track index: collection, name, file_name, album, artists, genres, album_artist, lyrics
+TRACK_WEIGHTS = '0.0, 10.0, 2.0, 4.0, 5.0, 2.0, 3.0, 1.0'
+
+# album, artist and genre rows share one index, the kind is encoded in the low bits of the rowid
+ENTITY_KINDS = {Album: 1, Artist: 2, Genre: 3}
+
+BATCH_SIZE = 500
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+_index_created = False
+
+
+# the index is sqlite only, other databases fall back to plain filtering
+def enabled():
+    if connection.vendor != 'sqlite':
+        return False
+    if not _index_created:
+        create_index()
+    return True
+
+
+def create_index():
+    global _index_created
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5('
+                       'collection, name, file_name, album, artists, genres, album_artist, lyrics, {1})'
+                       .format(TRACK_INDEX, TOKENIZE))
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5(collection, name, {1})'
+                       .format(ENTITY_INDEX, TOKENIZE))
+    _index_created = True
+
+
+# turn user input into an fts5 query where every word is a quoted prefix term
+def build_query(text):
+    terms = TERM_RE.findall(text or '')
+    return ' AND '.join('"%s"*' % term for term in terms)
+
+
+# the fts5 query of the tracks matching user input, with the terms kept out of the collection column
+def build_track_query(text):
+    query = build_query(text)
+    return '{%s} : (%s)' % (TRACK_COLUMNS, query) if query else ''
+
+
+def chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        yield ids[i:i + BATCH_SIZE]
+
+
+def index_tracks(track_ids):
+    if not enabled():
+        return
+
+    track_table = Track._meta.db_table
+    album_table = Album._meta.db_table
+    artist_table = Artist._meta.db_table
+    genre_table = Genre._meta.db_table
+    track_artists = Track.artists.through._meta.db_table
+    track_genres = Track.genres.through._meta.db_table
+
+    with connection.cursor() as cursor:
+        for batch in chunks(track_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(TRACK_INDEX, placeholders), batch)
+            cursor.execute(
+                'INSERT INTO {index}'
+                '(rowid, collection, name, file_name, album, artists, genres, album_artist, lyrics) '
+                'SELECT t.id, \'c\' || t.collection_id, t.name, t.file_name, COALESCE(al.name, \'\'), '
+                '  COALESCE((SELECT group_concat(ar.name, \' \') FROM {track_artists} ta '
+                '            JOIN {artist} ar ON ar.id = ta.artist_id WHERE ta.track_id = t.id), \'\'), '
+                '  COALESCE((SELECT group_concat(g.name, \' \') FROM {track_genres} tg '
+                '            JOIN {genre} g ON g.id = tg.genre_id WHERE tg.track_id = t.id), \'\'), '
+                '  t.album_artist, t.lyrics '
+                'FROM {track} t LEFT JOIN {album} al ON al.id = t.album_id '
+                'WHERE t.id IN ({placeholders})'.format(index=TRACK_INDEX, track=track_table, album=album_table,
+                                                        artist=artist_table, genre=genre_table,
+                                                        track_artists=track_artists, track_genres=track_genres,
+                                                        placeholders=placeholders),
+                batch)
+
+
+def unindex_tracks(track_ids):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        for batch in chunks(track_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(TRACK_INDEX, placeholders), batch)
+
+
+def index_entities(model, entity_ids):
+    if not enabled():
+        return
+    kind = ENTITY_KINDS[model]
+    with connection.cursor() as cursor:
+        for batch in chunks(entity_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(ENTITY_INDEX, placeholders),
+                           [entity_id * 4 + kind for entity_id in batch])
+            cursor.execute('INSERT INTO {0}(rowid, collection, name) '
+                           'SELECT id * 4 + {1}, \'c\' || collection_id, name FROM {2} WHERE id IN ({3})'
+                           .format(ENTITY_INDEX, kind, model._meta.db_table, placeholders), batch)
+
+
+def unindex_entity(model, entity_id):
+    if not enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {0} WHERE rowid = %s'.format(ENTITY_INDEX),
+                       [entity_id * 4 + ENTITY_KINDS[model]])
+
+
+def unindex_entities(model, entity_ids):
+    if not enabled():
+        return
+    kind = ENTITY_KINDS[model]
+    with connection.cursor() as cursor:
+        for batch in chunks(entity_ids):
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute('DELETE FROM {0} WHERE rowid IN ({1})'.format(ENTITY_INDEX, placeholders),
+                           [entity_id * 4 + kind for entity_id in batch])
+
+
+def rebuild_index():
+    create_index()
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {0}'.format(TRACK_INDEX))
+        cursor.execute('DELETE FROM {0}'.format(ENTITY_INDEX))
+    index_tracks(Track.objects.values_list('id', flat=True))
+    for model in ENTITY_KINDS:
+        index_entities(model, model.objects.values_list('id', flat=True))
+
+
+# ranked track ids in a collection, best match first
+def search_tracks(collection_id, text, limit):
+    query = build_track_query(text)
+    if not query:
+        return []
+    with connections[router.db_for_read(Track)].cursor() as cursor:
+        cursor.execute('SELECT rowid FROM {0} WHERE {0} MATCH %s ORDER BY bm25({0}, {1}) LIMIT %s'
+                       .format(TRACK_INDEX, TRACK_WEIGHTS),
+                       ['collection : "c%d" AND %s' % (int(collection_id), query), limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_entities(model, collection_id, text, limit):
+    query = build_query(text)
+    if not query:
+        return []
+    with connections[router.db_for_read(Track)].cursor() as cursor:
+        cursor.execute('SELECT rowid FROM {0} WHERE {0} MATCH %s AND rowid %% 4 = %s ORDER BY rank LIMIT %s'
+                       .format(ENTITY_INDEX),
+                       ['collection : "c%d" AND name : (%s)' % (int(collection_id), query), ENTITY_KINDS[model],
+                        limit])
+        return [row[0] // 4 for row in cursor.fetchall()]
+
+
+# restrict a track queryset to rows matching the search text, for use as a filter backend
+def filter_tracks(queryset, text):
+    query = build_track_query(text)
+    if not query:
+        return queryset
+    if not enabled():
+        return queryset.filter(name__icontains=text)
+    return queryset.filter(id__in=RawSQL('SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(TRACK_INDEX), [query]))
+
+
+# drop-in replacement for SearchFilter on track lists that answers ?search= from the index
+class FullTextSearchFilter(filters.SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        return filter_tracks(queryset, request.query_params.get(self.search_param, ''))
+
+
+# ~~~ Index maintenance ~~~
+
+@receiver(signals.post_migrate)
+def create_index_after_migrate(sender, using, **kwargs):
+    if sender.name == 'acris.core' and connection.vendor == 'sqlite':
+        create_index()
+
+
+@receiver(signals.post_save, sender=Track)
+def index_track_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_tracks([instance.id])
+
+
+@receiver(signals.post_delete, sender=Track)
+def unindex_track_on_delete(sender, instance, **kwargs):
+    unindex_tracks([instance.id])
+
+
+@receiver(signals.m2m_changed, sender=Track.artists.through)
+@receiver(signals.m2m_changed, sender=Track.genres.through)
+def index_track_on_relation_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        index_tracks([instance.id])
+    elif pk_set:
+        index_tracks(pk_set)
+
+
+@receiver(signals.post_save, sender=Album)
+@receiver(signals.post_save, sender=Artist)
+@receiver(signals.post_save, sender=Genre)
+def index_entity_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    index_entities(sender, [instance.id])
+
+    # a renamed entity changes the text of every track linked to it
+    if not created:
+        index_tracks(instance.track_set.values_list('id', flat=True))
+
+
+@receiver(signals.pre_delete, sender=Artist)
+@receiver(signals.pre_delete, sender=Genre)
+def remember_tracks_on_entity_delete(sender, instance, **kwargs):
+    instance.search_track_ids = list(instance.track_set.values_list('id', flat=True))
+
+
+@receiver(signals.post_delete, sender=Album)
+@receiver(signals.post_delete, sender=Artist)
+@receiver(signals.post_delete, sender=Genre)
+def unindex_entity_on_delete(sender, instance, **kwargs):
+    unindex_entity(sender, instance.id)
+    track_ids = getattr(instance, 'search_track_ids', None)
+    if track_ids:
+        transaction.on_commit(lambda: index_tracks(track_ids))
+
+
+@receiver(bulk_deleting, sender=Track)
+def unindex_tracks_on_bulk_delete(sender, ids, **kwargs):
+    unindex_tracks(ids)
+
+
+@receiver(bulk_deleting, sender=Album)
+@receiver(bulk_deleting, sender=Artist)
+@receiver(bulk_deleting, sender=Genre)
+def unindex_entities_on_bulk_delete(sender, ids, **kwargs):
+    unindex_entities(sender, ids)
+
+
+@receiver(tracks_imported)
+def index_imported_tracks(sender, collection, track_ids, **kwargs):
+    index_tracks(track_ids)
+    tracks = Track.objects.filter(id__in=track_ids)
+    index_entities(Album, set(tracks.exclude(album=None).values_list('album_id', flat=True)))
+    index_entities(Artist, set(Track.artists.through.objects.filter(track_id__in=track_ids)
+                               .values_list('artist_id', flat=True)))
+    index_entities(Genre, set(Track.genres.through.objects.filter(track_id__in=track_ids)
+                              .values_list('genre_id', flat=True)))
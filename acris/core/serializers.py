@@ -1,6 +1,8 @@
 from rest_framework import serializers
 
-from acris.core.models import AcrisUser, Collection, Artist, Playlist, Album, Genre, Track
+from acris.core.models import AcrisUser, Collection, Artist, Playlist, PlaylistEntry, Album, Genre, Track, \
+    IngestJob
+from acris.core.rules import RuleError, compile_rules
 
 
 class AcrisUserSerializer(serializers.ModelSerializer):
@@ -16,7 +18,7 @@ class CollectionViewSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Collection
-        fields = ['id', 'name', 'is_public', 'owners', 'viewers']
+        fields = ['id', 'name', 'is_public', 'owners', 'viewers', 'track_count', 'length', 'formats', 'date_updated']
 
 
 class CollectionSerializer(serializers.ModelSerializer):
@@ -39,25 +41,41 @@ class CollectionSerializer(serializers.ModelSerializer):
 class PlaylistSerializer(serializers.ModelSerializer):
     class Meta:
         model = Playlist
-        fields = ['name', 'collection']
+        fields = ['id', 'name', 'collection', 'date_created', 'rules']
+        read_only_fields = ['collection', 'date_created']
+
+    def validate_rules(self, value):
+        if value:
+            try:
+                compile_rules(value)
+            except RuleError as e:
+                raise serializers.ValidationError(str(e))
+        return value
+
+
+class PlaylistEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PlaylistEntry
+        fields = ['id', 'track', 'position']
 
 
 class ArtistSerializer(serializers.ModelSerializer):
     class Meta:
         model = Artist
-        fields = ['id', 'name', 'collection', 'thumbnail_src']
+        fields = ['id', 'name', 'collection', 'thumbnail_src', 'track_count', 'length', 'formats', 'date_updated']
 
 
 class AlbumSerializer(serializers.ModelSerializer):
     class Meta:
         model = Album
-        fields = ['id', 'name', 'length', 'artists', 'collection', 'thumbnail_src']
+        fields = ['id', 'name', 'length', 'artists', 'collection', 'thumbnail_src', 'track_count', 'formats',
+                  'date_updated']
 
 
 class GenreSerializer(serializers.ModelSerializer):
     class Meta:
         model = Genre
-        fields = ['id', 'name', 'collection', 'thumbnail_src']
+        fields = ['id', 'name', 'collection', 'thumbnail_src', 'track_count', 'length', 'formats', 'date_updated']
 
 
 class TrackSerializer(serializers.ModelSerializer):
@@ -78,11 +96,24 @@ class TrackSerializer(serializers.ModelSerializer):
                   'album',
                   'album_track_number',
                   'genres',
-                  'lyrics',
                   'year',
                   'collection',
                   'playlists',
-                  'thumbnail_src']
+                  'thumbnail_src',
+                  'content_hash']
+
+
+class TrackLyricsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Track
+        fields = ['id', 'lyrics']
+
+
+class IngestJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = IngestJob
+        fields = ['id', 'kind', 'status', 'total', 'processed', 'failed', 'duplicates', 'error', 'collection',
+                  'track', 'date_created', 'date_finished']
 
 
 class FileUploadSerializer(serializers.Serializer):
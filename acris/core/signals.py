@@ -0,0 +1,17 @@
+from django.dispatch import Signal
+
+# sent with collection and track_ids after tracks were written in bulk, bypassing Track.save()
+tracks_imported = Signal()
+
+# sent with collection and track_ids before tracks read again are rewritten in bulk, while the database still has
+# their old values. tracks_imported follows once the new ones are written
+tracks_rewriting = Signal()
+
+# sent with collection and ids before rows of sender are deleted in bulk by acris.core.deletion, bypassing delete()
+bulk_deleting = Signal()
+
+# sent with collection_id whenever the version of a collection is bumped
+collection_changed = Signal()
+
+# sent once the transaction that queued FileDeletion rows has committed
+file_deletions_queued = Signal()
@@ -0,0 +1,87 @@
+import threading
+
+from django.db import OperationalError
+from django.db.backends.sqlite3 import base
+
+# The sqlite3 backend with the settings a server needs:
+#
+#   - the pragmas below on every connection, WAL lets readers carry on while a write is in progress and
+#     busy_timeout makes writers wait for each other instead of failing with "database is locked"
+#   - OPTIONS 'pragmas' overrides them per database, OPTIONS 'read_only' opens a connection that refuses writes
+#   - transactions start with BEGIN IMMEDIATE, taking the write lock up front. A deferred transaction that reads
+#     first and writes later cannot wait for the lock and fails right away when another write got in between
+#   - write transactions of one process queue on a lock of their own, in order, rather than polling sqlite
+
+PRAGMAS = {
+    'journal_mode': 'wal',
+    # in WAL mode a power loss can only lose the last transactions, not corrupt the database
+    'synchronous': 'normal',
+    'busy_timeout': 20000,
+    # negative sizes are in KiB
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 ** 2,
+    'temp_store': 'memory',
+}
+
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def write_lock(name):
+    with _write_locks_lock:
+        return _write_locks.setdefault(name, threading.Lock())
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    holds_write_lock = False
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        self.read_only = params.pop('read_only', False)
+        self.pragmas = dict(PRAGMAS, **params.pop('pragmas', {}))
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            conn.execute('PRAGMA %s = %s' % (pragma, value))
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.read_only:
+            super()._start_transaction_under_autocommit()
+            return
+
+        if not write_lock(self.settings_dict['NAME']).acquire(timeout=self.pragmas['busy_timeout'] / 1000):
+            raise OperationalError('database is locked')
+        self.holds_write_lock = True
+        try:
+            self.cursor().execute('BEGIN IMMEDIATE')
+        except Exception:
+            self.release_write_lock()
+            raise
+
+    def release_write_lock(self):
+        if self.holds_write_lock:
+            self.holds_write_lock = False
+            write_lock(self.settings_dict['NAME']).release()
+
+    def _commit(self):
+        try:
+            return super()._commit()
+        finally:
+            self.release_write_lock()
+
+    def _rollback(self):
+        try:
+            return super()._rollback()
+        finally:
+            self.release_write_lock()
+
+    def _close(self):
+        try:
+            return super()._close()
+        finally:
+            self.release_write_lock()
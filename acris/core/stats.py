@@ -0,0 +1,240 @@
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Sum, signals
+from django.dispatch import receiver
+from django.utils.timezone import make_aware
+
+from acris.core.models import Collection, Artist, Album, Genre, Track, Change, is_deleting, record_changes
+from acris.core.signals import bulk_deleting, tracks_imported, tracks_rewriting
+
+# Track count, total length and format breakdown are kept on collections, albums, artists and genres.
+# They are adjusted by deltas as tracks are saved, linked and deleted, recompute() rebuilds them from scratch.
+
+STATS_MODELS = (Collection, Album, Artist, Genre)
+
+
+class Delta:
+    def __init__(self):
+        self.count = 0
+        self.length = timedelta(0)
+        self.formats = Counter()
+
+    def add(self, sign, count, length, formats):
+        self.count += sign * count
+        self.length += sign * (length or timedelta(0))
+        for audio_format, n in formats.items():
+            self.formats[audio_format] += sign * n
+
+    def __bool__(self):
+        return bool(self.count or self.length or any(self.formats.values()))
+
+
+# deltas for the entities of one collection, the albums, artists and genres they change are logged as updated
+class Deltas(defaultdict):
+    def __init__(self, collection_id):
+        super().__init__(Delta)
+        self.collection_id = collection_id
+
+    def track(self, model, entity_id, sign, length, audio_format):
+        if entity_id is not None:
+            self[(model, entity_id)].add(sign, 1, length, {audio_format: 1})
+
+    def apply(self):
+        now = make_aware(datetime.now())
+        changes = []
+        with transaction.atomic():
+            for (model, entity_id), delta in self.items():
+                if not delta:
+                    continue
+
+                current = model.objects.filter(id=entity_id).values_list('formats', flat=True).first()
+                if current is None:
+                    continue
+                formats = Counter(current)
+                formats.update(delta.formats)
+
+                model.objects.filter(id=entity_id).update(
+                    track_count=F('track_count') + delta.count,
+                    length=F('length') + delta.length,
+                    formats={audio_format: n for audio_format, n in formats.items() if n > 0},
+                    date_updated=now)
+                if model is not Collection:
+                    changes.append((model._meta.model_name, entity_id, Change.UPDATE))
+
+            if changes:
+                record_changes(self.collection_id, changes)
+
+
+def track_relations(track_id):
+    artist_ids = Track.artists.through.objects.filter(track_id=track_id).values_list('artist_id', flat=True)
+    genre_ids = Track.genres.through.objects.filter(track_id=track_id).values_list('genre_id', flat=True)
+    return [(Artist, artist_id) for artist_id in artist_ids] + [(Genre, genre_id) for genre_id in genre_ids]
+
+
+# (model, rows of (entity id, format, track count, total length)) for a set of tracks and their links
+def grouped_totals(tracks, artist_links, genre_links):
+    return [
+        (Collection, tracks.values_list('collection_id', 'audio_format')
+         .annotate(count=Count('id'), length=Sum('length'))),
+        (Album, tracks.exclude(album=None).values_list('album_id', 'audio_format')
+         .annotate(count=Count('id'), length=Sum('length'))),
+        (Artist, artist_links.values_list('artist_id', 'track__audio_format')
+         .annotate(count=Count('id'), length=Sum('track__length'))),
+        (Genre, genre_links.values_list('genre_id', 'track__audio_format')
+         .annotate(count=Count('id'), length=Sum('track__length'))),
+    ]
+
+
+# rebuild every aggregate, optionally for one collection only
+def recompute(collection=None):
+    tracks = Track.objects.all()
+    artist_links = Track.artists.through.objects.all()
+    genre_links = Track.genres.through.objects.all()
+    entities = {model: model.objects.all() for model in STATS_MODELS}
+    if collection is not None:
+        tracks = tracks.filter(collection=collection)
+        artist_links = artist_links.filter(track__collection=collection)
+        genre_links = genre_links.filter(track__collection=collection)
+        entities[Collection] = entities[Collection].filter(id=collection.id)
+        for model in (Album, Artist, Genre):
+            entities[model] = entities[model].filter(collection=collection)
+
+    now = make_aware(datetime.now())
+    changes = defaultdict(list)
+    with transaction.atomic():
+        for model, rows in grouped_totals(tracks, artist_links, genre_links):
+            totals = defaultdict(Delta)
+            for entity_id, audio_format, count, length in rows:
+                totals[entity_id].add(1, count, length, {audio_format: count})
+
+            objects = list(entities[model])
+            for obj in objects:
+                delta = totals.get(obj.id, Delta())
+                if (obj.track_count, obj.length, obj.formats) != (delta.count, delta.length, dict(delta.formats)):
+                    collection_changes = changes[obj.id if model is Collection else obj.collection_id]
+                    if model is not Collection:
+                        collection_changes.append((model._meta.model_name, obj.id, Change.UPDATE))
+                obj.track_count = delta.count
+                obj.length = delta.length
+                obj.formats = dict(delta.formats)
+                obj.date_updated = now
+            model.objects.bulk_update(objects, ['track_count', 'length', 'formats', 'date_updated'], batch_size=500)
+
+        # only collections whose numbers were off get a new version
+        for collection_id, entity_changes in changes.items():
+            record_changes(collection_id, entity_changes)
+
+
+# ~~~ Incremental maintenance ~~~
+
+@receiver(signals.pre_save, sender=Track)
+def remember_track_stats(sender, instance, raw=False, **kwargs):
+    instance.stats_previous = None
+    if instance.pk and not raw:
+        instance.stats_previous = Track.objects.filter(pk=instance.pk) \
+            .values_list('length', 'audio_format', 'album_id').first()
+
+
+@receiver(signals.post_save, sender=Track)
+def update_stats_on_track_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    deltas = Deltas(instance.collection_id)
+    previous = getattr(instance, 'stats_previous', None)
+    current = (instance.length, instance.audio_format, instance.album_id)
+
+    if created or previous is None:
+        deltas.track(Collection, instance.collection_id, 1, instance.length, instance.audio_format)
+        deltas.track(Album, instance.album_id, 1, instance.length, instance.audio_format)
+    elif previous != current:
+        old_length, old_format, old_album_id = previous
+        entities = [(Collection, instance.collection_id)] + track_relations(instance.pk)
+        for model, entity_id in entities:
+            deltas.track(model, entity_id, -1, old_length, old_format)
+            deltas.track(model, entity_id, 1, instance.length, instance.audio_format)
+        deltas.track(Album, old_album_id, -1, old_length, old_format)
+        deltas.track(Album, instance.album_id, 1, instance.length, instance.audio_format)
+
+    deltas.apply()
+
+
+@receiver(signals.m2m_changed, sender=Track.artists.through)
+@receiver(signals.m2m_changed, sender=Track.genres.through)
+def update_stats_on_relation_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    entity_model = Artist if sender is Track.artists.through else Genre
+    entity_field = 'artist_id' if entity_model is Artist else 'genre_id'
+
+    # the cleared ids are gone by post_clear, remember them first
+    if action == 'pre_clear':
+        if reverse:
+            instance.stats_cleared = set(sender.objects.filter(**{entity_field: instance.pk})
+                                         .values_list('track_id', flat=True))
+        else:
+            instance.stats_cleared = set(sender.objects.filter(track_id=instance.pk)
+                                         .values_list(entity_field, flat=True))
+        return
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    sign = 1 if action == 'post_add' else -1
+    ids = getattr(instance, 'stats_cleared', set()) if action == 'post_clear' else pk_set
+    if not ids:
+        return
+
+    # contributions follow the saved row, unsaved changes on the instance are picked up by its next save
+    deltas = Deltas(instance.collection_id)
+    if reverse:
+        for length, audio_format in Track.objects.filter(id__in=ids).values_list('length', 'audio_format'):
+            deltas.track(entity_model, instance.pk, sign, length, audio_format)
+    else:
+        saved = Track.objects.filter(pk=instance.pk).values_list('length', 'audio_format').first()
+        if saved is None:
+            return
+        for entity_id in ids:
+            deltas.track(entity_model, entity_id, sign, *saved)
+    deltas.apply()
+
+
+@receiver(signals.pre_delete, sender=Track)
+def update_stats_on_track_delete(sender, instance, **kwargs):
+    deltas = Deltas(instance.collection_id)
+    for model, entity_id in [(Collection, instance.collection_id), (Album, instance.album_id)] + \
+            track_relations(instance.pk):
+        deltas.track(model, entity_id, -1, instance.length, instance.audio_format)
+    deltas.apply()
+
+
+# add or take out what a set of tracks and their links contribute, in a few grouped queries
+def apply_track_totals(collection, track_ids, sign):
+    groups = grouped_totals(Track.objects.filter(id__in=track_ids),
+                            Track.artists.through.objects.filter(track_id__in=track_ids),
+                            Track.genres.through.objects.filter(track_id__in=track_ids))
+
+    deltas = Deltas(collection.id)
+    for model, rows in groups:
+        for entity_id, audio_format, count, length in rows:
+            deltas[(model, entity_id)].add(sign, count, length, {audio_format: count})
+    deltas.apply()
+
+
+@receiver(tracks_imported)
+def update_stats_on_import(sender, collection, track_ids, **kwargs):
+    apply_track_totals(collection, track_ids, 1)
+
+
+# the rewritten values are added back by update_stats_on_import
+@receiver(tracks_rewriting)
+def update_stats_on_rewrite(sender, collection, track_ids, **kwargs):
+    apply_track_totals(collection, track_ids, -1)
+
+
+@receiver(bulk_deleting, sender=Track)
+def update_stats_on_bulk_delete(sender, collection, ids, **kwargs):
+    # nothing to keep up to date in a collection that is going away
+    if is_deleting(collection.id):
+        return
+    apply_track_totals(collection, ids, -1)
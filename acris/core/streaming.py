@@ -0,0 +1,211 @@
+import os
+import re
+import uuid
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+import acris.core.metrics as metrics
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# more ranges than this in one request is treated as abuse and answered with the full file
+MAX_RANGES = 16
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def file_etag(stat):
+    return '"{0:x}-{1:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+# parse a Range header into a sorted list of coalesced (start, end) byte ranges, both inclusive
+# returns None if the header is absent or malformed, in which case the full file should be sent
+def parse_range_header(header, size):
+    if not header:
+        return None
+
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = RANGE_SPEC_RE.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+
+        if first == '' and last == '':
+            return None
+
+        if first == '':
+            # suffix range, the last n bytes of the file
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = size - 1 if last == '' else min(int(last), size - 1)
+            if last != '' and int(last) < start:
+                return None
+
+        if start >= size or start > end:
+            continue
+        ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+# If-Range only allows a partial response when the validator matches the current file exactly
+def if_range_matches(header, etag, mtime):
+    if header is None:
+        return True
+    header = header.strip()
+    if header.startswith('W/'):
+        return False
+    if header.startswith('"'):
+        return header == etag
+    date = parse_http_date_safe(header)
+    return date is not None and date == int(mtime)
+
+
+def iter_file_range(file, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    try:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = file.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def multipart_parts(ranges, size, content_type, boundary):
+    parts = []
+    for start, end in ranges:
+        header = ('\r\n--{0}\r\n'
+                  'Content-Type: {1}\r\n'
+                  'Content-Range: bytes {2}-{3}/{4}\r\n\r\n').format(boundary, content_type, start, end, size)
+        parts.append((header.encode('ascii'), start, end))
+    closing = '\r\n--{0}--\r\n'.format(boundary).encode('ascii')
+    return parts, closing
+
+
+def iter_multipart_ranges(path, parts, closing, chunk_size=STREAM_CHUNK_SIZE):
+    with open(path, 'rb') as file:
+        for header, start, end in parts:
+            yield header
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = file.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        yield closing
+
+
+# what to send for a file on disk: status, headers and the parts of the body as (prefix, start, end) byte ranges,
+# followed by closing. Responses carry it as file_plan so acris.core.asgi can send the body without a thread
+class FilePlan:
+    def __init__(self, path, status, headers, parts=(), closing=b''):
+        self.path = path
+        self.status = status
+        self.headers = headers
+        self.parts = parts
+        self.closing = closing
+
+
+# honour Range and If-Range for a file on disk
+def plan_file_response(meta, path, content_type):
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(stat)
+
+    try:
+        ranges = parse_range_header(meta.get('HTTP_RANGE'), size)
+    except RangeNotSatisfiable:
+        return FilePlan(path, 416, {'Content-Range': 'bytes */%d' % size, 'Accept-Ranges': 'bytes'})
+
+    if ranges is not None and not if_range_matches(meta.get('HTTP_IF_RANGE'), etag, stat.st_mtime):
+        ranges = None
+
+    headers = {'Content-Type': content_type}
+    if ranges is None:
+        plan = FilePlan(path, 200, headers, [(b'', 0, size - 1)] if size else [])
+        headers['Content-Length'] = size
+
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        plan = FilePlan(path, 206, headers, [(b'', start, end)])
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        headers['Content-Length'] = end - start + 1
+
+    else:
+        boundary = uuid.uuid4().hex
+        parts, closing = multipart_parts(ranges, size, content_type, boundary)
+        plan = FilePlan(path, 206, headers, parts, closing)
+        headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        headers['Content-Length'] = sum(len(header) + end - start + 1 for header, start, end in parts) + len(closing)
+
+    headers['Accept-Ranges'] = 'bytes'
+    headers['ETag'] = etag
+    headers['Last-Modified'] = http_date(stat.st_mtime)
+    return plan
+
+
+# build a response for a file on disk honouring Range and If-Range
+# whole-file responses go through FileResponse so the server can use wsgi.file_wrapper / sendfile,
+# partial responses are streamed in fixed size chunks so memory per stream stays flat
+def file_response(request, path, content_type):
+    plan = plan_file_response(request.META, path, content_type)
+    # HEAD requests send no body and are not counted as streams
+    account = None
+    if plan.status != 416 and request.method != 'HEAD':
+        account = metrics.StreamAccount(plan.status)
+
+    if plan.status == 416:
+        response = HttpResponse(status=416)
+    elif plan.status == 200:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        if account is not None:
+            account.expected = plan.headers['Content-Length']
+    else:
+        if len(plan.parts) == 1:
+            prefix, start, end = plan.parts[0]
+            chunks = iter_file_range(open(path, 'rb'), start, end)
+        else:
+            chunks = iter_multipart_ranges(path, plan.parts, plan.closing)
+        response = StreamingHttpResponse(account.counted(chunks) if account is not None else chunks, status=206)
+
+    for header, value in plan.headers.items():
+        response[header] = value
+    response.file_plan = plan
+    if account is not None:
+        response.stream_account = account
+        response._resource_closers.append(account.finish)
+    return response
@@ -0,0 +1,268 @@
+import base64
+import io
+import random
+import struct
+
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import ID3, APIC, TALB, TCON, TDRC, TIT2, TPE1, TPE2, TRCK, USLT
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+from PIL import Image
+
+# Synthetic libraries for benchmarks: a seeded description of artists, albums and tracks, tiny audio files carrying
+# those tags and covers (FLAC, MP3, Ogg Vorbis, MP4), and track records for filling the database without files.
+# The same seed always gives the same library.
+
+WORDS = ['night', 'river', 'glass', 'echo', 'paper', 'static', 'golden', 'velvet', 'hollow', 'summer', 'neon',
+         'silver', 'distant', 'quiet', 'broken', 'electric', 'northern', 'ghost', 'wild', 'ocean', 'stone', 'lights',
+         'garden', 'signal', 'winter', 'harbor', 'machine', 'fever', 'crystal', 'shadow', 'morning', 'city', 'dream',
+         'fire', 'satellite', 'honey', 'mirror', 'thunder', 'violet', 'parade', 'empire', 'lantern', 'atlas', 'bloom']
+GENRES = ['Rock', 'Pop', 'Jazz', 'Electronic', 'Hip-Hop', 'Classical', 'Folk', 'Ambient', 'Metal', 'Soul', 'Blues',
+          'Indie', 'Punk', 'Reggae', 'Country', 'Techno']
+FORMATS = ('flac', 'mp3', 'ogg', 'm4a')
+MIME_TYPES = {'flac': 'audio/flac', 'mp3': 'audio/mpeg', 'ogg': 'audio/ogg', 'm4a': 'audio/mp4'}
+
+
+def phrase(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).title()
+
+
+# track descriptions: artists with albums of tracks, each album with a year, a genre and a cover colour
+def library(seed, count, tracks_per_album=10, albums_per_artist=3):
+    rng = random.Random(seed)
+    tracks = []
+    artist_number = 0
+    while len(tracks) < count:
+        artist_number += 1
+        artist = '%s %d' % (phrase(rng, 1, 3), artist_number)
+        for _ in range(albums_per_artist):
+            album = phrase(rng, 1, 4)
+            year = rng.randint(1960, 2024)
+            genres = rng.sample(GENRES, rng.randint(1, 2))
+            colour = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            for number in range(1, tracks_per_album + 1):
+                featured = [artist] + (['%s %d' % (phrase(rng, 1, 2), rng.randint(1, 999))]
+                                       if rng.random() < 0.1 else [])
+                tracks.append({
+                    'name': phrase(rng, 1, 5),
+                    'artists': featured,
+                    'album_artist': artist,
+                    'album': album,
+                    'album_track_number': number,
+                    'genres': genres,
+                    'year': year,
+                    'length': rng.randint(90, 420),
+                    'lyrics': '\n'.join(phrase(rng, 3, 7) for _ in range(8)) if rng.random() < 0.3 else '',
+                    'colour': colour,
+                })
+                if len(tracks) == count:
+                    return tracks
+    return tracks
+
+
+def cover_image(colour, size=96):
+    image = Image.new('RGB', (size, size), colour)
+    # a gradient so the jpeg is not trivially small
+    pixels = image.load()
+    for x in range(size):
+        for y in range(0, size, 4):
+            pixels[x, y] = ((colour[0] + x) % 256, (colour[1] + y) % 256, colour[2])
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=80)
+    return data.getvalue()
+
+
+# ~~~ Files ~~~
+# audio streams hold silence or zeros, only the container headers are valid. mutagen reads and tags them like
+# real files, which is all ingestion and streaming look at
+
+def write_flac(path, seconds):
+    rate, channels, bits, samples = 44100, 2, 16, 44100 * seconds
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+    info += ((rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples).to_bytes(8, 'big') + b'\x00' * 16
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info + b'\x00' * 4096)
+
+
+def write_mp3(path, seconds):
+    # mpeg 1 layer 3, 128 kbps, 44.1 kHz: 417 byte frames, 38 per second
+    frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+    with open(path, 'wb') as f:
+        f.write(frame * (38 * seconds))
+
+
+def write_ogg(path, seconds):
+    rate = 44100
+    identification = b'\x01vorbis' + struct.pack('<IBIiii', 0, 2, rate, 0, 128000, 0) + b'\xb8\x01'
+    vendor = b'acris synthetic'
+    comment = b'\x03vorbis' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', 0) + b'\x01'
+    setup = b'\x05vorbis' + b'\x00' * 32
+
+    pages = []
+    for sequence, (packets, position) in enumerate([([identification], 0), ([comment, setup], 0),
+                                                     ([b'\x00' * 4096], rate * seconds)]):
+        page = OggPage()
+        page.serial = 1
+        page.sequence = sequence
+        page.position = position
+        page.packets = packets
+        page.first = sequence == 0
+        page.last = sequence == 2
+        pages.append(page.write())
+    with open(path, 'wb') as f:
+        f.write(b''.join(pages))
+
+
+def mp4_box(kind, payload):
+    return struct.pack('>I', 8 + len(payload)) + kind + payload
+
+
+def mp4_full_box(kind, payload, version=0, flags=0):
+    return mp4_box(kind, bytes([version]) + flags.to_bytes(3, 'big') + payload)
+
+
+def write_mp4(path, seconds):
+    rate = 44100
+    duration = rate * seconds
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+    mvhd = mp4_full_box(b'mvhd', struct.pack('>IIIIIH', 0, 0, rate, duration, 0x10000, 0x100) + b'\x00' * 10 +
+                        matrix + b'\x00' * 24 + struct.pack('>I', 2))
+    tkhd = mp4_full_box(b'tkhd', struct.pack('>IIIII', 0, 0, 1, 0, duration) + b'\x00' * 8 +
+                        struct.pack('>HHHH', 0, 0, 0x100, 0) + matrix + struct.pack('>II', 0, 0), flags=7)
+    mdhd = mp4_full_box(b'mdhd', struct.pack('>IIIIHH', 0, 0, rate, duration, 0x55c4, 0))
+    hdlr = mp4_full_box(b'hdlr', b'\x00' * 4 + b'soun' + b'\x00' * 12 + b'SoundHandler\x00')
+    # aac lc, 44.1 kHz, stereo
+    decoder_config = b'\x04\x11\x40\x15' + b'\x00' * 3 + struct.pack('>II', 128000, 128000) + b'\x05\x02\x12\x10'
+    esds = mp4_full_box(b'esds', b'\x03\x19\x00\x01\x00' + decoder_config + b'\x06\x01\x02')
+    mp4a = mp4_box(b'mp4a', b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8 +
+                   struct.pack('>HHHHI', 2, 16, 0, 0, rate << 16) + esds)
+    stbl = mp4_box(b'stbl', mp4_full_box(b'stsd', struct.pack('>I', 1) + mp4a) +
+                   mp4_full_box(b'stts', struct.pack('>I', 0)) +
+                   mp4_full_box(b'stsc', struct.pack('>I', 0)) +
+                   mp4_full_box(b'stsz', struct.pack('>II', 0, 0)) +
+                   mp4_full_box(b'stco', struct.pack('>I', 0)))
+    dinf = mp4_box(b'dinf', mp4_full_box(b'dref', struct.pack('>I', 1) + mp4_full_box(b'url ', b'', flags=1)))
+    minf = mp4_box(b'minf', mp4_full_box(b'smhd', b'\x00' * 4) + dinf + stbl)
+    trak = mp4_box(b'trak', tkhd + mp4_box(b'mdia', mdhd + hdlr + minf))
+
+    with open(path, 'wb') as f:
+        f.write(mp4_box(b'ftyp', b'M4A ' + struct.pack('>I', 0) + b'M4A mp42isom'))
+        f.write(mp4_box(b'moov', mvhd + trak))
+        f.write(mp4_box(b'mdat', b'\x00' * 4096))
+
+
+def tag_flac(path, track, cover):
+    audio = FLAC(path)
+    audio['title'] = track['name']
+    audio['artist'] = track['artists']
+    audio['albumartist'] = track['album_artist']
+    audio['album'] = track['album']
+    audio['genre'] = track['genres']
+    audio['date'] = str(track['year'])
+    audio['tracknumber'] = str(track['album_track_number'])
+    if track['lyrics']:
+        audio['lyrics'] = track['lyrics']
+    picture = Picture()
+    picture.type = 3
+    picture.mime = 'image/jpeg'
+    picture.data = cover
+    audio.add_picture(picture)
+    audio.save()
+
+
+def tag_mp3(path, track, cover):
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=track['name']))
+    tags.add(TPE1(encoding=3, text=track['artists']))
+    tags.add(TPE2(encoding=3, text=track['album_artist']))
+    tags.add(TALB(encoding=3, text=track['album']))
+    tags.add(TCON(encoding=3, text=track['genres']))
+    tags.add(TDRC(encoding=3, text=str(track['year'])))
+    tags.add(TRCK(encoding=3, text=str(track['album_track_number'])))
+    if track['lyrics']:
+        tags.add(USLT(encoding=3, lang='eng', desc='', text=track['lyrics']))
+    tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='cover', data=cover))
+    tags.save(path)
+
+
+def tag_ogg(path, track, cover):
+    audio = OggVorbis(path)
+    audio['title'] = track['name']
+    audio['artist'] = track['artists']
+    audio['albumartist'] = track['album_artist']
+    audio['album'] = track['album']
+    audio['genre'] = track['genres']
+    audio['date'] = str(track['year'])
+    audio['tracknumber'] = str(track['album_track_number'])
+    if track['lyrics']:
+        audio['lyrics'] = track['lyrics']
+    picture = Picture()
+    picture.type = 3
+    picture.mime = 'image/jpeg'
+    picture.data = cover
+    audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+    audio.save()
+
+
+def tag_mp4(path, track, cover):
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    audio['\xa9nam'] = track['name']
+    audio['\xa9ART'] = track['artists']
+    audio['aART'] = track['album_artist']
+    audio['\xa9alb'] = track['album']
+    audio['\xa9gen'] = track['genres']
+    audio['\xa9day'] = str(track['year'])
+    audio['trkn'] = [(track['album_track_number'], 0)]
+    if track['lyrics']:
+        audio['\xa9lyr'] = track['lyrics']
+    audio['covr'] = [MP4Cover(cover, imageformat=MP4Cover.FORMAT_JPEG)]
+    audio.save()
+
+
+WRITERS = {
+    'flac': (write_flac, tag_flac),
+    'mp3': (write_mp3, tag_mp3),
+    'ogg': (write_ogg, tag_ogg),
+    'm4a': (write_mp4, tag_mp4),
+}
+
+
+# write one tagged file per track into directory, cycling through formats. Returns [(path, format)]
+def write_files(directory, tracks, formats=FORMATS, seconds=2):
+    files = []
+    covers = {}
+    for number, track in enumerate(tracks):
+        audio_format = formats[number % len(formats)]
+        path = '%s/%05d.%s' % (directory, number, audio_format)
+        if track['colour'] not in covers:
+            covers[track['colour']] = cover_image(track['colour'])
+        write, tag = WRITERS[audio_format]
+        write(path, seconds)
+        tag(path, track, covers[track['colour']])
+        files.append((path, audio_format))
+    return files
+
+
+# ~~~ Database ~~~
+
+# a parsed tag record as acris.core.importer.write_tracks takes them, without a cover so no file is needed
+def import_record(track, audio_format):
+    return {
+        'name': track['name'],
+        'format': MIME_TYPES[audio_format],
+        'album_track_number': track['album_track_number'],
+        'lyrics': track['lyrics'],
+        'year': track['year'],
+        'length': track['length'],
+        'album_artist': track['album_artist'],
+        'album': track['album'],
+        'artists': track['artists'],
+        'genres': track['genres'],
+        'picture_digest': None,
+        'picture': None,
+        'content_hash': '',
+    }
@@ -0,0 +1,273 @@
+import base64
+import hashlib
+import io
+from collections import namedtuple
+
+import mutagen
+from mutagen.flac import FLAC, Picture, error as FLACError
+from mutagen.mp3 import MP3
+from mutagen.oggvorbis import OggVorbis
+from mutagen.oggopus import OggOpus
+from mutagen.mp4 import MP4
+from PIL import Image
+
+# this module must not touch the database or django models so it can run in worker processes
+
+
+# ~~~ Tag tables ~~~
+# every format maps the fields of a record to the tags holding them, tried in order until one has a value. Fields in
+# LIST_FIELDS take every value of that tag (repeated vorbis comments, ID3v2.4 multi-value frames, several MP4
+# atoms), the others its first value
+
+LIST_FIELDS = ('artists', 'genres')
+
+VORBIS_TAGS = {
+    'name': ['title'],
+    'artists': ['artists', 'artist'],
+    'album_artist': ['albumartist', 'album artist'],
+    'album': ['album'],
+    'album_track_number': ['tracknumber'],
+    'genres': ['genre'],
+    'lyrics': ['lyrics', 'unsyncedlyrics'],
+    'year': ['date', 'year'],
+}
+
+ID3_TAGS = {
+    'name': ['TIT2'],
+    'artists': ['TXXX:ARTISTS', 'TPE1'],
+    'album_artist': ['TPE2'],
+    'album': ['TALB'],
+    'album_track_number': ['TRCK'],
+    'genres': ['TCON'],
+    'lyrics': ['USLT'],
+    'year': ['TDRC', 'TYER'],
+}
+
+MP4_TAGS = {
+    'name': ['\xa9nam'],
+    'artists': ['----:com.apple.iTunes:ARTISTS', '\xa9ART'],
+    'album_artist': ['aART'],
+    'album': ['\xa9alb'],
+    'album_track_number': ['trkn'],
+    'genres': ['\xa9gen'],
+    'lyrics': ['\xa9lyr'],
+    'year': ['\xa9day'],
+}
+
+
+def vorbis_values(tags, key):
+    return [str(value) for value in tags.get(key, [])]
+
+
+def id3_values(tags, key):
+    values = []
+    for frame in tags.getall(key):
+        if key == 'TCON':
+            # numeric ID3v1 genres like (13) are turned into their names
+            values.extend(frame.genres)
+        elif isinstance(frame.text, str):
+            values.append(frame.text)
+        else:
+            values.extend(str(value) for value in frame.text)
+    return values
+
+
+def mp4_values(tags, key):
+    values = []
+    for value in tags.get(key, []):
+        if isinstance(value, tuple):
+            # trkn is (number, total)
+            value = value[0]
+        elif isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        values.append(str(value))
+    return values
+
+
+def flac_picture(metadata):
+    return metadata.pictures[0].data if metadata.pictures else None
+
+
+def id3_picture(metadata):
+    pictures = metadata.tags.getall('APIC') if metadata.tags is not None else []
+    return pictures[0].data if pictures else None
+
+
+def mp4_picture(metadata):
+    pictures = metadata.get('covr')
+    return bytes(pictures[0]) if pictures else None
+
+
+def ogg_picture(metadata):
+    for b64_data in metadata.get('metadata_block_picture', []):
+        try:
+            return Picture(base64.b64decode(b64_data)).data
+        except (TypeError, ValueError, FLACError):
+            continue
+    return None
+
+
+TagFormat = namedtuple('TagFormat', ['type', 'mime_type', 'tags', 'values', 'picture'])
+
+# checked in order, the first type the file is an instance of wins
+FORMATS = [
+    TagFormat(FLAC, 'audio/flac', VORBIS_TAGS, vorbis_values, flac_picture),
+    TagFormat(MP3, 'audio/mpeg', ID3_TAGS, id3_values, id3_picture),
+    TagFormat(MP4, 'audio/mp4', MP4_TAGS, mp4_values, mp4_picture),
+    TagFormat(OggVorbis, 'audio/ogg', VORBIS_TAGS, vorbis_values, ogg_picture),
+    TagFormat(OggOpus, 'audio/opus', VORBIS_TAGS, vorbis_values, ogg_picture),
+]
+
+
+# ~~~ Records ~~~
+
+def unique(values):
+    return list(dict.fromkeys(value.strip() for value in values if value and value.strip()))
+
+
+def parse_track_number(value):
+    if value is None:
+        return 0
+    try:
+        return int(str(value).split('/')[0])
+    except ValueError:
+        return 0
+
+
+def empty_record(path):
+    return {
+        'path': path,
+        'format': 'Unknown',
+        'length': None,
+        'name': None,
+        'artists': [],
+        'album_artist': None,
+        'album': None,
+        'album_track_number': 0,
+        'genres': [],
+        'lyrics': None,
+        'year': None,
+        'picture': None,
+    }
+
+
+def tag_format(metadata):
+    for candidate in FORMATS:
+        if isinstance(metadata, candidate.type):
+            return candidate
+    return None
+
+
+# read the tags of an audio file (a path or an open file) into a plain dict. None for unsupported files
+def read_tags(path, fileobj=None):
+    metadata = mutagen.File(fileobj or path)
+    if metadata is None:
+        return None
+    file_format = tag_format(metadata)
+    if file_format is None:
+        return None
+
+    record = empty_record(path)
+    record['format'] = file_format.mime_type
+    record['length'] = metadata.info.length
+    record['picture'] = file_format.picture(metadata)
+    if metadata.tags is None:
+        return record
+
+    for field, keys in file_format.tags.items():
+        for key in keys:
+            values = unique(file_format.values(metadata.tags, key))
+            if values:
+                record[field] = values if field in LIST_FIELDS else values[0]
+                break
+    record['album_track_number'] = parse_track_number(record['album_track_number'] or None)
+    return record
+
+
+# encode embedded cover art as the jpeg served for thumbnails
+def encode_thumbnail(image_data):
+    image = Image.open(io.BytesIO(image_data))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, format='JPEG')
+    return output.getvalue()
+
+
+# pool entry point for encoding new covers, None for images that could not be decoded
+def try_encode_thumbnail(image_data):
+    try:
+        return encode_thumbnail(image_data)
+    except Exception:
+        return None
+
+
+# A read only file hashing its content as mutagen reads it, so a file is read once for its tags and its hash. Reads
+# continuing the hashed part extend it, the audio data mutagen seeks over is hashed by hexdigest at the end.
+class HashingFile:
+    def __init__(self, path):
+        self.name = path
+        self.file = open(path, 'rb')
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+
+    def read(self, size=-1):
+        start = self.file.tell()
+        data = self.file.read(size)
+        if start <= self.hashed < start + len(data):
+            self.hasher.update(memoryview(data)[self.hashed - start:])
+            self.hashed = start + len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def hexdigest(self, chunk_size=1024 * 1024):
+        self.file.seek(self.hashed)
+        for chunk in iter(lambda: self.file.read(chunk_size), b''):
+            self.hasher.update(chunk)
+            self.hashed += len(chunk)
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# tags, the content hash (unless it is already known) and the digest of the embedded picture, None for unsupported
+# files
+def read_record(path, content_hash=None):
+    if content_hash:
+        record = read_tags(path)
+    else:
+        with HashingFile(path) as f:
+            record = read_tags(path, f)
+            if record is not None:
+                content_hash = f.hexdigest()
+    if record is None:
+        return None
+
+    record['content_hash'] = content_hash
+    record['picture_digest'] = None
+    if record['picture'] is not None:
+        record['picture_digest'] = hashlib.sha256(record['picture']).hexdigest()
+    return record
+
+
+# worker process entry point: read_record, or the error that stopped parsing
+def parse_file(path, content_hash=None):
+    try:
+        record = read_record(path, content_hash)
+        if record is None:
+            return path, None, 'unsupported audio format'
+        return path, record, None
+    except Exception as e:
+        return path, None, str(e) or e.__class__.__name__
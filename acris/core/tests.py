@@ -1,3 +1,1348 @@
-from django.test import TestCase
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import zipfile
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_finished, request_started
+from django.db import IntegrityError, close_old_connections, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils.http import http_date
+from django.utils.timezone import make_aware
+from mutagen.flac import FLAC, Picture
+from PIL import Image
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+import acris.core.asgi as asgi
+import acris.core.caching as caching
+import acris.core.changes as changes
+import acris.core.covers as covers
+import acris.core.deletion as deletion
+import acris.core.ingest as ingest
+import acris.core.metrics as metrics
+import acris.core.permissions as permissions
+import acris.core.playlists as playlists
+import acris.core.reaper as reaper
+import acris.core.rules as rules
+import acris.core.resumable as resumable
+import acris.core.search as search
+import acris.core.stats as stats
+import acris.core.views as views
+import acris.core.streaming as streaming
+from acris.core.models import AcrisUser, Album, Artist, Change, Collection, CoverArt, FileDeletion, Genre, IngestJob, \
+    Playlist, PlaylistEntry, Track, UploadSession
+
+
+def now():
+    return make_aware(datetime.now())
+
+
+def create_collection(name='collection', is_public=False):
+    return Collection.objects.create(date_created=now(), name=name, is_public=is_public)
+
+
+def create_track(collection, name, **fields):
+    return Track.objects.create(collection=collection, name=name, file_name=name + '.flac', date_uploaded=now(),
+                                **fields)
+
+
+def png(color):
+    data = io.BytesIO()
+    Image.new('RGB', (32, 32), color).save(data, 'PNG')
+    return data.getvalue()
+
+
+# a FLAC file with a STREAMINFO block, no audio frames and the given vorbis comments and front cover
+def write_flac(path, seconds=10, cover=None, **tags):
+    rate, channels, bits = 44100, 2, 16
+    info = struct.pack('>HH', 4096, 4096) + bytes(6)
+    info += ((rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | rate * seconds).to_bytes(8, 'big')
+    info += bytes(16)
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info + bytes(1024))
+    meta = FLAC(path)
+    for key, value in tags.items():
+        meta[key] = value
+    if cover is not None:
+        picture = Picture()
+        picture.type = 3
+        picture.mime = 'image/png'
+        picture.data = cover
+        meta.add_picture(picture)
+    meta.save()
+
+
+# points MEDIA_ROOT at a directory that is removed after each test
+class TemporaryMediaMixin:
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media_root = media.name
+        override = self.settings(MEDIA_ROOT=media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def flac(self, name, **tags):
+        path = os.path.join(self.media_root, name)
+        write_flac(path, **tags)
+        return path
+
+    # queue an import job for the given local files and run it
+    def run_import(self, collection, paths):
+        files = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                files.append(default_storage.save('import/' + os.path.basename(path), f))
+        job = IngestJob.objects.create(date_created=now(), collection=collection, kind=IngestJob.IMPORT,
+                                       total=len(files), files=files)
+        ingest.run_job(job.id)
+        job.refresh_from_db()
+        return job
+
+
+# ~~~ Streaming ~~~
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(streaming.parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(streaming.parse_range_header('bytes=500-', 1000), [(500, 999)])
+        self.assertEqual(streaming.parse_range_header('bytes=990-2000', 1000), [(990, 999)])
+        self.assertEqual(streaming.parse_range_header(' bytes = 1 - 2 ', 1000), [(1, 2)])
+
+    def test_suffix_ranges(self):
+        self.assertEqual(streaming.parse_range_header('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(streaming.parse_range_header('bytes=-5000', 1000), [(0, 999)])
+
+    def test_ranges_are_sorted_and_coalesced(self):
+        self.assertEqual(streaming.parse_range_header('bytes=100-110,0-10,5-20,21-30', 1000),
+                         [(0, 30), (100, 110)])
+
+    def test_malformed_headers_send_the_whole_file(self):
+        for header in (None, '', 'items=0-1', 'bytes=', 'bytes=abc', 'bytes=5-1', 'bytes=-', 'bytes=0-1,x'):
+            self.assertIsNone(streaming.parse_range_header(header, 1000), header)
+
+    def test_too_many_ranges_send_the_whole_file(self):
+        header = 'bytes=' + ','.join('%d-%d' % (i * 10, i * 10) for i in range(streaming.MAX_RANGES + 1))
+        self.assertIsNone(streaming.parse_range_header(header, 1000))
+
+    def test_unsatisfiable_ranges(self):
+        for header in ('bytes=1000-', 'bytes=2000-3000', 'bytes=-0'):
+            with self.assertRaises(streaming.RangeNotSatisfiable):
+                streaming.parse_range_header(header, 1000)
+        with self.assertRaises(streaming.RangeNotSatisfiable):
+            streaming.parse_range_header('bytes=0-', 0)
+
+
+class IfRangeTests(SimpleTestCase):
+    etag = '"5f3a-400"'
+    mtime = 1700000000.75
+
+    def test_missing_header_matches(self):
+        self.assertTrue(streaming.if_range_matches(None, self.etag, self.mtime))
+
+    def test_etags(self):
+        self.assertTrue(streaming.if_range_matches(self.etag, self.etag, self.mtime))
+        self.assertFalse(streaming.if_range_matches('"other"', self.etag, self.mtime))
+        self.assertFalse(streaming.if_range_matches('W/' + self.etag, self.etag, self.mtime))
+
+    def test_dates(self):
+        self.assertTrue(streaming.if_range_matches(http_date(self.mtime), self.etag, self.mtime))
+        self.assertFalse(streaming.if_range_matches(http_date(self.mtime - 60), self.etag, self.mtime))
+        self.assertFalse(streaming.if_range_matches('yesterday', self.etag, self.mtime))
+
+
+# ~~~ Ingest ~~~
+
+class IngestJobTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.owners.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, file):
+        # the job is queued on commit, the tests run it themselves
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.put('/api/collection/%d/upload/' % self.collection.id, {'file': file},
+                                       format='multipart')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], IngestJob.PENDING)
+        self.assertEqual(len(callbacks), 1)
+        return IngestJob.objects.get(id=response.data['id'])
+
+    def test_upload_is_processed_in_the_background(self):
+        with open(self.flac('upload.flac', title='Title', artist='Artist', album='Album'), 'rb') as f:
+            job = self.upload(f)
+        self.assertEqual(job.track.name, '')
+
+        ingest.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.DONE)
+        self.assertEqual(job.processed, 1)
+        self.assertIsNotNone(job.date_finished)
+
+        track = Track.objects.get(id=job.track_id)
+        self.assertEqual(track.name, 'Title')
+        self.assertEqual(track.album.name, 'Album')
+        self.assertEqual([artist.name for artist in track.artists.all()], ['Artist'])
+        self.assertEqual(track.length.total_seconds(), 10)
+
+        response = self.client.get('/api/ingest/%d/' % job.id)
+        self.assertEqual(response.data['status'], IngestJob.DONE)
+
+    def test_claimed_jobs_are_not_run_again(self):
+        with open(self.flac('upload.flac', title='Title'), 'rb') as f:
+            job = self.upload(f)
+        IngestJob.objects.filter(id=job.id).update(status=IngestJob.RUNNING)
+        ingest.run_job(job.id)
+        self.assertEqual(Track.objects.get(id=job.track_id).name, '')
+        self.assertEqual(IngestJob.objects.get(id=job.id).status, IngestJob.RUNNING)
+
+    def test_unreadable_files_fail_the_job(self):
+        job = self.upload(SimpleUploadedFile('broken.flac', b'not audio'))
+        ingest.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.FAILED)
+        self.assertNotEqual(job.error, '')
+
+    def test_jobs_left_running_by_a_dead_process(self):
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        dead_worker = '%s:%d' % (socket.gethostname(), dead.pid)
+        track = create_track(self.collection, 'track')
+        jobs = {}
+        for name, kind, worker in (('dead upload', IngestJob.UPLOAD, dead_worker),
+                                   ('dead import', IngestJob.IMPORT, dead_worker),
+                                   ('unknown', IngestJob.UPLOAD, ''),
+                                   ('this process', IngestJob.UPLOAD, ingest.worker_name()),
+                                   ('other host', IngestJob.UPLOAD, 'elsewhere.invalid:1')):
+            jobs[name] = IngestJob.objects.create(date_created=now(), collection=self.collection, track=track,
+                                                  kind=kind, status=IngestJob.RUNNING, worker=worker).id
+
+        ingest.recover_jobs()
+        states = dict(IngestJob.objects.values_list('id', 'status'))
+        self.assertEqual({name: states[job_id] for name, job_id in jobs.items()}, {
+            'dead upload': IngestJob.PENDING,
+            'dead import': IngestJob.FAILED,
+            'unknown': IngestJob.PENDING,
+            'this process': IngestJob.RUNNING,
+            'other host': IngestJob.RUNNING,
+        })
+        self.assertEqual(IngestJob.objects.get(id=jobs['dead import']).error, 'Interrupted by a restart.')
+
+        # requeued jobs are claimed again under the name of the process running them
+        with open(self.flac('upload.flac', title='Title'), 'rb') as f:
+            track.audio_src.save('upload.flac', f)
+        ingest.run_job(jobs['dead upload'])
+        job = IngestJob.objects.get(id=jobs['dead upload'])
+        self.assertEqual((job.status, job.worker), (IngestJob.DONE, ingest.worker_name()))
+
+    def test_import_archives_and_files(self):
+        archive_path = os.path.join(self.media_root, 'import.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            for i in range(3):
+                archive.write(self.flac('%d.flac' % i, title='Track %d' % i, artist='Artist', genre='Genre'),
+                              'disc/%d.flac' % i)
+            archive.writestr('notes.txt', 'not audio')
+
+        with open(archive_path, 'rb') as f:
+            with self.captureOnCommitCallbacks():
+                response = self.client.post('/api/collection/%d/import/' % self.collection.id,
+                                            {'files': [f, SimpleUploadedFile('broken.mp3', b'not audio')]},
+                                            format='multipart')
+        self.assertEqual(response.status_code, 202)
+        job = IngestJob.objects.get(id=response.data['id'])
+        self.assertEqual((job.kind, job.total), (IngestJob.IMPORT, 4))
+
+        ingest.run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestJob.DONE)
+        self.assertEqual((job.processed, job.failed), (4, 1))
+        self.assertIn('broken.mp3', job.error)
+
+        tracks = Track.objects.filter(collection=self.collection).order_by('name')
+        self.assertEqual([track.name for track in tracks], ['Track 0', 'Track 1', 'Track 2'])
+        artist = Artist.objects.get(collection=self.collection)
+        self.assertEqual(artist.name, 'Artist')
+        self.assertEqual(Track.artists.through.objects.filter(artist=artist).count(), 3)
+        # tracks keep the hash taken while their files were copied out of the archive
+        hashes = dict(job.files)
+        for track in tracks:
+            with track.audio_src.open('rb') as f:
+                self.assertEqual(hashlib.sha256(f.read()).hexdigest(), track.content_hash)
+            self.assertEqual(hashes[track.audio_src.name], track.content_hash)
+
+    def test_import_needs_audio(self):
+        response = self.client.post('/api/collection/%d/import/' % self.collection.id,
+                                    {'files': [SimpleUploadedFile('notes.txt', b'text')]}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IngestJob.objects.exists())
+
+
+# ~~~ Search ~~~
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        artist = Artist.objects.create(collection=self.collection, name='Monk')
+        create_track(self.collection, 'Giant Steps').artists.add(artist)
+        create_track(self.collection, 'So What')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def names(self, track_ids):
+        return sorted(Track.objects.filter(id__in=track_ids).values_list('name', flat=True))
+
+    def test_search_tracks(self):
+        self.assertEqual(self.names(search.search_tracks(self.collection.id, 'giant', 10)), ['Giant Steps'])
+        self.assertEqual(self.names(search.search_tracks(self.collection.id, 'mon', 10)), ['Giant Steps'])
+        self.assertEqual(search.search_tracks(create_collection().id, 'giant', 10), [])
+
+    def test_terms_do_not_match_the_collection_column(self):
+        for text in ('c', 'c%d' % self.collection.id):
+            self.assertEqual(search.search_tracks(self.collection.id, text, 10), [], text)
+            response = self.client.get('/api/collection/%d/tracks/' % self.collection.id, {'search': text})
+            self.assertEqual(response.data, [], text)
+        response = self.client.get('/api/collection/%d/tracks/' % self.collection.id, {'search': 'what'})
+        self.assertEqual([track['name'] for track in response.data], ['So What'])
+
+
+# ~~~ Keyset pagination ~~~
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.owners.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # names repeat so pages have to break ties on id, years are partly empty
+        for i in range(25):
+            create_track(self.collection, 'track %d' % (i % 4), year=str(1990 + i % 3) if i % 5 else '')
+
+    def walk(self, query):
+        ids = []
+        url = '/api/collection/%d/tracks/?cursor=&limit=3&%s' % (self.collection.id, query)
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids += [row['id'] for row in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def expected(self, *ordering):
+        return list(Track.objects.filter(collection=self.collection).order_by(*ordering).values_list('id', flat=True))
+
+    def test_pages_cover_every_row_once_in_order(self):
+        self.assertEqual(self.walk('ordering=name'), self.expected('name', 'id'))
+        self.assertEqual(self.walk('ordering=-name'), self.expected('-name', '-id'))
+        self.assertEqual(self.walk('ordering=year'), self.expected('year', 'id'))
+        self.assertEqual(self.walk('ordering=-year'), self.expected('-year', '-id'))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/collection/%d/tracks/?cursor=not-a-cursor' % self.collection.id)
+        self.assertEqual(response.status_code, 404)
+
+
+# ~~~ Aggregates ~~~
+
+class StatsTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = create_collection()
+        self.album = Album.objects.create(collection=self.collection, name='Album')
+        self.artist = Artist.objects.create(collection=self.collection, name='Artist')
+        self.genre = Genre.objects.create(collection=self.collection, name='Genre')
+
+    def totals(self, obj):
+        obj.refresh_from_db()
+        return obj.track_count, obj.length.total_seconds(), obj.formats
+
+    def snapshot(self):
+        return {(model.__name__, obj.id): (obj.track_count, obj.length, obj.formats)
+                for model in stats.STATS_MODELS for obj in model.objects.all()}
+
+    # the incrementally kept numbers have to match a full rebuild
+    def assertMatchesRecompute(self):
+        kept = self.snapshot()
+        stats.recompute()
+        self.assertEqual(kept, self.snapshot())
+
+    def test_saves_links_and_deletes(self):
+        first = create_track(self.collection, 'first', album=self.album, length=timedelta(seconds=100),
+                             audio_format='flac')
+        second = create_track(self.collection, 'second', album=self.album, length=timedelta(seconds=50),
+                              audio_format='mp3')
+        first.artists.add(self.artist)
+        first.genres.add(self.genre)
+        self.assertEqual(self.totals(self.album), (2, 150, {'flac': 1, 'mp3': 1}))
+        self.assertEqual(self.totals(self.collection), (2, 150, {'flac': 1, 'mp3': 1}))
+        self.assertEqual(self.totals(self.artist), (1, 100, {'flac': 1}))
+        self.assertMatchesRecompute()
+
+        first.length = timedelta(seconds=10)
+        first.audio_format = 'mp3'
+        first.save()
+        self.genre.track_set.add(second)
+        self.assertEqual(self.totals(self.genre), (2, 60, {'mp3': 2}))
+        self.assertEqual(self.totals(self.artist), (1, 10, {'mp3': 1}))
+        self.assertMatchesRecompute()
+
+        first.delete()
+        self.genre.track_set.clear()
+        self.assertEqual(self.totals(self.collection), (1, 50, {'mp3': 1}))
+        self.assertEqual(self.totals(self.genre), (0, 0, {}))
+        # artists without tracks are removed with their last track
+        self.assertFalse(Artist.objects.filter(id=self.artist.id).exists())
+        self.assertMatchesRecompute()
+
+    def test_imports(self):
+        self.run_import(self.collection, [self.flac('%d.flac' % i, title=str(i), album='Album', artist='Artist')
+                                          for i in range(3)])
+        self.assertEqual(self.totals(self.album)[:2], (3, 30))
+        self.assertEqual(self.totals(self.artist)[:2], (3, 30))
+        self.assertEqual(self.totals(self.collection)[:2], (3, 30))
+        self.assertMatchesRecompute()
+
+
+# ~~~ Cover art ~~~
+
+class CoverArtTests(TemporaryMediaMixin, TestCase):
+    def test_store_and_release(self):
+        image = png((200, 0, 0))
+        name = covers.store(image)
+        self.assertEqual(covers.store(image), name)
+        self.assertNotEqual(covers.store(png((0, 200, 0))), name)
+        self.assertEqual(CoverArt.objects.get(digest=covers.name_digest(name)).ref_count, 2)
+        self.assertTrue(default_storage.exists(name))
+
+        covers.release(name)
+        self.assertEqual(CoverArt.objects.get(digest=covers.name_digest(name)).ref_count, 1)
+        covers.release(name)
+        self.assertFalse(CoverArt.objects.filter(digest=covers.name_digest(name)).exists())
+        reaper.reap()
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(CoverArt.objects.count(), 1)
+
+    def test_covers_released_during_a_store_are_stored_again(self):
+        image = png((200, 0, 0))
+        name = covers.store(image)
+        digest = covers.name_digest(name)
+        select = CoverArt.objects.filter
+        covers.release(name)
+        reaper.reap()
+
+        # the select still sees the cover that was released before its reference could be added
+        def stale_select(*args, **kwargs):
+            if 'digest__in' in kwargs:
+                return mock.Mock(values_list=lambda *args, **kwargs: [digest])
+            return select(*args, **kwargs)
+
+        with mock.patch.object(CoverArt.objects, 'filter', side_effect=stale_select):
+            self.assertEqual(covers.store(image), name)
+        self.assertEqual(CoverArt.objects.get(digest=digest).ref_count, 1)
+        self.assertTrue(default_storage.exists(name))
+
+    def test_imported_albums_share_one_cover(self):
+        collection = create_collection()
+        image = png((0, 0, 200))
+        self.run_import(collection, [self.flac('%d.flac' % i, title=str(i), album='Album', cover=image)
+                                     for i in range(3)])
+
+        cover = CoverArt.objects.get()
+        self.assertEqual(cover.digest, covers.cover_digest(image))
+        # three tracks and the album that took their cover
+        self.assertEqual(cover.ref_count, 4)
+        album = Album.objects.get(collection=collection)
+        self.assertEqual(album.thumbnail_src.name, covers.cover_name(cover.digest))
+        self.assertEqual(set(Track.objects.values_list('thumbnail_src', flat=True)), {album.thumbnail_src.name})
+
+        Track.objects.filter(collection=collection).first().delete()
+        cover.refresh_from_db()
+        self.assertEqual(cover.ref_count, 3)
+        album.delete()
+        self.assertFalse(CoverArt.objects.exists())
+        reaper.reap()
+        self.assertFalse(default_storage.exists(covers.cover_name(cover.digest)))
+
+
+# ~~~ Conditional requests ~~~
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.owners.add(self.user)
+        self.track = create_track(self.collection, 'track')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_unchanged_collections_answer_304(self):
+        url = '/api/collection/%d/tracks/' % self.collection.id
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/track/%d/' % self.track.id)['ETag'], etag)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='W/' + etag).status_code, 304)
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        self.track.name = 'renamed'
+        self.track.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_changes_to_related_rows_change_the_etag(self):
+        url = '/api/collection/%d/' % self.collection.id
+        etag = self.client.get(url)['ETag']
+        self.track.genres.add(Genre.objects.create(collection=self.collection, name='Genre'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_collections_list(self):
+        etag = self.client.get('/api/collections/')['ETag']
+        self.assertEqual(self.client.get('/api/collections/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        create_collection('other').viewers.add(self.user)
+        self.assertEqual(self.client.get('/api/collections/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+# ~~~ Access ~~~
+
+class AccessCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.factory = RequestFactory()
+
+    def can(self, method, user=None):
+        request = getattr(self.factory, method)('/')
+        request.user = user or self.user
+        return permissions.has_collection_permission(request, self.collection.id)
+
+    def test_member_changes_drop_the_cached_access(self):
+        self.assertFalse(self.can('get'))
+
+        self.collection.viewers.add(self.user)
+        self.assertTrue(self.can('get'))
+        self.assertFalse(self.can('post'))
+
+        self.collection.owners.add(self.user)
+        self.assertTrue(self.can('post'))
+
+        self.collection.owners.remove(self.user)
+        self.assertFalse(self.can('post'))
+        self.assertTrue(self.can('get'))
+
+        self.collection.viewers.clear()
+        self.assertFalse(self.can('get'))
+
+    def test_user_side_changes_drop_the_cached_access(self):
+        self.assertFalse(self.can('post'))
+        self.user.collection_owners.add(self.collection)
+        self.assertTrue(self.can('post'))
+        self.user.collection_owners.clear()
+        self.assertFalse(self.can('post'))
+
+    def test_public_collections(self):
+        other = AcrisUser.objects.create(username='other', description='')
+        self.assertFalse(self.can('get', other))
+        self.collection.is_public = True
+        self.collection.save()
+        self.assertTrue(self.can('get', other))
+        self.assertFalse(self.can('post', other))
+
+    def test_deleted_collection_drops_the_cached_access(self):
+        self.collection.owners.add(self.user)
+        self.assertTrue(self.can('post'))
+        collection_id = self.collection.id
+        self.collection.delete()
+        self.assertNotIn(collection_id, permissions.load_user_access(self.user.id))
+        request = self.factory.get('/')
+        request.user = self.user
+        self.assertNotIn(collection_id, permissions.user_access(request))
+
+
+class AccessRouteTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.collection = create_collection()
+        self.track = create_track(self.collection, 'track')
+        self.album = Album.objects.create(collection=self.collection, name='Album')
+        self.client = APIClient()
+
+    def status(self, user, method, url, **kwargs):
+        self.client.force_authenticate(user)
+        return getattr(self.client, method)(url, **kwargs).status_code
+
+    def test_sub_collection_routes(self):
+        stranger = AcrisUser.objects.create(username='stranger', description='')
+        viewer = AcrisUser.objects.create(username='viewer', description='')
+        self.collection.viewers.add(viewer)
+        urls = ['/api/collection/%d/tracks/' % self.collection.id, '/api/track/%d/' % self.track.id,
+                '/api/album/%d/' % self.album.id, '/api/album/%d/tracks/' % self.album.id]
+        for url in urls:
+            self.assertEqual(self.status(stranger, 'get', url), 403, url)
+            self.assertEqual(self.status(viewer, 'get', url), 200, url)
+
+        upload = '/api/collection/%d/upload/' % self.collection.id
+        self.assertEqual(self.status(viewer, 'put', upload, data={'file': SimpleUploadedFile('a.flac', b'')},
+                                     format='multipart'), 403)
+
+    def test_public_streams(self):
+        with open(self.flac('track.flac'), 'rb') as f:
+            self.track.audio_src.save('track.flac', f)
+        url = '/api/track/%d/stream/' % self.track.id
+        self.assertIn(self.status(None, 'get', url), (401, 403))
+        self.collection.is_public = True
+        self.collection.save()
+        self.assertEqual(self.status(None, 'get', url), 200)
+
+
+# ~~~ List rows ~~~
+
+class RowTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        self.album = Album.objects.create(collection=self.collection, name='Album')
+        self.track = create_track(self.collection, 'track', album=self.album, lyrics='la la')
+        self.track.artists.add(Artist.objects.create(collection=self.collection, name='Artist'))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/api/collection/%d/tracks/' % self.collection.id
+
+    def rows(self, query=''):
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_default_rows_match_the_detail_route(self):
+        detail = self.client.get('/api/track/%d/' % self.track.id).data
+        self.assertEqual(self.rows(), [detail])
+        self.assertNotIn('lyrics', detail)
+
+    def test_fields_and_expand(self):
+        self.assertEqual(self.rows('?fields=id,name'), [{'id': self.track.id, 'name': 'track'}])
+        self.assertEqual(self.rows('?fields=name,lyrics'), [{'name': 'track', 'lyrics': 'la la'}])
+        self.assertEqual(self.rows('?fields=album&expand=')[0]['album'], self.album.id)
+        row = self.rows('?fields=album,artists&expand=album')[0]
+        self.assertEqual(row['album']['name'], 'Album')
+        self.assertEqual(row['artists'], list(self.track.artists.values_list('id', flat=True)))
+
+    def test_unknown_fields(self):
+        self.assertEqual(self.client.get(self.url + '?fields=id,nope').status_code, 400)
+        self.assertEqual(self.client.get(self.url + '?fields=name&expand=name').status_code, 400)
+
+
+# ~~~ Change log ~~~
+
+class ChangeLogTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, since, limit=1000):
+        response = self.client.get('/api/collection/%d/changes/?since=%d&limit=%d' % (self.collection.id, since, limit))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_a_seq(self):
+        first = create_track(self.collection, 'first')
+        second = create_track(self.collection, 'second')
+        data = self.sync(0)
+        self.assertEqual([(change['kind'], change['id'], change['action']) for change in data['changes']],
+                         [('track', first.id, Change.CREATE), ('track', second.id, Change.CREATE)])
+        self.assertEqual(data['changes'][0]['data']['name'], 'first')
+        self.assertEqual(data['seq'], Collection.objects.get(id=self.collection.id).version)
+        self.assertFalse(data['more'] or data['reset'])
+
+        seqs = list(Change.objects.filter(collection=self.collection).order_by('id').values_list('seq', flat=True))
+        self.assertEqual(seqs, sorted(set(seqs)))
+
+        # only the latest change of an object is sent
+        since = data['seq']
+        for name in ('renamed', 'renamed again'):
+            first.name = name
+            first.save()
+        second_id = second.id
+        second.delete()
+        data = self.sync(since)
+        self.assertEqual([(change['id'], change['action']) for change in data['changes']],
+                         [(first.id, Change.UPDATE), (second_id, Change.DELETE)])
+        self.assertEqual(data['changes'][0]['data']['name'], 'renamed again')
+        self.assertNotIn('data', data['changes'][1])
+        self.assertEqual(self.sync(data['seq'])['changes'], [])
+
+    def test_pages(self):
+        for i in range(5):
+            create_track(self.collection, 'track %d' % i)
+        since, ids = 0, []
+        while True:
+            data = self.sync(since, limit=2)
+            self.assertLessEqual(len(data['changes']), 2)
+            ids += [change['id'] for change in data['changes']]
+            since = data['seq']
+            if not data['more']:
+                break
+        self.assertEqual(ids, list(Track.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_compaction_horizon(self):
+        track = create_track(self.collection, 'track')
+        before = self.sync(0)['seq']
+        track.name = 'renamed'
+        track.save()
+        gone = create_track(self.collection, 'gone')
+        gone.delete()
+
+        Change.objects.filter(action=Change.DELETE).update(date=now() - timedelta(days=40))
+        superseded, removed = changes.compact(self.collection, 30)
+        self.assertEqual((superseded, removed), (2, 1))
+        self.assertEqual(Change.objects.filter(collection=self.collection).count(), 1)
+
+        # clients that may have missed the dropped delete start over
+        self.assertTrue(self.sync(before)['reset'])
+        data = self.sync(0)
+        self.assertTrue(data['reset'])
+        latest = self.sync(data['seq'])
+        self.assertFalse(latest['reset'])
+        self.assertEqual(latest['changes'], [])
+
+
+# ~~~ Exports ~~~
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        genre = Genre.objects.create(collection=self.collection, name='Genre')
+        for i in range(5):
+            create_track(self.collection, 'track %d' % i, length=timedelta(seconds=i)).genres.add(genre)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/api/collection/%d/tracks/' % self.collection.id
+
+    def export(self, query, **headers):
+        # small chunks so the export spans several of them
+        with mock.patch.object(views.CollectionTracksRoute, 'export_chunk_size', 2):
+            response = self.client.get(self.url + query, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            return response, b''.join(response.streaming_content)
+
+    def test_ndjson(self):
+        expected = self.client.get(self.url + '?fields=id,name,length,genres').json()
+        response, content = self.export('?format=ndjson&fields=id,name,length,genres')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in content.splitlines()], expected)
+        self.assertEqual(len(expected), 5)
+
+    def test_msgpack(self):
+        expected = self.client.get(self.url).json()
+        response, content = self.export('', HTTP_ACCEPT='application/x-msgpack')
+        self.assertEqual(response['Content-Type'], 'application/x-msgpack')
+        self.assertEqual(list(msgpack.Unpacker(io.BytesIO(content), raw=False)), expected)
+
+    def test_gzip(self):
+        _, plain = self.export('?format=ndjson')
+        response, content = self.export('?format=ndjson', HTTP_ACCEPT_ENCODING='gzip, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(content), plain)
+
+    def test_errors_are_one_record(self):
+        response = self.client.get(self.url + '?format=ndjson&fields=nope')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(json.loads(response.content)), ['fields'])
+
+
+# ~~~ Duplicates ~~~
+
+class DuplicateTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.owners.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.path = self.flac('song.flac', title='Song', artist='Artist')
+        with open(self.path, 'rb') as f:
+            self.content_hash = hashlib.sha256(f.read()).hexdigest()
+
+    def upload(self, name, query=''):
+        with open(self.path, 'rb') as f:
+            file = SimpleUploadedFile(name, f.read())
+        with self.captureOnCommitCallbacks():
+            response = self.client.put('/api/collection/%d/upload/%s' % (self.collection.id, query), {'file': file},
+                                       format='multipart')
+        if response.status_code == 202:
+            ingest.run_job(response.data['id'])
+        return response
+
+    def test_uploads_are_stored_by_hash(self):
+        self.assertEqual(self.upload('song.flac').status_code, 202)
+        track = Track.objects.get()
+        self.assertEqual(track.content_hash, self.content_hash)
+        self.assertIn(self.content_hash, track.audio_src.name)
+
+        response = self.upload('again.flac')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], track.id)
+        self.assertEqual(Track.objects.count(), 1)
+        self.assertEqual(IngestJob.objects.count(), 1)
+
+        self.assertEqual(self.upload('again.flac', '?on_duplicate=other').status_code, 400)
+
+    def test_linked_tracks_share_the_file(self):
+        self.upload('song.flac')
+        original = Track.objects.get()
+        response = self.upload('copy.flac', '?on_duplicate=link')
+        self.assertEqual(response.status_code, 201)
+        linked = Track.objects.get(id=response.data['id'])
+        self.assertEqual((linked.name, linked.file_name, linked.audio_src.name),
+                         ('Song', 'copy.flac', original.audio_src.name))
+        self.assertEqual(list(linked.artists.values_list('name', flat=True)), ['Artist'])
+
+        linked.delete()
+        reaper.reap()
+        self.assertTrue(default_storage.exists(original.audio_src.name))
+        original.delete()
+        reaper.reap()
+        self.assertFalse(default_storage.exists(original.audio_src.name))
+
+    def test_replace_reads_the_existing_track_again(self):
+        self.upload('song.flac')
+        original = Track.objects.get()
+        self.assertEqual(self.upload('renamed.flac', '?on_duplicate=replace').status_code, 202)
+        track = Track.objects.get()
+        self.assertEqual((track.id, track.file_name, track.name), (original.id, 'renamed.flac', 'Song'))
+
+    def test_imports_skip_known_audio(self):
+        self.upload('song.flac')
+        other = self.flac('other.flac', title='Other')
+        archive_path = os.path.join(self.media_root, 'import.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.write(self.path, 'song.flac')
+            archive.write(other, 'a/other.flac')
+            archive.write(other, 'b/other.flac')
+
+        with open(archive_path, 'rb') as f:
+            with self.captureOnCommitCallbacks():
+                response = self.client.post('/api/collection/%d/import/' % self.collection.id, {'files': [f]},
+                                            format='multipart')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.data['total'], response.data['duplicates']), (1, 2))
+        ingest.run_job(response.data['id'])
+        self.assertEqual(sorted(Track.objects.values_list('name', flat=True)), ['Other', 'Song'])
+
+
+# ~~~ Resumable uploads ~~~
+
+class ResumableUploadTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.owners.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        with open(self.flac('song.flac', title='Song'), 'rb') as f:
+            self.data = f.read()
+
+    def create(self, length=None):
+        response = self.client.post('/api/collection/%d/uploads/' % self.collection.id,
+                                    HTTP_UPLOAD_LENGTH=str(length or len(self.data)),
+                                    HTTP_UPLOAD_METADATA='filename ' + base64.b64encode(b'song.flac').decode())
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['Tus-Resumable'], resumable.TUS_VERSION)
+        return response['Location']
+
+    def patch(self, url, offset, data):
+        with self.captureOnCommitCallbacks():
+            return self.client.generic('PATCH', url, data, content_type=resumable.OFFSET_CONTENT_TYPE,
+                                       HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_upload_in_chunks(self):
+        url = self.create()
+        half = len(self.data) // 2
+        response = self.patch(url, 0, self.data[:half])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['Upload-Offset'], str(half))
+
+        # a chunk sent again after a lost response does not match the offset
+        self.assertEqual(self.patch(url, 0, self.data[:half]).status_code, 409)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], str(half))
+
+        response = self.patch(url, half, self.data[half:])
+        self.assertEqual(response.status_code, 202)
+        ingest.run_job(response.data['id'])
+        track = Track.objects.get()
+        self.assertEqual((track.name, track.content_hash), ('Song', hashlib.sha256(self.data).hexdigest()))
+        with track.audio_src.open('rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self.client.head(url).status_code, 404)
+
+    def test_resumed_sessions_hash_what_they_have(self):
+        url = self.create()
+        self.patch(url, 0, self.data[:100])
+        # another process, or this one after a restart, has no hash state for the session
+        resumable._hashers.clear()
+        response = self.patch(url, 100, self.data[100:])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Track.objects.get().content_hash, hashlib.sha256(self.data).hexdigest())
+
+    def test_hash_state_of_expired_sessions_is_evicted(self):
+        abandoned = self.create()
+        self.patch(abandoned, 0, self.data[:100])
+        session = UploadSession.objects.get()
+        # left alone past its expiry
+        offset, hasher, _ = resumable._hashers[session.id]
+        resumable._hashers[session.id] = (offset, hasher, now() - timedelta(minutes=1))
+
+        self.patch(self.create(), 0, self.data[:100])
+        self.assertNotIn(session.id, resumable._hashers)
+        self.assertIn(UploadSession.objects.latest('id').id, resumable._hashers)
+
+        # the abandoned session can still be completed, its hash is caught up from the partial file
+        response = self.patch(abandoned, 100, self.data[100:])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Track.objects.get().content_hash, hashlib.sha256(self.data).hexdigest())
+
+        other = UploadSession.objects.get()
+        UploadSession.objects.update(date_expires=now() - timedelta(minutes=1))
+        self.assertEqual(resumable.expire(), 1)
+        self.assertNotIn(other.id, resumable._hashers)
+
+    def test_cancel(self):
+        url = self.create()
+        self.patch(url, 0, self.data[:100])
+        session = UploadSession.objects.get()
+        path = default_storage.path(session.partial_name)
+        self.assertEqual(os.path.getsize(path), 100)
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertFalse(os.path.exists(path))
+
+    def test_invalid_requests(self):
+        url = self.create()
+        response = self.client.generic('PATCH', url, b'data', content_type='application/octet-stream',
+                                       HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(response.status_code, 415)
+        with self.settings(ACRIS_UPLOAD_MAX_SIZE=10):
+            response = self.client.post('/api/collection/%d/uploads/' % self.collection.id, HTTP_UPLOAD_LENGTH='11',
+                                        HTTP_UPLOAD_METADATA='filename ' + base64.b64encode(b'a.flac').decode())
+        self.assertEqual(response.status_code, 413)
+
+
+# ~~~ ASGI ~~~
+
+class StreamingASGIHandlerTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # as with django's test client, the connection of the test transaction stays open across requests
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+        self.addCleanup(request_finished.connect, close_old_connections)
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        for i in range(5):
+            create_track(self.collection, 'track %d' % i)
+
+    def request(self, method, path, query=b''):
+        async def run():
+            communicator = ApplicationCommunicator(asgi.StreamingASGIHandler(), {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                'scheme': 'http', 'path': path, 'query_string': query,
+                'headers': [(b'host', b'testserver'),
+                            (b'authorization', b'Bearer %s' % str(AccessToken.for_user(self.user)).encode())],
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 50000),
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b'', 'more_body': False})
+            start = await communicator.receive_output(5)
+            body = b''
+            while True:
+                message = await communicator.receive_output(5)
+                body += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+            await communicator.wait(5)
+            return start['status'], dict(start['headers']), body
+        return async_to_sync(run)()
+
+    def test_exports_query_the_database_off_the_event_loop(self):
+        with mock.patch.object(views.CollectionTracksRoute, 'export_chunk_size', 2):
+            status, headers, body = self.request('GET', '/api/collection/%d/tracks/' % self.collection.id,
+                                                 b'format=ndjson&fields=name')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'Content-Type'], b'application/x-ndjson')
+        self.assertEqual([json.loads(line)['name'] for line in body.splitlines()],
+                         ['track %d' % i for i in range(5)])
+
+    def test_head_requests_are_not_counted_as_streams(self):
+        track = Track.objects.get(name='track 0')
+        with open(self.flac('track.flac'), 'rb') as f:
+            track.audio_src.save('track.flac', f)
+        url = '/api/track/%d/stream/' % track.id
+        streams = metrics.STREAMS.values.get(('200',), 0)
+        status, headers, body = self.request('HEAD', url)
+        self.assertEqual((status, body), (200, b''))
+        self.assertEqual(metrics.STREAMS.values.get(('200',), 0), streams)
+
+        status, headers, body = self.request('GET', url)
+        self.assertEqual(len(body), int(headers[b'Content-Length']))
+        self.assertEqual(metrics.STREAMS.values.get(('200',), 0), streams + 1)
+
+
+# ~~~ Metrics ~~~
+
+class MetricsRouteTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_without_a_token_only_loopback_is_answered(self):
+        with self.settings(ACRIS_METRICS_TOKEN=None):
+            response = self.client.get('/api/metrics/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'acris_', response.content)
+            self.assertEqual(self.client.get('/api/metrics/', REMOTE_ADDR='::1').status_code, 200)
+            self.assertEqual(self.client.get('/api/metrics/', REMOTE_ADDR='10.0.0.2').status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_X_FORWARDED_FOR='10.0.0.2').status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_FORWARDED='for=10.0.0.2').status_code, 403)
+
+    def test_token(self):
+        with self.settings(ACRIS_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+            self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = self.client.get('/api/metrics/', REMOTE_ADDR='10.0.0.2', HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+
+# ~~~ Deletion ~~~
+
+class DeletionTests(TemporaryMediaMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.collection = create_collection()
+        self.album = Album.objects.create(collection=self.collection, name='Album')
+        self.artist = Artist.objects.create(collection=self.collection, name='Artist')
+        self.genre = Genre.objects.create(collection=self.collection, name='Genre')
+        self.tracks = []
+        for i in range(5):
+            track = create_track(self.collection, 'track %d' % i, album=self.album, length=timedelta(seconds=10))
+            with open(self.flac('%d.flac' % i), 'rb') as f:
+                track.audio_src.save('%d.flac' % i, f)
+            track.artists.add(self.artist)
+            track.genres.add(self.genre)
+            self.tracks.append(track)
+
+    def test_batches_remove_tracks_and_orphans(self):
+        names = [track.audio_src.name for track in self.tracks]
+        kept = create_track(self.collection, 'kept')
+        kept.genres.add(self.genre)
+
+        with mock.patch.object(deletion, 'BATCH_SIZE', 2):
+            self.assertEqual(deletion.delete_tracks(self.collection, [track.id for track in self.tracks]), 5)
+        self.assertEqual(list(Track.objects.values_list('id', flat=True)), [kept.id])
+        self.assertFalse(Album.objects.exists())
+        self.assertFalse(Artist.objects.exists())
+        self.assertTrue(Genre.objects.filter(id=self.genre.id).exists())
+        self.assertEqual(Collection.objects.get(id=self.collection.id).track_count, 1)
+        self.assertEqual(Change.objects.filter(kind='track', action=Change.DELETE).count(), 5)
+
+        # files are only queued by the delete, the reaper removes them
+        self.assertEqual(sorted(FileDeletion.objects.values_list('name', flat=True)), sorted(names))
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+        self.assertEqual(reaper.reap(), 5)
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+        self.assertFalse(FileDeletion.objects.exists())
+
+    def test_reaper_keeps_files_still_in_use(self):
+        shared = create_track(self.collection, 'shared', audio_src=self.tracks[0].audio_src.name)
+        deletion.delete_tracks(self.collection, [self.tracks[0].id])
+        self.assertEqual(reaper.reap(), 0)
+        self.assertTrue(default_storage.exists(shared.audio_src.name))
+        self.assertFalse(FileDeletion.objects.exists())
+
+    def test_delete_routes(self):
+        user = AcrisUser.objects.create(username='user', description='')
+        self.collection.owners.add(user)
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.delete('/api/track/%d/' % self.tracks[0].id).status_code, 204)
+        self.assertEqual(Track.objects.count(), 4)
+        self.assertEqual(client.delete('/api/album/%d/' % self.album.id).status_code, 204)
+        self.assertFalse(Track.objects.exists())
+        self.assertFalse(Album.objects.exists())
+
+    def test_gc_media(self):
+        stray = default_storage.save('collection-%d/tracks/stray.flac' % self.collection.id, io.BytesIO(b'data'))
+        os.remove(default_storage.path(self.tracks[0].audio_src.name))
+        result = reaper.gc_media(min_age=0)
+        self.assertEqual((result.unreferenced, result.missing), (1, 1))
+        self.assertFalse(default_storage.exists(stray))
+        self.assertTrue(default_storage.exists(self.tracks[1].audio_src.name))
+
+
+# ~~~ Response cache ~~~
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.user = AcrisUser.objects.create(username='user', description='')
+        self.collection = create_collection()
+        self.collection.viewers.add(self.user)
+        self.album = Album.objects.create(collection=self.collection, name='Album')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = '/api/collection/%d/albums/' % self.collection.id
+
+    def lookups(self, result):
+        return metrics.RESPONSE_CACHE.values.get((result,), 0)
+
+    def get(self, url):
+        hits = self.lookups('hit')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, self.lookups('hit') > hits
+
+    def test_hits_until_the_collection_changes(self):
+        first, hit = self.get(self.url)
+        self.assertFalse(hit)
+        second, hit = self.get(self.url)
+        self.assertTrue(hit)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertFalse(self.get(self.url + '?fields=id')[1])
+
+        self.album.name = 'Renamed'
+        self.album.save()
+        response, hit = self.get(self.url)
+        self.assertFalse(hit)
+        self.assertEqual(response.json()[0]['name'], 'Renamed')
+        self.assertFalse(self.get('/api/album/%d/' % self.album.id)[1])
+        self.assertTrue(self.get('/api/album/%d/' % self.album.id)[1])
+
+    def test_exports_are_not_cached(self):
+        self.get(self.url + '?format=ndjson')
+        self.assertFalse(self.get(self.url + '?format=ndjson')[1])
+
+
+# ~~~ Playlists ~~~
+
+class PlaylistEntryTests(TestCase):
+    def setUp(self):
+        self.collection = create_collection()
+        self.tracks = [create_track(self.collection, 'track %d' % i).id for i in range(6)]
+        self.playlist = Playlist.objects.create(name='playlist', collection=self.collection, date_created=now())
+
+    def entries(self):
+        return list(PlaylistEntry.objects.filter(playlist=self.playlist).order_by('position')
+                    .values_list('id', flat=True))
+
+    def positions(self):
+        return list(PlaylistEntry.objects.filter(playlist=self.playlist).order_by('position')
+                    .values_list('position', flat=True))
+
+    def test_append_and_insert(self):
+        added = playlists.add_tracks(self.playlist, self.tracks[:3])
+        self.assertEqual([entry.track_id for entry in added], self.tracks[:3])
+        self.assertEqual(self.positions(), [playlists.GAP, 2 * playlists.GAP, 3 * playlists.GAP])
+
+        inserted = playlists.add_tracks(self.playlist, [self.tracks[5], self.tracks[5]], before=added[1].id)
+        self.assertEqual(self.entries(), [added[0].id, inserted[0].id, inserted[1].id, added[1].id, added[2].id])
+
+    def test_moves_keep_order_and_unique_positions(self):
+        playlists.add_tracks(self.playlist, self.tracks)
+        expected = self.entries()
+        # moving the last entry in front of the second one over and over uses up the gap and renumbers
+        for _ in range(40):
+            last = expected.pop()
+            expected.insert(1, last)
+            playlists.move_entries(self.playlist, [last], before=expected[2])
+            self.assertEqual(self.entries(), expected)
+        self.assertEqual(len(set(self.positions())), len(expected))
+
+        moved = [expected[4], expected[0]]
+        playlists.move_entries(self.playlist, moved)
+        self.assertEqual(self.entries(), [entry for entry in expected if entry not in moved] + moved)
+
+    def test_renumber(self):
+        playlists.add_tracks(self.playlist, self.tracks[:3])
+        entries = self.entries()
+        playlists.renumber(self.playlist, before=entries[1], count=2)
+        self.assertEqual(self.entries(), entries)
+        self.assertEqual(self.positions(), [playlists.GAP, 4 * playlists.GAP, 5 * playlists.GAP])
+
+    def test_invalid_moves(self):
+        playlists.add_tracks(self.playlist, self.tracks[:3])
+        entries = self.entries()
+        invalid = (([entries[0], entries[0]], None), ([entries[0]], entries[0]), ([0], None), ([], None))
+        for entry_ids, before in invalid:
+            with self.assertRaises(ValidationError):
+                playlists.move_entries(self.playlist, entry_ids, before)
+        self.assertEqual(self.entries(), entries)
+
+    def test_positions_are_unique(self):
+        added = playlists.add_tracks(self.playlist, self.tracks[:2])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PlaylistEntry.objects.filter(id=added[1].id).update(position=added[0].position)
+
+    def test_remove(self):
+        playlists.add_tracks(self.playlist, self.tracks[:3])
+        entries = self.entries()
+        self.assertEqual(playlists.remove_entries(self.playlist, [entries[1]]), 1)
+        self.assertEqual(self.entries(), [entries[0], entries[2]])
+
+    def test_deleted_tracks_leave_playlists(self):
+        playlists.add_tracks(self.playlist, self.tracks[:3])
+        entries = self.entries()
+        deletion.delete_tracks(self.collection, [self.tracks[1]])
+        self.assertEqual(self.entries(), [entries[0], entries[2]])
+        seq = Collection.objects.get(id=self.collection.id).version
+        self.assertTrue(Change.objects.filter(kind='playlist', object_id=self.playlist.id, action=Change.UPDATE,
+                                              seq=seq).exists())
+
+
+# ~~~ Smart playlist rules ~~~
+
+class RuleParserTests(SimpleTestCase):
+    def test_tokenize(self):
+        self.assertEqual(rules.tokenize('genre = "Free Jazz" and(year<1970)'), [
+            ('word', 'genre'), ('word', '='), ('value', 'Free Jazz'), ('word', 'and'), ('word', '('),
+            ('word', 'year'), ('word', '<'), ('word', '1970'), ('word', ')'),
+        ])
+        self.assertEqual(rules.tokenize(r'''name = "say \"hi\"" or name = 'a b' '''),
+                         [('word', 'name'), ('word', '='), ('value', 'say "hi"'), ('word', 'or'),
+                          ('word', 'name'), ('word', '='), ('value', 'a b')])
+
+    def test_precedence(self):
+        self.assertEqual(rules.Parser('genre = a or genre = b and not year = 1').parse(), ('or', [
+            ('compare', 'genre', '=', 'a'),
+            ('and', [('compare', 'genre', '=', 'b'), ('not', ('compare', 'year', '=', 1))]),
+        ]))
+        self.assertEqual(rules.Parser('(genre = a OR genre = b) AND length > 60').parse(), ('and', [
+            ('or', [('compare', 'genre', '=', 'a'), ('compare', 'genre', '=', 'b')]),
+            ('compare', 'length', '>', timedelta(seconds=60)),
+        ]))
+
+    def test_dates(self):
+        self.assertEqual(rules.Parser('added in last 2 weeks').parse(), ('recent', 'added', timedelta(days=14)))
+        node = rules.Parser('added >= 2024-01-31').parse()
+        self.assertEqual(node[:3], ('compare', 'added', '>='))
+        self.assertEqual(node[3].date().isoformat(), '2024-01-31')
+
+    def test_errors(self):
+        for text in ('', 'genre', 'genre =', 'genre ~ x', 'foo = 1', '(genre = a', 'genre = a)', 'genre = a and',
+                     'length contains 3', 'length > long', 'year < abc', 'added in last x days',
+                     'added in last 2 months', 'added = yesterday', 'name = "open'):
+            with self.assertRaises(rules.RuleError, msg=text):
+                rules.compile_rules(text)
+
+
+class RuleMatchingTests(TestCase):
+    def setUp(self):
+        self.collection = create_collection()
+        jazz = Genre.objects.create(collection=self.collection, name='Jazz')
+        for name, seconds, year, genre in (('a', 100, '1959', jazz), ('b', 400, '1969-05-01', None),
+                                           ('c', 200, '2005', jazz), ('d', 500, '', jazz),
+                                           ('e', 50, 'unknown', None), ('f', 300, '1000', None)):
+            track = create_track(self.collection, name, length=timedelta(seconds=seconds), year=year)
+            if genre:
+                track.genres.add(genre)
+        Track.objects.filter(name='f').update(date_uploaded=now() - timedelta(days=40))
+
+    def match(self, text):
+        query = rules.compile_rules(text)()
+        return sorted(rules.annotate(Track.objects.filter(collection=self.collection)).filter(query)
+                      .values_list('name', flat=True))
+
+    def test_matching(self):
+        self.assertEqual(self.match('genre = jazz and length < 300'), ['a', 'c'])
+        self.assertEqual(self.match('genre = JAZZ or length >= 400'), ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.match('name != c and genre = jazz'), ['a', 'd'])
+        self.assertEqual(self.match('not genre = jazz'), ['b', 'e', 'f'])
+        self.assertEqual(self.match('genre = jazz and year < 1970'), ['a'])
+        self.assertEqual(self.match('year > 199'), ['a', 'b', 'c', 'f'])
+        self.assertEqual(self.match('year != 2005'), ['a', 'b', 'f'])
+        self.assertEqual(self.match('added in last 30 days and name contains E'), ['e'])
+        self.assertEqual(self.match('not added in last 30 days'), ['f'])
+
+    def test_negated_year_conditions_need_a_year(self):
+        self.assertEqual(self.match('not year = 2005'), ['a', 'b', 'f'])
+        self.assertEqual(self.match('not not year = 2005'), ['c'])
+        self.assertEqual(self.match('not (year < 1970 and genre = jazz)'), ['b', 'c', 'e', 'f'])
+        self.assertEqual(self.match('not (year < 1970 or name = e)'), ['c'])
+
+
+class SmartPlaylistTests(TestCase):
+    def setUp(self):
+        self.collection = create_collection()
+        self.jazz = Genre.objects.create(collection=self.collection, name='Jazz')
+        self.playlist = Playlist.objects.create(name='smart', collection=self.collection, date_created=now(),
+                                                rules='genre = jazz and length > 60')
+
+    def members(self):
+        return sorted(PlaylistEntry.objects.filter(playlist=self.playlist).values_list('track__name', flat=True))
+
+    def test_membership_follows_the_tracks(self):
+        track = create_track(self.collection, 'a', length=timedelta(seconds=100))
+        self.assertEqual(self.members(), [])
+        track.genres.add(self.jazz)
+        self.assertEqual(self.members(), ['a'])
+
+        track.length = timedelta(seconds=30)
+        track.save()
+        self.assertEqual(self.members(), [])
+
+        create_track(self.collection, 'b', length=timedelta(seconds=100)).genres.add(self.jazz)
+        self.assertEqual(self.members(), ['b'])
+        self.jazz.name = 'Bebop'
+        self.jazz.save()
+        self.assertEqual(self.members(), [])
+
+    def test_rules_changes_refill_the_playlist(self):
+        for name in ('a', 'b'):
+            create_track(self.collection, name, length=timedelta(seconds=100))
+        self.playlist.rules = 'name = b'
+        self.playlist.save()
+        self.assertEqual(self.members(), ['b'])
+
+    def test_entries_cannot_be_added_by_hand(self):
+        track = create_track(self.collection, 'a')
+        with self.assertRaises(ValidationError):
+            playlists.add_tracks(self.playlist, [track.id])
@@ -1,21 +1,45 @@
-import os
+import hashlib
+import hmac
+import logging
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
-from django.http import Http404
-from django.http.response import HttpResponse
+from django.db.models import F, Q
+from django.http import Http404, HttpResponse
+from django.urls import reverse
 from django.utils.timezone import make_aware
 from rest_framework import permissions, generics, status, filters
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-import acris.core.audio as audio
+import acris.core.changes as changes
+import acris.core.deletion as deletion
+import acris.core.duplicates as duplicates
+import acris.core.importer as importer
+import acris.core.ingest as ingest
+import acris.core.metrics as metrics
+import acris.core.playlists as playlists
+import acris.core.resumable as resumable
+import acris.core.search as search
 import acris.core.serializers as serializers
-from acris.core.models import AcrisUser, Collection, Artist, Playlist, Album, Genre, Track
-from acris.core.permissions import HasCollectionPermissionOrReadOnly
+import acris.core.streaming as streaming
+from acris.core.caching import CachedResponseMixin
+from acris.core.conditional import ConditionalGetMixin
+from acris.core.models import AcrisUser, Collection, Artist, Playlist, Album, Genre, Track, IngestJob, \
+    UploadSession
+from acris.core.pagination import KeysetPagination
+from acris.core.rows import RowListMixin, TrackRowSerializer, AlbumRowSerializer, ArtistRowSerializer, \
+    GenreRowSerializer, PlaylistTrackRowSerializer
+from acris.core.permissions import CollectionScopedMixin, HasCollectionPermissionOrReadOnly, \
+    HasSubCollectionPermissionOrReadOnly
+
+logger = logging.getLogger(__name__)
+
+# api/metrics answers these without a token
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1')
 
 
 def get_collection(collection_id):
@@ -25,6 +49,48 @@ def get_collection(collection_id):
         raise Http404
 
 
+# every relation TrackSerializer renders, fetched in a fixed number of queries regardless of page size
+def track_queryset():
+    return Track.objects.select_related('album').prefetch_related('artists', 'genres', 'playlists', 'album__artists') \
+        .defer('lyrics')
+
+
+# in debug mode, report routes that run more queries than their budget
+class QueryBudgetMixin:
+    query_budget = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.query_budget is None or not settings.DEBUG:
+            return super().dispatch(request, *args, **kwargs)
+
+        timer = metrics.QueryTimer()
+        with metrics.timed_queries(timer):
+            response = super().dispatch(request, *args, **kwargs)
+        if timer.count > self.query_budget:
+            logger.warning('query budget exceeded', extra={'path': request.path, 'queries': timer.count,
+                                                           'budget': self.query_budget})
+        return response
+
+
+# route: api/metrics
+class MetricsRoute(APIView):
+    # scraped without a user, ACRIS_METRICS_TOKEN has to be sent as a bearer token instead. Without a token only
+    # requests from loopback are answered, and not ones a local reverse proxy forwarded
+    authentication_classes = ()
+    permission_classes = ()
+
+    def get(self, request, format=None):
+        token = settings.ACRIS_METRICS_TOKEN
+        if token:
+            allowed = hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+        else:
+            allowed = request.META.get('REMOTE_ADDR') in LOOPBACK_ADDRESSES and \
+                not any(header in request.META for header in ('HTTP_X_FORWARDED_FOR', 'HTTP_FORWARDED'))
+        if not allowed:
+            return HttpResponse(status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # route: api/user/<user_id>
 class UserRoute(APIView):
     def get(self, request, user_id, format=None):
@@ -43,9 +109,18 @@ class CurrentUserRoute(APIView):
 
 
 # route: api/collections
-class CollectionsListRoute(APIView):
+class CollectionsListRoute(ConditionalGetMixin, APIView):
     permission_classes = [permissions.IsAuthenticated]
 
+    # the list changes with the version of any collection in it
+    def get_validators(self):
+        user = self.request.user
+        versions = list(Collection.objects.filter(Q(viewers=user) | Q(owners=user)).distinct().order_by('id')
+                        .values_list('id', 'version'))
+        digest = hashlib.sha1(repr(versions).encode()).hexdigest()
+        # no Last-Modified, a collection leaving the list would not move it forward
+        return '"u%d.%s.%s"' % (user.id, digest, self.request.accepted_renderer.format), None
+
     def get(self, request, format=None):
         user = self.request.user
         collections = Collection.objects.filter(Q(viewers=user) | Q(owners=user))
@@ -56,12 +131,11 @@ class CollectionsListRoute(APIView):
         if serializer.is_valid():
             serializer.save(date_created=make_aware(datetime.now()))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
-        print(serializer.errors)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 # route: api/collection/<collection_id>
-class CollectionRoute(APIView):
+class CollectionRoute(ConditionalGetMixin, APIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly, HasCollectionPermissionOrReadOnly]
 
     def get(self, request, collection_id, format=None):
@@ -79,65 +153,294 @@ class CollectionRoute(APIView):
 
     def delete(self, request, collection_id, format=None):
         collection = get_collection(collection_id)
-        collection.delete()
+        deletion.delete_collection(collection)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 # route: api/collection/<collection_id>/upload
-class CollectionUploadRoute(APIView):
+class CollectionUploadRoute(CollectionScopedMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     parser_classes = (MultiPartParser,)
 
     def put(self, request, collection_id, format=None):
+        on_duplicate = duplicate_mode(request.query_params.get('on_duplicate', duplicates.SKIP))
         try:
             collection = get_collection(collection_id)
             file = request.FILES['file']
+            return accept_upload(request, collection, file.name, duplicates.upload_hash(file), on_duplicate,
+                                 lambda: file)
+        except Http404:
+            raise
+        except Exception:
+            logger.exception('upload failed', extra={'collection': collection_id})
+        return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def duplicate_mode(value):
+    if value not in duplicates.MODES:
+        raise ValidationError({'on_duplicate': ['Expected one of: %s.' % ', '.join(duplicates.MODES)]})
+    return value
+
+
+# the response to a received upload: the existing track when it is a skipped duplicate, the linked track, or the
+# ingest job reading the new (or replaced) track. audio returns what to store as audio_src of a new track
+def accept_upload(request, collection, file_name, content_hash, on_duplicate, audio):
+    existing = duplicates.find_duplicate(collection, content_hash)
+    if existing is not None and on_duplicate == duplicates.SKIP:
+        return Response(serializers.TrackSerializer(existing, context={'request': request}).data)
+    if existing is not None and on_duplicate == duplicates.LINK:
+        track = duplicates.link_track(existing, file_name)
+        return Response(serializers.TrackSerializer(track, context={'request': request}).data,
+                        status=status.HTTP_201_CREATED)
+
+    if existing is not None:
+        track = duplicates.replace_track(existing, file_name)
+    else:
+        track = Track(date_uploaded=make_aware(datetime.now()), collection=collection, file_name=file_name,
+                      audio_src=audio(), content_hash=content_hash)
+        track.save()
+
+    # metadata is extracted in the background, clients poll api/ingest/<job_id>
+    job = IngestJob(date_created=make_aware(datetime.now()), collection=collection, track=track)
+    job.save()
+    ingest.submit(job)
+    return Response(serializers.IngestJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+# route: api/collection/<collection_id>/uploads
+class CollectionResumableUploadsRoute(resumable.TusMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def post(self, request, collection_id, format=None):
+        collection = get_collection(collection_id)
+        try:
+            length = int(request.META['HTTP_UPLOAD_LENGTH'])
+            metadata = resumable.parse_metadata(request.META.get('HTTP_UPLOAD_METADATA', ''))
+        except (KeyError, ValueError):
+            return Response({'Upload-Length': ['A valid Upload-Length header is required.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        file_name = metadata.get('filename') or metadata.get('name')
+        if length <= 0 or not file_name:
+            return Response({'Upload-Metadata': ['A non-empty upload with a filename is required.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        on_duplicate = duplicate_mode(metadata.get('on_duplicate') or
+                                      request.query_params.get('on_duplicate', duplicates.SKIP))
+
+        session = resumable.create(collection, request.user, file_name, length, on_duplicate)
+        response = Response(status=status.HTTP_201_CREATED)
+        response['Location'] = request.build_absolute_uri(reverse('upload-session', args=[session.id]))
+        return resumable.upload_headers(response, session)
+
+
+# route: api/upload/<upload_id>
+class ResumableUploadRoute(resumable.TusMixin, APIView):
+    collection_model = UploadSession
+    collection_kwarg = 'upload_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    # sessions are only visible to the user who started them
+    def get_session(self, upload_id):
+        try:
+            return UploadSession.objects.select_related('collection').get(id=upload_id, user=self.request.user)
+        except UploadSession.DoesNotExist:
+            raise Http404
+
+    def head(self, request, upload_id, format=None):
+        return resumable.upload_headers(Response(status=status.HTTP_200_OK), self.get_session(upload_id))
 
-            track = Track(date_uploaded=make_aware(datetime.now()), collection=collection, file_name=file.name,
-                          audio_src=file)
-            track.save()
+    def patch(self, request, upload_id, format=None):
+        session = self.get_session(upload_id)
+        if request.content_type.split(';')[0].strip() != resumable.OFFSET_CONTENT_TYPE:
+            return Response(status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+        except (KeyError, ValueError):
+            return Response({'Upload-Offset': ['A valid Upload-Offset header is required.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        resumable.write(session, offset, request.stream)
+        if session.offset < session.length:
+            return resumable.upload_headers(Response(status=status.HTTP_204_NO_CONTENT), session)
+
+        file_hash = resumable.content_hash(session)
+        response = accept_upload(request, session.collection, session.file_name, file_hash, session.on_duplicate,
+                                 lambda: resumable.store(session, file_hash))
+        resumable.discard(session)
+        return resumable.upload_headers(response, session)
+
+    def delete(self, request, upload_id, format=None):
+        resumable.discard(self.get_session(upload_id))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# route: api/collection/<collection_id>/import
+class CollectionImportRoute(CollectionScopedMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+    parser_classes = (MultiPartParser,)
 
-            # add metadata to db
-            audio.setup_track_from_file(track)
-            return Response(status.HTTP_201_CREATED)
-        except Exception as e:
-            print(e)
-        return Response(status.HTTP_500_INTERNAL_SERVER_ERROR)
+    def post(self, request, collection_id, format=None):
+        collection = get_collection(collection_id)
+        try:
+            names = []
+            skipped = 0
+            seen = set()
+            for file in request.FILES.getlist('files'):
+                stored, duplicate_count = importer.store_upload(collection, file, seen)
+                names += stored
+                skipped += duplicate_count
+        except Exception:
+            logger.warning('could not store import', exc_info=True, extra={'collection': collection_id})
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if not names and skipped:
+            return Response({'duplicates': skipped})
+        if not names:
+            return Response({'files': ['No audio files or archives were uploaded.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        job = IngestJob(date_created=make_aware(datetime.now()), collection=collection, kind=IngestJob.IMPORT,
+                        total=len(names), files=names, duplicates=skipped)
+        job.save()
+        ingest.submit(job)
+        return Response(serializers.IngestJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+# route: api/collection/<collection_id>/retag
+class CollectionRetagRoute(CollectionScopedMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def post(self, request, collection_id, format=None):
+        collection = get_collection(collection_id)
+        job = IngestJob(date_created=make_aware(datetime.now()), collection=collection, kind=IngestJob.RETAG, total=0)
+        job.save()
+        ingest.submit(job)
+        return Response(serializers.IngestJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+
+# route: api/ingest/<job_id>
+class IngestJobRoute(CollectionScopedMixin, APIView):
+    collection_model = IngestJob
+    collection_kwarg = 'job_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            serializer = serializers.IngestJobSerializer(IngestJob.objects.get(id=kwargs['job_id']))
+            return Response(serializer.data)
+        except IngestJob.DoesNotExist:
+            raise Http404
 
 
 # route: api/collection/<collection_id>/tracks
-class CollectionTracksRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class CollectionTracksRoute(QueryBudgetMixin, ConditionalGetMixin, RowListMixin, generics.ListAPIView):
+    query_budget = 12
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.TrackSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'file_name']
+    row_serializer_class = TrackRowSerializer
+    filter_backends = [search.FullTextSearchFilter, filters.OrderingFilter]
     ordering_fields = ['name', 'year']
     ordering = ['name']
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Track.objects.filter(collection=self.kwargs['collection_id'])
 
 
+# route: api/collection/<collection_id>/search
+class CollectionSearchRoute(ConditionalGetMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def get(self, request, collection_id, format=None):
+        text = request.query_params.get('q', '')
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), 100)
+        except ValueError:
+            limit = 10
+
+        if search.enabled():
+            track_ids = search.search_tracks(collection_id, text, limit)
+            found = track_queryset().in_bulk(track_ids)
+            tracks = [found[track_id] for track_id in track_ids if track_id in found]
+            albums = self.ranked(Album.objects.prefetch_related('artists'), collection_id, text, limit)
+            artists = self.ranked(Artist.objects, collection_id, text, limit)
+            genres = self.ranked(Genre.objects, collection_id, text, limit)
+        else:
+            tracks = track_queryset().filter(collection=collection_id, name__icontains=text)[:limit]
+            albums = Album.objects.prefetch_related('artists').filter(collection=collection_id,
+                                                                      name__icontains=text)[:limit]
+            artists = Artist.objects.filter(collection=collection_id, name__icontains=text)[:limit]
+            genres = Genre.objects.filter(collection=collection_id, name__icontains=text)[:limit]
+
+        return Response({
+            'tracks': serializers.TrackSerializer(tracks, many=True).data,
+            'albums': serializers.AlbumSerializer(albums, many=True).data,
+            'artists': serializers.ArtistSerializer(artists, many=True).data,
+            'genres': serializers.GenreSerializer(genres, many=True).data,
+        })
+
+    @staticmethod
+    def ranked(queryset, collection_id, text, limit):
+        ids = search.search_entities(queryset.model, collection_id, text, limit)
+        objects = queryset.in_bulk(ids)
+        return [objects[entity_id] for entity_id in ids if entity_id in objects]
+
+
+# route: api/collection/<collection_id>/changes
+class CollectionChangesRoute(ConditionalGetMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def get(self, request, collection_id, format=None):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = min(int(request.query_params.get('limit', 1000)), 10000)
+        except ValueError:
+            raise ValidationError({'since': ['since and limit must be integers.']})
+
+        version, horizon = Collection.objects.filter(id=collection_id).values_list('version', 'changes_horizon') \
+            .first() or (0, 0)
+        return Response(changes.sync(request, collection_id, version, horizon, since, max(limit, 1)))
+
+
 # route: api/track/<track_id>
-class TrackRoute(APIView):
+class TrackRoute(CachedResponseMixin, APIView):
+    collection_model = Track
+    collection_kwarg = 'track_id'
     serializer_class = serializers.TrackSerializer
-    permission_classes = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
-            serializer = serializers.TrackSerializer(Track.objects.get(id=kwargs['track_id']))
+            serializer = serializers.TrackSerializer(track_queryset().get(id=kwargs['track_id']))
             return Response(serializer.data)
         except Track.DoesNotExist:
             raise Http404
 
     def delete(self, request, format=None, *args, **kwargs):
-        Track.objects.get(id=kwargs['track_id']).delete()
+        try:
+            track = Track.objects.select_related('collection').get(id=kwargs['track_id'])
+        except Track.DoesNotExist:
+            raise Http404
+        deletion.delete_tracks(track.collection, [track.id])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+# route: api/track/<track_id>/lyrics
+class TrackLyricsRoute(ConditionalGetMixin, APIView):
+    collection_model = Track
+    collection_kwarg = 'track_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            track = Track.objects.only('id', 'lyrics').get(id=kwargs['track_id'])
+            return Response(serializers.TrackLyricsSerializer(track).data)
+        except Track.DoesNotExist:
+            raise Http404
+
+
 # route: api/collection/<collection_id>/playlists
-class CollectionPlaylistsRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class CollectionPlaylistsRoute(ConditionalGetMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.PlaylistSerializer
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
@@ -147,11 +450,42 @@ class CollectionPlaylistsRoute(generics.ListAPIView):
     def get_queryset(self):
         return Playlist.objects.filter(collection=self.kwargs['collection_id'])
 
+    def post(self, request, collection_id, format=None):
+        collection = get_collection(collection_id)
+        serializer = serializers.PlaylistSerializer(data=request.data)
+        if serializer.is_valid():
+            serializer.save(collection=collection, date_created=make_aware(datetime.now()))
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+def get_playlist(playlist_id):
+    try:
+        return Playlist.objects.select_related('collection').get(id=playlist_id)
+    except Playlist.DoesNotExist:
+        raise Http404
+
+
+def id_list(data, name):
+    values = data.get(name)
+    if not isinstance(values, list) or not all(type(value) is int for value in values):
+        raise ValidationError({name: ['Expected a list of ids.']})
+    return values
+
+
+def optional_id(data, name):
+    value = data.get(name)
+    if value is not None and type(value) is not int:
+        raise ValidationError({name: ['Expected an id.']})
+    return value
+
 
 # route: api/playlist/<playlist_id>
-class PlaylistRoute(generics.RetrieveAPIView):
+class PlaylistRoute(ConditionalGetMixin, generics.RetrieveAPIView):
+    collection_model = Playlist
+    collection_kwarg = 'playlist_id'
     serializer_class = serializers.PlaylistSerializer
-    permission_classes = [permissions.IsAuthenticated]
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
@@ -160,76 +494,145 @@ class PlaylistRoute(generics.RetrieveAPIView):
         except Playlist.DoesNotExist:
             raise Http404
 
+    def post(self, request, *args, **kwargs):
+        serializer = serializers.PlaylistSerializer(get_playlist(kwargs['playlist_id']), data=request.data,
+                                                    partial=True)
+        if serializer.is_valid():
+            serializer.save()
+            return Response(serializer.data)
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    def delete(self, request, *args, **kwargs):
+        deletion.delete_playlist(get_playlist(kwargs['playlist_id']))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+# route: api/playlist/<playlist_id>/entries
+class PlaylistEntriesRoute(CollectionScopedMixin, APIView):
+    collection_model = Playlist
+    collection_kwarg = 'playlist_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
+
+    # add {"tracks": [...]} in front of the entry {"before": id}, at the end without it
+    def post(self, request, *args, **kwargs):
+        entries = playlists.add_tracks(get_playlist(kwargs['playlist_id']), id_list(request.data, 'tracks'),
+                                       optional_id(request.data, 'before'))
+        return Response(serializers.PlaylistEntrySerializer(entries, many=True).data, status=status.HTTP_201_CREATED)
+
+    # move {"entries": [...]} in front of the entry {"before": id}, to the end without it
+    def patch(self, request, *args, **kwargs):
+        entries = playlists.move_entries(get_playlist(kwargs['playlist_id']), id_list(request.data, 'entries'),
+                                         optional_id(request.data, 'before'))
+        return Response(serializers.PlaylistEntrySerializer(entries, many=True).data)
+
+    # remove {"entries": [...]}
+    def delete(self, request, *args, **kwargs):
+        removed = playlists.remove_entries(get_playlist(kwargs['playlist_id']), id_list(request.data, 'entries'))
+        return Response({'removed': removed})
+
 
 # route: api/playlist/<playlist_id>/tracks
-class PlaylistTracksRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class PlaylistTracksRoute(QueryBudgetMixin, ConditionalGetMixin, RowListMixin, generics.ListAPIView):
+    collection_model = Playlist
+    collection_kwarg = 'playlist_id'
+    query_budget = 12
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.TrackSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'file_name']
-    ordering_fields = ['name', 'year']
-    ordering = ['name']
-    pagination_class = LimitOffsetPagination
+    row_serializer_class = PlaylistTrackRowSerializer
+    filter_backends = [search.FullTextSearchFilter, filters.OrderingFilter]
+    ordering_fields = ['position', 'name', 'year']
+    ordering = ['position']
+    pagination_class = KeysetPagination
 
+    # one row per entry, a track in the playlist twice is listed twice
     def get_queryset(self):
-        return Track.objects.filter(playlists__id=self.kwargs['playlist_id'])
+        return Track.objects.filter(playlistentry__playlist_id=self.kwargs['playlist_id']) \
+            .annotate(entry=F('playlistentry__id'), position=F('playlistentry__position'))
+
+    # position is unique in a playlist, it breaks ties between entries of the same track for keyset pages
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        ordering = list(queryset.query.order_by)
+        if 'position' not in ordering and '-position' not in ordering:
+            queryset = queryset.order_by(*ordering, 'position')
+        return queryset
 
 
 # route: api/collection/<collection_id>/albums
-class CollectionAlbumsRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class CollectionAlbumsRoute(QueryBudgetMixin, CachedResponseMixin, RowListMixin, generics.ListAPIView):
+    query_budget = 7
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.AlbumSerializer
+    row_serializer_class = AlbumRowSerializer
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
     ordering_fields = ['name']
     ordering = ['name']
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Album.objects.filter(collection=self.kwargs['collection_id'])
 
 
 # route: api/album/<album_id>
-class AlbumRoute(generics.RetrieveAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class AlbumRoute(CachedResponseMixin, generics.RetrieveAPIView):
+    collection_model = Album
+    collection_kwarg = 'album_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
-            serializer = serializers.AlbumSerializer(Album.objects.get(id=kwargs['album_id']))
+            serializer = serializers.AlbumSerializer(Album.objects.prefetch_related('artists').get(id=kwargs['album_id']))
             return Response(serializer.data)
         except Album.DoesNotExist:
             raise Http404
 
+    def delete(self, request, *args, **kwargs):
+        try:
+            album = Album.objects.select_related('collection').get(id=kwargs['album_id'])
+        except Album.DoesNotExist:
+            raise Http404
+        deletion.delete_album(album)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 
 # route: api/album/<album_id>/tracks
-class AlbumTracksRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class AlbumTracksRoute(QueryBudgetMixin, ConditionalGetMixin, RowListMixin, generics.ListAPIView):
+    collection_model = Album
+    collection_kwarg = 'album_id'
+    query_budget = 12
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.TrackSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'file_name']
+    row_serializer_class = TrackRowSerializer
+    filter_backends = [search.FullTextSearchFilter, filters.OrderingFilter]
     ordering_fields = ['name', 'year']
     ordering = ['name']
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Track.objects.filter(album__id=self.kwargs['album_id'])
 
 
 # route: api/collection/<collection_id>/artists
-class CollectionArtistsRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class CollectionArtistsRoute(CachedResponseMixin, RowListMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.ArtistSerializer
+    row_serializer_class = ArtistRowSerializer
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
     ordering_fields = ['name']
     ordering = ['name']
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Artist.objects.filter(collection=self.kwargs['collection_id'])
 
 
 # route: api/artist/<artist_id>
-class ArtistRoute(generics.RetrieveAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class ArtistRoute(ConditionalGetMixin, generics.RetrieveAPIView):
+    collection_model = Artist
+    collection_kwarg = 'artist_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
@@ -240,35 +643,42 @@ class ArtistRoute(generics.RetrieveAPIView):
 
 
 # route: api/artist/<artist_id>/tracks
-class ArtistTracksRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class ArtistTracksRoute(QueryBudgetMixin, ConditionalGetMixin, RowListMixin, generics.ListAPIView):
+    collection_model = Artist
+    collection_kwarg = 'artist_id'
+    query_budget = 12
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.TrackSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'file_name']
+    row_serializer_class = TrackRowSerializer
+    filter_backends = [search.FullTextSearchFilter, filters.OrderingFilter]
     ordering_fields = ['name', 'year']
     ordering = ['name']
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Track.objects.filter(artists__id=self.kwargs['artist_id'])
 
 
 # route: api/collection/<collection_id>/genres
-class CollectionGenresRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class CollectionGenresRoute(CachedResponseMixin, RowListMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.GenreSerializer
+    row_serializer_class = GenreRowSerializer
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name']
     ordering_fields = ['name']
     ordering = ['name']
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Genre.objects.filter(collection=self.kwargs['collection_id'])
 
 
 # route: api/genre/<genre_id>
-class GenreRoute(generics.RetrieveAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class GenreRoute(ConditionalGetMixin, generics.RetrieveAPIView):
+    collection_model = Genre
+    collection_kwarg = 'genre_id'
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
@@ -279,35 +689,36 @@ class GenreRoute(generics.RetrieveAPIView):
 
 
 # route: api/genre/<genre_id>/tracks
-class GenreTracksRoute(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
+class GenreTracksRoute(QueryBudgetMixin, ConditionalGetMixin, RowListMixin, generics.ListAPIView):
+    collection_model = Genre
+    collection_kwarg = 'genre_id'
+    query_budget = 12
+    permission_classes = [permissions.IsAuthenticated, HasSubCollectionPermissionOrReadOnly]
     serializer_class = serializers.TrackSerializer
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name', 'file_name']
+    row_serializer_class = TrackRowSerializer
+    filter_backends = [search.FullTextSearchFilter, filters.OrderingFilter]
     ordering_fields = ['name', 'year']
     ordering = ['name']
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         return Track.objects.filter(genres__id=self.kwargs['genre_id'])
 
 
 # route: api/track/<track_id>/stream
-class TrackStreamRoute(APIView):
-    permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+class TrackStreamRoute(CollectionScopedMixin, APIView):
+    collection_model = Track
+    collection_kwarg = 'track_id'
+    permission_classes = [permissions.IsAuthenticatedOrReadOnly, HasSubCollectionPermissionOrReadOnly]
 
     def get(self, request, *args, **kwargs):
         try:
             track = Track.objects.get(id=kwargs['track_id'])
-            fsock = track.audio_src.open('rb')
-            response = HttpResponse(fsock)
-            response['Content-Type'] = track.audio_format
+            response = streaming.file_response(request, track.audio_src.path, track.audio_format)
             response['Content-Disposition'] = 'attachment; filename=%s' % (track.file_name.replace(' ', '-'),)
-            response['Content-Length'] = os.path.getsize(track.audio_src.path)
-            response['Accept-Ranges'] = 'bytes'
             return response
         except Track.DoesNotExist:
             raise Http404
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception('stream failed', extra={'track': kwargs['track_id']})
         return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
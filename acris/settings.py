@@ -28,6 +28,22 @@ CORS_ALLOW_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
     'content-disposition',
+    'tus-resumable',
+    'upload-length',
+    'upload-metadata',
+    'upload-offset',
+]
+
+# read by browser tus clients, see acris.core.resumable
+CORS_EXPOSE_HEADERS = [
+    'location',
+    'tus-resumable',
+    'tus-version',
+    'tus-extension',
+    'tus-max-size',
+    'upload-expires',
+    'upload-length',
+    'upload-offset',
 ]
 
 
@@ -45,6 +61,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'acris.core.metrics.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
 
     'django.middleware.security.SecurityMiddleware',
@@ -62,6 +79,85 @@ REST_FRAMEWORK = {
     ),
 }
 
+# json lines on stderr, see acris.core.logs
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'acris.core.logs.JSONFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'acris': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'django': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}
+
+# bearer token Prometheus has to send to scrape api/metrics, without one only direct requests from loopback are answered
+ACRIS_METRICS_TOKEN = None
+
+# number of background threads extracting metadata from uploaded files
+ACRIS_INGEST_WORKERS = 2
+
+# number of processes parsing tags during bulk imports
+ACRIS_IMPORT_PROCESSES = os.cpu_count()
+
+# seconds a user's collection access map is cached, changes to owners and viewers invalidate it right away
+# in this process, other processes only see them early if CACHES points at a shared cache
+ACRIS_ACL_CACHE_TIMEOUT = 300
+
+# the access maps above and rendered responses (acris.core.caching) are kept in local memory, least recently used
+# entries are evicted past MAX_ENTRIES. Use a FileBasedCache, or a shared cache server, for 'responses' to share
+# entries between processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'acris',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'acris-responses',
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 2000,
+            'CULL_FREQUENCY': 4,
+        },
+    },
+}
+
+# cache alias responses are cached in, None turns the response cache off
+ACRIS_RESPONSE_CACHE = 'responses'
+
+# responses larger than this many bytes are not cached
+ACRIS_RESPONSE_CACHE_MAX_SIZE = 512 * 1024
+
+# uploads are hashed while they stream in, see acris.core.uploads
+FILE_UPLOAD_HANDLERS = [
+    'acris.core.uploads.HashingMemoryFileUploadHandler',
+    'acris.core.uploads.HashingTemporaryFileUploadHandler',
+]
+
+# resumable uploads (api/collection/<id>/uploads) larger than this are refused, and partial uploads not written to
+# for this many hours are removed by manage.py expire_uploads
+ACRIS_UPLOAD_MAX_SIZE = 8 * 1024 ** 3
+ACRIS_UPLOAD_EXPIRY_HOURS = 24
+
+# days deleted objects stay in the change log, clients that last synced before that have to start over
+ACRIS_CHANGE_RETENTION_DAYS = 30
+
 ROOT_URLCONF = 'acris.urls'
 
 TEMPLATES = [
@@ -86,13 +182,26 @@ WSGI_APPLICATION = 'acris.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
+# sqlite in WAL mode with the pragmas of acris.core.sqlite. Reads are routed to the read only 'read' connection
+# (acris.core.routers), writes are made one at a time through 'default', and connections are kept open for
+# CONN_MAX_AGE seconds instead of opened for every request. Both have to point at the same file
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'acris.core.sqlite',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+        'CONN_MAX_AGE': 600,
+    },
+    'read': {
+        'ENGINE': 'acris.core.sqlite',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 600,
+        'OPTIONS': {'read_only': True},
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['acris.core.routers.ReadWriteRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
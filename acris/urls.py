@@ -16,10 +16,19 @@ urlpatterns = [
     path('api/collections/', views.CollectionsListRoute.as_view(), name='collections'),
     path('api/collection/<int:collection_id>/', views.CollectionRoute.as_view(), name='collection-info'),
     path('api/collection/<int:collection_id>/upload/', views.CollectionUploadRoute.as_view(), name='collection-upload'),
+    path('api/collection/<int:collection_id>/import/', views.CollectionImportRoute.as_view(), name='collection-import'),
+    path('api/collection/<int:collection_id>/retag/', views.CollectionRetagRoute.as_view(), name='collection-retag'),
+    path('api/collection/<int:collection_id>/uploads/', views.CollectionResumableUploadsRoute.as_view(), name='collection-uploads'),
+    path('api/upload/<int:upload_id>/', views.ResumableUploadRoute.as_view(), name='upload-session'),
+    path('api/ingest/<int:job_id>/', views.IngestJobRoute.as_view(), name='ingest-job'),
     path('api/collection/<int:collection_id>/tracks/', views.CollectionTracksRoute.as_view(), name='collection-tracks'),
+    path('api/collection/<int:collection_id>/search/', views.CollectionSearchRoute.as_view(), name='collection-search'),
+    path('api/collection/<int:collection_id>/changes/', views.CollectionChangesRoute.as_view(), name='collection-changes'),
     path('api/track/<int:track_id>/', views.TrackRoute.as_view(), name='track-info'),
+    path('api/track/<int:track_id>/lyrics/', views.TrackLyricsRoute.as_view(), name='track-lyrics'),
     path('api/collection/<int:collection_id>/playlists/', views.CollectionPlaylistsRoute.as_view(), name='collection-playlists'),
     path('api/playlist/<int:playlist_id>/', views.PlaylistRoute.as_view(), name='playlist-info'),
+    path('api/playlist/<int:playlist_id>/entries/', views.PlaylistEntriesRoute.as_view(), name='playlist-entries'),
     path('api/playlist/<int:playlist_id>/tracks/', views.PlaylistTracksRoute.as_view(), name='playlist-tracks'),
     path('api/collection/<int:collection_id>/albums/', views.CollectionAlbumsRoute.as_view(), name='collection-albums'),
     path('api/album/<int:album_id>/', views.AlbumRoute.as_view(), name='album-info'),
@@ -32,6 +41,8 @@ urlpatterns = [
     path('api/genre/<str:genre_id>/tracks/', views.GenreTracksRoute.as_view(), name='genre-tracks'),
     path('api/track/<int:track_id>/stream/', views.TrackStreamRoute.as_view(), name='track-stream'),
 
+    path('api/metrics/', views.MetricsRoute.as_view(), name='metrics'),
+
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)